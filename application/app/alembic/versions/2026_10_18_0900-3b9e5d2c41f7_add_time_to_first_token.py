@@ -0,0 +1,26 @@
+"""Add time to first token.
+
+Revision ID: 3b9e5d2c41f7
+Revises: 7f32ea7481a8
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '3b9e5d2c41f7'
+down_revision: Union[str, None] = '7f32ea7481a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Milliseconds until the first streamed token reached the client, NULL for non-streaming requests
+    op.add_column("cosi_usage", sa.Column("time_to_first_token", sa.Integer, nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("cosi_usage", "time_to_first_token")
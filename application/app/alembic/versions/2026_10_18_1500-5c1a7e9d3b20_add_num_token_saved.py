@@ -0,0 +1,26 @@
+"""Add num token saved.
+
+Revision ID: 5c1a7e9d3b20
+Revises: 3b9e5d2c41f7
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '5c1a7e9d3b20'
+down_revision: Union[str, None] = '3b9e5d2c41f7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Estimated prompt tokens left out of the request by the history compaction, NULL for chats without history
+    op.add_column("cosi_usage", sa.Column("num_token_saved", sa.Integer, nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("cosi_usage", "num_token_saved")
@@ -1,10 +1,13 @@
 import os
+import asyncio
 import uvicorn
 import sys
 import logging
 import json
+import time
 
 from fastapi import FastAPI, Response, Request
+from fastapi.responses import StreamingResponse
 from fastapi.logger import logger
 from datetime import datetime
 from pathlib import Path
@@ -15,21 +18,34 @@ from backend.utils import (vertexai_api,
                            storage_api,
                            sql_api,
                            agent_builder_api,
+                           region_router,
+                           metrics,
+                           document_registry,
+                           context_cache,
+                           log_writer,
+                           history_manager,
+                           session_store,
+                           document_store,
+                           query_cache,
                            data_processing,
                            constants,
                            speech_to_text_api)
 from backend.schemas.schemas import(Answer,
                                     ImageAnswer,
                                     Question,
+                                    SpeechQuestion,
                                     HealthCheck,
                                     UnhealthyCheck,
                                     DocQuestion,
+                                    DocUpload,
+                                    DocUploadAnswer,
                                     BackendError,
                                     Conversation,
                                     ImageConversation,
                                     ImageQuestion,
                                     ProvidedDocQuestion,
                                     AnswerWithQuotes,
+                                    AnswerStreamEnd,
                                     GroundContent,
                                     Citation,
                                     ExcelProcessed,
@@ -43,39 +59,260 @@ DATASTORE_ID = os.environ["DATASTORE_ID"]
 
 app = FastAPI()
 
+
+@app.on_event("shutdown")
+def flush_logs():
+    # Uvicorn runs the shutdown event on SIGTERM, i.e. when Cloud Run stops the instance
+    log_writer.shutdown()
+
+
+provided_docs = document_registry.DocumentRegistry(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "local_files")
+)
+metrics.register_gauge(
+    "provided_doc_estimated_tokens",
+    lambda: {doc_key: stats["estimated_tokens"] for doc_key, stats in provided_docs.stats().items()},
+)
+
+
+def _load_provided_doc(doc_key: str, question: str, history: list) -> (str, list, tuple):
+    """Returns content, system instruction and context cache key of a provided document.
+
+    Documents above PROVIDED_DOC_RETRIEVAL_MIN_TOKENS are indexed and answered from the passages
+    matching the question and the previous question, without a context cache as the passages
+    change with every question. The whole document, with its context cache key, is only sent
+    if no passage matches or the document is not indexed. Since PROVIDED_DOC_RETRIEVAL_MIN_TOKENS
+    is below CONTEXT_CACHE_MIN_TOKENS, a context cache is only used in the first case.
+    """
+    document = provided_docs.get(doc_key)
+    excerpts = provided_docs.retrieve(doc_key, " ".join([turn.question for turn in history[-1:]] + [question]))
+    if excerpts is None:
+        metrics.increment("provided_doc_context", "full")
+        return document.content, document.system_instruction, (document.doc_key, document.version)
+    metrics.increment("provided_doc_context", "excerpts")
+    return excerpts, list(document.system_instruction) + [constants.SYSTEM_INSTRUCTION_PROVIDED_DOC_RETRIEVAL], None
+
+
+async def _load_history(question) -> list:
+    """Returns the history of the conversation, from the session store if the client uses it."""
+    if question.use_session_store:
+        return await session_store.get_store().load(question.oid_hashed, question.session_id)
+    return question.history
+
+
+async def _answer_history(question, history: list) -> list:
+    """Returns the history to send back, only the new turn if the client uses the session store."""
+    if question.use_session_store:
+        await session_store.get_store().save(question.oid_hashed, question.session_id, history)
+        return history[-1:]
+    return history
+
+
+async def _inspect_doc_question(question: DocQuestion) -> tuple[dict, tuple[str, str, BackendError], str]:
+    """Inspects the question and anonymizes the document of a doc chat question.
+
+    A document uploaded to /llm/docchat/documents was anonymized on upload, only the question
+    is inspected.
+
+    Returns:
+        The results of inspect_prompt_async and anonymize_text_async, and the original document to log.
+    """
+    if question.doc_id is None:
+        dlp_response, anonymized = await dlp_api.inspect_question_and_anonymize_document_async(
+            question=question.doc_question,
+            document=question.doc_context,
+            project_id=PROJECT_ID,
+        )
+        return dlp_response, anonymized, question.doc_context
+
+    dlp_response, document = await asyncio.gather(
+        dlp_api.inspect_prompt_async(prompt=question.doc_question, project_id=PROJECT_ID),
+        document_store.get_store().get(question.doc_id, question.oid_hashed),
+    )
+    if document is None:
+        error = BackendError(code="404", msg=constants.DOCUMENT_NOT_FOUND_ERROR, status="DOC_NOT_FOUND")
+        return dlp_response, ("", "", error), ""
+    return dlp_response, (document.anonymized_content, document.info, None), document.content
+
+
+def _summarize_history(summary: str | None, turns: list):
+    """Generates the rolling history summary for history_manager."""
+    return region_router.get_router("gemini").run(
+        lambda region: vertexai_api.summarize_conversation_async(summary, turns, PROJECT_ID, location=region)
+    )
+
+
+def _sse_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+async def _stream_answer(
+    question_text: str,
+    history: list,
+    errors: list,
+    full_answer: str,
+    open_stream,
+    router: region_router.RegionRouter,
+    chat_type: str,
+    session_id: str,
+    oid_hashed: str,
+    info: str = "",
+    log_context: str | None = None,
+    restorer: dlp_api.StreamingRestorer | None = None,
+    compacted: history_manager.CompactedHistory | None = None,
+    llm_question: str | None = None,
+    use_session_store: bool = False,
+):
+    """Sends an LLM answer as server-sent events.
+
+    Every text delta is sent as a "token" event. The closing "final" event carries an AnswerStreamEnd
+    with the full answer, the history, errors and token counts. Logging happens after the final event,
+    so it does not delay the client.
+
+    Args:
+        question_text: The user question as shown in the history.
+        history: The history of the conversation without the current turn.
+        errors: Errors found before the LLM call (e.g. DLP findings). If not empty, the LLM is not called.
+        full_answer: The answer to send if the LLM is not called.
+        open_stream: Callable taking a region and returning an async iterator of (text, num_token_prompt, num_token_response).
+        router: The region router of the model family that open_stream calls.
+        restorer: Reverts the pseudonymization of the prompt in the streamed answer.
+        compacted: The compacted history open_stream sends, its summary is updated after the answer.
+        llm_question: The question as sent to the LLM, if it differs from question_text.
+        use_session_store: Whether the client uses the session store, see _answer_history.
+    """
+    quota_exceeded = False
+    num_token_prompt = -1
+    num_token_response = -1
+    response_time = -1
+    time_to_first_token = None
+    # The answer as generated, before the pseudonyms are reverted
+    llm_answer = ""
+    start_time = time.perf_counter()
+
+    if not errors:
+        router.count_request()
+        # Stays True if every region is exhausted or skipped because of an open circuit breaker
+        quota_exceeded = True
+        for region in router.ordered_regions():
+            if not router.acquire(region):
+                continue
+            received = False
+            # Whether record_success or record_failure released the region
+            released = False
+            region_start_time = time.monotonic()
+            try:
+                async for text, num_token_prompt, num_token_response in open_stream(region):
+                    received = received or bool(text)
+                    llm_answer += text
+                    if restorer:
+                        text = restorer.feed(text)
+                    if not text:
+                        continue
+                    if time_to_first_token is None:
+                        time_to_first_token = int((time.perf_counter() - start_time) * 1000)
+                    full_answer += text
+                    yield _sse_event("token", json.dumps({"text": text}, ensure_ascii=False))
+                router.record_success(region, time.monotonic() - region_start_time)
+                released = True
+                quota_exceeded = False
+            except ResourceExhausted as re:
+                logger.warning(re)
+                router.record_failure(region, quota_exceeded=True)
+                released = True
+                # A retry in the next region is only possible as long as nothing was streamed yet
+                if not received:
+                    continue
+                quota_exceeded = False
+                errors.append(BackendError(code="500", msg=str(re), status="STREAM_ERROR"))
+            except Exception as e:
+                logger.exception(e)
+                router.record_failure(region, quota_exceeded=False)
+                released = True
+                quota_exceeded = False
+                errors.append(BackendError(code="500", msg=str(e), status="STREAM_ERROR"))
+            finally:
+                # GeneratorExit or CancelledError when the client disconnects mid-stream
+                if not released:
+                    router.release(region)
+            break
+
+        if restorer:
+            tail = restorer.flush()
+            if tail:
+                full_answer += tail
+                yield _sse_event("token", json.dumps({"text": tail}, ensure_ascii=False))
+        response_time = int(time.perf_counter() - start_time)
+
+    if quota_exceeded:
+        full_answer = constants.QUOTA_EXCEEDED_ERROR
+        errors.append(BackendError(
+            code="500",
+            msg=full_answer,
+            status="QUOTA_ERROR"
+        ))
+
+    history.append(Conversation(
+        question=question_text,
+        answer=full_answer
+    ))
+
+    if use_session_store:
+        await session_store.get_store().save(oid_hashed, session_id, history)
+
+    yield _sse_event("final", AnswerStreamEnd(
+        question=question_text,
+        answer=full_answer,
+        history=history[-1:] if use_session_store else history,
+        errors=errors,
+        info=info,
+        num_token_prompt=num_token_prompt,
+        num_token_response=num_token_response,
+        time_to_first_token=time_to_first_token,
+    ).json())
+
+    log_writer.log_history(
+        session_id,
+        oid_hashed,
+        chat_type,
+        history,
+        os.environ["CHATBOT_LOGGING_BUCKET"],
+        log_context,
+    )
+    if compacted and llm_answer and not errors:
+        history_manager.summarize_later(
+            compacted, Conversation(question=llm_question or question_text, answer=llm_answer), _summarize_history
+        )
+    log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type=chat_type, num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time, time_to_first_token=time_to_first_token, num_token_saved=compacted.tokens_saved if compacted else None)
+    logger.info(f"\nNutzerfrage: {question_text}\nAntwort: {full_answer}")
+
+
+def _sse_response(stream) -> StreamingResponse:
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/llm/provideddocchat",response_model=Answer)
-def call_llm_provided(request: Request, question: ProvidedDocQuestion):
+async def call_llm_provided(request: Request, question: ProvidedDocQuestion):
     logging.basicConfig(level=logging.INFO)
-    available_regions = ["europe-west3", "europe-west4", "europe-west1", "europe-west9"] # EU only, here: Frankfurt, Netherlands, Belgium, Paris
     try:
         doc_question = question.doc_question
         session_id = question.session_id
-        history = question.history
+        history = await _load_history(question)
         oid_hashed = question.oid_hashed
 
-        dlp_response = dlp_api.inspect_prompt(
+        dlp_response = await dlp_api.inspect_prompt_async(
             prompt = doc_question,
             project_id = PROJECT_ID
         )
 
-        doc_context = ""
-
-        doc_key = question.doc_key
-        doc_map = {
-            "fragenkatalog":"/local_files/fragenkatalogv2.txt",
-            "strategiepapier":"/local_files/strategie_final_short.txt",
-        }
-        script_dir_name = os.path.dirname(os.path.realpath(__file__))
-        with open(f"{script_dir_name}{doc_map[doc_key]}", "r") as f:
-            lines = f.readlines()
-            doc_context = "\n".join(lines)
-
-        system_instruction = ""
-        if doc_key == "fragenkatalog":
-            system_instruction = constants.SYSTEM_INSTRUCTION_GEMINI_KATALOG
-        elif doc_key == "strategiepapier":
-            system_instruction = constants.SYSTEM_INSTRUCTION_GEMINI_STRATEGIE
+        doc_context, system_instruction, context_cache_key = _load_provided_doc(question.doc_key, question.doc_question, history)
 
+        # Only set if the LLM is called, a rejected question saves no tokens
+        compacted = None
         quota_exceeded = False
 
         # all vars for return type (default values) / except question and history
@@ -95,26 +332,28 @@ def call_llm_provided(request: Request, question: ProvidedDocQuestion):
                 status="DLP_ERROR"
             ))
         else:
-            for region in available_regions:
-                try:
-                    result, response_time = vertexai_api.ask_gemini_docchat_question(
+            # Older turns beyond the token budget of the model are replaced by a summary
+            compacted = history_manager.compact(session_id, "provided_doc_chat", history, constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME)
+            try:
+                result, response_time = await region_router.get_router("gemini").run(
+                    lambda region: vertexai_api.ask_gemini_docchat_question_async(
                         doc_context=doc_context,
                         prompt=question.doc_question,
                         project_id=PROJECT_ID,
-                        history=question.history,
+                        history=compacted.history,
                         model_name=constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME,
                         system_instruction=system_instruction,
                         temperature=1.0,
                         max_output_tokens=500,
                         location=region,
+                        context_cache_key=context_cache_key,
                     )
-                    full_answer, num_token_prompt, num_token_response = result
-                    quota_exceeded = False
-                    break
-                except ResourceExhausted as re:
-                    logger.warning(re)
-                    quota_exceeded = True
-                    continue
+                )
+                full_answer, num_token_prompt, num_token_response = result
+                history_manager.summarize_later(compacted, Conversation(question=question.doc_question, answer=full_answer), _summarize_history)
+            except ResourceExhausted as re:
+                logger.warning(re)
+                quota_exceeded = True
         if quota_exceeded:
             full_answer = constants.QUOTA_EXCEEDED_ERROR
             errors.append(BackendError(
@@ -128,7 +367,7 @@ def call_llm_provided(request: Request, question: ProvidedDocQuestion):
           answer=full_answer
         ))
 
-        storage_api.log_history(
+        log_writer.log_history(
             session_id,
             oid_hashed,
             "provided_doc_chat",
@@ -137,14 +376,14 @@ def call_llm_provided(request: Request, question: ProvidedDocQuestion):
             doc_context,
        )
 
-        sql_api.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="provided_doc_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
+        log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="provided_doc_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time, num_token_saved=compacted.tokens_saved if compacted else None)
 
         logger.info(f"\nNutzerfrage: {question.doc_question}\nAntwort: {full_answer}")
 
         return Answer(
             question=question.doc_question,
             answer=full_answer,
-            history = history,
+            history=await _answer_history(question, history),
             errors=errors,
             info = ""
         )
@@ -155,26 +394,53 @@ def call_llm_provided(request: Request, question: ProvidedDocQuestion):
             status_code=500
         )
 
+@app.post("/llm/docchat/documents", response_model=DocUploadAnswer)
+async def upload_doc(request: Request, upload: DocUpload):
+    logging.basicConfig(level=logging.INFO)
+    try:
+        start_time = time.perf_counter()
+        # Anonymized once, the following questions reference the document by doc_id
+        dlp_response_doc, dlp_info, dlp_error = await dlp_api.anonymize_text_async(
+            doc_content=upload.doc_context,
+            project_id=PROJECT_ID,
+        )
+        document = None
+        if not dlp_error:
+            document = await document_store.get_store().add(upload.oid_hashed, upload.doc_context, dlp_response_doc, dlp_info)
+            logger.info(f"\nDokument {document.doc_id} hochgeladen ({len(upload.doc_context)} Zeichen)")
+
+        log_writer.log_usage(oid_hashed=upload.oid_hashed, session_id=upload.session_id, chat_type="doc_upload", num_token_prompt=None, num_token_response=None, response_time=int(time.perf_counter() - start_time))
+
+        if dlp_error:
+            return DocUploadAnswer(doc_id=None, errors=[dlp_error], info=dlp_info)
+
+        return DocUploadAnswer(
+            doc_id=document.doc_id,
+            errors=[],
+            info=dlp_info,
+            expires_in=constants.DOCUMENT_STORE_TTL_SECONDS,
+        )
+    except Exception as ex:
+        logger.exception("CDC-GenAI-Weltwissen-Backend-Docchat-Upload-Error: %s", ex)
+        return Response(
+            content=str(ex),
+            status_code=500
+        )
+
 @app.post("/llm/docchat",response_model=Answer)
-def call_llm(request: Request, question: DocQuestion):
+async def call_llm(request: Request, question: DocQuestion):
     logging.basicConfig(level=logging.INFO)
-    available_regions = ["europe-west3", "europe-west4", "europe-west1", "europe-west9"] # EU only, here: Frankfurt, Netherlands, Belgium, Paris
     try:
-        doc_context = question.doc_context
         doc_question = question.doc_question
         session_id = question.session_id
         oid_hashed = question.oid_hashed
-        history = question.history
+        history = await _load_history(question)
 
-        dlp_response = dlp_api.inspect_prompt(
-            prompt=doc_question,
-            project_id=PROJECT_ID
-        )
-        dlp_response_doc, dlp_info, dlp_error = dlp_api.anonymize_text(
-            doc_content=doc_context,
-            project_id=PROJECT_ID,
-        )
+        # Question and document are inspected concurrently, an uploaded document only once on upload
+        dlp_response, (dlp_response_doc, dlp_info, dlp_error), doc_context = await _inspect_doc_question(question)
 
+        # Only set if the LLM is called, a rejected question saves no tokens
+        compacted = None
         quota_exceeded = False
 
         # all vars for return type (default values) / except question and history
@@ -196,23 +462,24 @@ def call_llm(request: Request, question: DocQuestion):
         elif dlp_error:
             errors.append(dlp_error)
         else:
-            for region in available_regions:
-                try:
-                    result, response_time = vertexai_api.ask_gemini_docchat_question(
+            # Older turns beyond the token budget of the model are replaced by a summary
+            compacted = history_manager.compact(session_id, "doc_chat", history, constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME)
+            try:
+                result, response_time = await region_router.get_router("gemini").run(
+                    lambda region: vertexai_api.ask_gemini_docchat_question_async(
                         doc_context=dlp_response_doc,
                         prompt=question.doc_question,
                         project_id=PROJECT_ID,
-                        history=question.history,
+                        history=compacted.history,
                         model_name=constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME,
                         location=region,
                     )
-                    full_answer, num_token_prompt, num_token_response = result
-                    quota_exceeded = False
-                    break
-                except ResourceExhausted as re:
-                    logger.warning(re)
-                    quota_exceeded = True
-                    continue
+                )
+                full_answer, num_token_prompt, num_token_response = result
+                history_manager.summarize_later(compacted, Conversation(question=question.doc_question, answer=full_answer), _summarize_history)
+            except ResourceExhausted as re:
+                logger.warning(re)
+                quota_exceeded = True
         if quota_exceeded:
             full_answer = constants.QUOTA_EXCEEDED_ERROR
             errors.append(BackendError(
@@ -226,7 +493,7 @@ def call_llm(request: Request, question: DocQuestion):
           answer=full_answer
         ))
 
-        storage_api.log_history(
+        log_writer.log_history(
             session_id,
             oid_hashed,
             "doc_chat",
@@ -235,14 +502,14 @@ def call_llm(request: Request, question: DocQuestion):
             doc_context,
        )
 
-        sql_api.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="doc_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
+        log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="doc_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time, num_token_saved=compacted.tokens_saved if compacted else None)
 
         logger.info(f"\nNutzerfrage: {question.doc_question}\nAntwort: {full_answer}")
 
         return Answer(
             question=question.doc_question,
             answer=full_answer,
-            history = history,
+            history=await _answer_history(question, history),
             errors=errors,
             info = dlp_info
         )
@@ -254,23 +521,28 @@ def call_llm(request: Request, question: DocQuestion):
         )
 
 @app.post("/llm/textchat", response_model=Answer)
-def call_llm(request: Request, question: Question):
+async def call_llm(request: Request, question: Question):
     logging.basicConfig(level=logging.INFO)
-    available_regions = ["europe-west3", "europe-west4", "europe-west1", "europe-west9"] # EU only, here: Frankfurt, Netherlands, Belgium, Paris
     try:
-        history = question.history # Is logged in Cloud Storage Bucket
+        history = await _load_history(question) # Is logged in Cloud Storage Bucket
         session_id = question.session_id
         oid_hashed = question.oid_hashed
         apply_pseudonymization = question.apply_pseudonymization
 
-        if apply_pseudonymization:
-            # Pseudonymize the prompt to replace PII before sending it to LLM
-            pseudonymized_prompt, replacement_mapping, dlp_error = dlp_api.pseudonymize_text(prompt=question.question, project_id=PROJECT_ID)
-            # Inspect whether the user prompt contains at personal sensitive information
-        dlp_response = dlp_api.inspect_prompt(
+        # Inspect whether the user prompt contains personal sensitive information and, with the
+        # findings of the same DLP request, pseudonymize the prompt before sending it to the LLM
+        dlp_response = await dlp_api.inspect_and_pseudonymize_async(
             prompt=question.question,
             project_id=PROJECT_ID,
+            pseudonymize=apply_pseudonymization,
+            session_key=(question.oid_hashed, question.session_id),
         )
+        if apply_pseudonymization:
+            pseudonymized_prompt = dlp_response["pseudonymized_prompt"]
+            replacement_mapping = dlp_response["replacement_mapping"]
+            dlp_error = dlp_response["error"]
+        # Only set if the LLM is called, a rejected question saves no tokens
+        compacted = None
         quota_exceeded = False
 
         # all vars for return type (default values) / except question and history
@@ -290,25 +562,27 @@ def call_llm(request: Request, question: Question):
                 status="DLP_ERROR"
             ))
         else:
-            for region in available_regions:
-                try:
-                    result, response_time = vertexai_api.ask_gemini_textchat_question(
+            # Older turns beyond the token budget of the model are replaced by a summary
+            compacted = history_manager.compact(session_id, "text_chat", history if not apply_pseudonymization else dlp_api.pseudonymize_history(history, (oid_hashed, session_id)), constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME)
+            try:
+                result, response_time = await region_router.get_router("gemini").run(
+                    lambda region: vertexai_api.ask_gemini_textchat_question_async(
                         prompt=question.question if not apply_pseudonymization else pseudonymized_prompt,
                         project_id=PROJECT_ID,
-                        history=question.history,
+                        history=compacted.history,
                         location=region
-                    ) # Try to get an answer from the Vertex AI PaLM API endpoint. If the quota for that API is exceeded in this region the for-loop continues with the next region in the list defined above.
-
-                    full_answer, num_token_prompt, num_token_response = result
-                    quota_exceeded = False
-                    break
-                except Exception as e:
-                    logger.error(str(e))
-                    print(e)
-                except ResourceExhausted as re:
-                    logger.warning(re)
-                    quota_exceeded = True
-                    continue
+                    )
+                ) # The router tries the healthiest region first and fails over to the next one if the quota of a region is exceeded.
+
+                full_answer, num_token_prompt, num_token_response = result
+                history_manager.summarize_later(compacted, Conversation(question=question.question if not apply_pseudonymization else pseudonymized_prompt, answer=full_answer), _summarize_history)
+                if apply_pseudonymization:
+                    full_answer, _ = dlp_api.restore_original_data(replacement_mapping, full_answer)
+            except ResourceExhausted as re:
+                logger.warning(re)
+                quota_exceeded = True
+            except Exception as e:
+                logger.exception("CDC-GenAI-Weltwissen-Backend-Textchat-LLM-Error: %s", e)
         if quota_exceeded:
             full_answer = constants.QUOTA_EXCEEDED_ERROR
             errors.append(BackendError(
@@ -320,26 +594,26 @@ def call_llm(request: Request, question: Question):
           question=question.question,
           answer=full_answer
         ))
-        storage_api.log_history(
+        log_writer.log_history(
             session_id,
             oid_hashed,
             "text_chat",
             history,
             os.environ["CHATBOT_LOGGING_BUCKET"],
         )
-        sql_api.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="text_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
+        log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="text_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time, num_token_saved=compacted.tokens_saved if compacted else None)
         logger.info(f"\nNutzerfrage: {question.question}\nAntwort: {full_answer}")
         return Answer(
             question=question.question,
             answer=full_answer,
-            history=history,
+            history=await _answer_history(question, history),
             errors=errors
         )
     except Exception as ex:
         logger.exception("CDC-GenAI-Weltwissen-Backend-Textchat-Error: %s", ex)
         return Response(content=str(ex), status_code=500)
 @app.post("/llm/speechtotext", response_model=Answer)
-def call_llm(request: Request, speech_question: SpeechQuestion):
+async def call_llm(request: Request, speech_question: SpeechQuestion):
     """Processes a voice-input question
     This method handles a question transcribed from voice input, potentially pseudonymizes it, and logs history to a storage bucket and updates usage metrics in a SQL table
     Args:
@@ -353,26 +627,36 @@ def call_llm(request: Request, speech_question: SpeechQuestion):
             - The errors
     """
     logging.basicConfig(level=logging.INFO)
-    available_regions = ["europe-west3", "europe-west4", "europe-west1", "europe-west9"] # EU only, here: Frankfurt, Netherlands, Belgium, Paris
     try:
         # Transcribe the voice-input question
-        transcribed_question = speech_to_text_api.transcribe(speech_question.path)
+        transcribed_question = await asyncio.to_thread(speech_to_text_api.transcribe, speech_question.path)
         # Create a Question-object with the transcribed prompt
         question = Question(
             question=transcribed_question,
             history = speech_question.history, # Is logged in Cloud Storage Bucket
             session_id = speech_question.session_id,
             oid_hashed = speech_question.oid_hashed, 
-            apply_pseudonymization = speech_question.apply_pseudonymization 
+            apply_pseudonymization = speech_question.apply_pseudonymization,
+            use_session_store = speech_question.use_session_store,
         )
-        if apply_pseudonymization: 
-            # Pseudonymize the prompt to replace PII before sending it to LLM
-            pseudonymized_prompt, replacement_mapping, _ = dlp_api.pseudonymize_text(prompt=question.question, project_id=PROJECT_ID) 
-        # Inspect whether the user prompt contains at personal sensitive information
-        dlp_response = dlp_api.inspect_prompt(
+        history = await _load_history(question)
+        session_id = question.session_id
+        oid_hashed = question.oid_hashed
+        apply_pseudonymization = question.apply_pseudonymization
+        replacement_mapping = None
+        # Inspect whether the user prompt contains personal sensitive information and, with the
+        # findings of the same DLP request, pseudonymize the prompt before sending it to the LLM
+        dlp_response = await dlp_api.inspect_and_pseudonymize_async(
             prompt=question.question,
             project_id=PROJECT_ID,
+            pseudonymize=apply_pseudonymization,
+            session_key=(question.oid_hashed, question.session_id),
         )
+        if apply_pseudonymization:
+            pseudonymized_prompt = dlp_response["pseudonymized_prompt"]
+            replacement_mapping = dlp_response["replacement_mapping"]
+        # Only set if the LLM is called, a rejected question saves no tokens
+        compacted = None
         quota_exceeded = False
         # all vars for return type (default values) / except question and history
         errors = []
@@ -389,25 +673,25 @@ def call_llm(request: Request, speech_question: SpeechQuestion):
                 status="DLP_ERROR"
             ))
         else:
-            for region in available_regions:
-                try:
-                    result, response_time = vertexai_api.ask_gemini_textchat_question(
+            # Older turns beyond the token budget of the model are replaced by a summary
+            compacted = history_manager.compact(session_id, "text_chat", history if not apply_pseudonymization else dlp_api.pseudonymize_history(history, (oid_hashed, session_id)), constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME)
+            try:
+                result, response_time = await region_router.get_router("gemini").run(
+                    lambda region: vertexai_api.ask_gemini_textchat_question_async(
                         prompt=question.question if not apply_pseudonymization else pseudonymized_prompt, 
                         project_id=PROJECT_ID,
-                        history=question.history,
+                        history=compacted.history,
                         location=region
-                    ) # Try to get an answer from the Vertex AI PaLM API endpoint. If the quota for that API is exceeded in this region the for-loop continues with the next region in the list defined above.
-                    pseudonymized_answer, num_token_prompt, num_token_response = result 
-                    full_answer,_ = dlp_api.restore_original_data(replacement_mapping, pseudonymized_answer) 
-                    quota_exceeded = False
-                    break
-                except Exception as e:
-                    logger.error(str(e))
-                    print(e)
-                except ResourceExhausted as re:
-                    logger.warning(re)
-                    quota_exceeded = True
-                    continue
+                    )
+                ) # The router tries the healthiest region first and fails over to the next one if the quota of a region is exceeded.
+                pseudonymized_answer, num_token_prompt, num_token_response = result 
+                history_manager.summarize_later(compacted, Conversation(question=question.question if not apply_pseudonymization else pseudonymized_prompt, answer=pseudonymized_answer), _summarize_history)
+                full_answer,_ = dlp_api.restore_original_data(replacement_mapping, pseudonymized_answer) 
+            except ResourceExhausted as re:
+                logger.warning(re)
+                quota_exceeded = True
+            except Exception as e:
+                logger.exception("CDC-GenAI-Weltwissen-Backend-Textchat-LLM-Error: %s", e)
 
         if quota_exceeded:
             full_answer = constants.QUOTA_EXCEEDED_ERROR
@@ -422,7 +706,7 @@ def call_llm(request: Request, speech_question: SpeechQuestion):
           answer=full_answer
         ))
 
-        storage_api.log_history(
+        log_writer.log_history(
             session_id,
             oid_hashed,
             "text_chat",
@@ -430,14 +714,14 @@ def call_llm(request: Request, speech_question: SpeechQuestion):
             os.environ["CHATBOT_LOGGING_BUCKET"],
         )
 
-        sql_api.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="text_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
+        log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="text_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time, num_token_saved=compacted.tokens_saved if compacted else None)
 
 
         logger.info(f"\nNutzerfrage: {question.question}\nAntwort: {full_answer}")
         return Answer(
             question = question.question,
             answer = full_answer,
-            history = history,
+            history=await _answer_history(question, history),
             errors = errors
         )
     except Exception as ex:
@@ -447,20 +731,21 @@ def call_llm(request: Request, speech_question: SpeechQuestion):
 
 
 @app.post("/llm/codechat", response_model=Answer)
-def call_llm(request: Request, question: Question):
+async def call_llm(request: Request, question: Question):
     logging.basicConfig(level=logging.INFO)
-    available_regions = ["europe-west3", "europe-west4", "europe-west1", "europe-west9"] # EU only, here: Frankfurt, Netherlands, Belgium, Paris
     try:
-        history = question.history
+        history = await _load_history(question)
         session_id = question.session_id
         oid_hashed = question.oid_hashed
 
         # Inspect whether the user prompt contains at personal sensitive information
-        dlp_response = dlp_api.inspect_prompt(
+        dlp_response = await dlp_api.inspect_prompt_async(
             prompt=question.question,
             project_id=PROJECT_ID,
         )
 
+        # Only set if the LLM is called, a rejected question saves no tokens
+        compacted = None
         quota_exceeded = False
 
         # all vars for return type (default values) / except question and history
@@ -480,22 +765,23 @@ def call_llm(request: Request, question: Question):
                 status="DLP_ERROR"
             ))
         else:
-            for region in available_regions:
-                try:
-                    result, response_time = vertexai_api.ask_codechat_question(
+            # Older turns beyond the token budget of the model are replaced by a summary
+            compacted = history_manager.compact(session_id, "code_chat", history, constants.CODE_CHAT_DEFAULT_MODEL_NAME)
+            try:
+                result, response_time = await region_router.get_router("codechat").run(
+                    lambda region: vertexai_api.ask_codechat_question_async(
                         prompt=question.question,
                         project_id=PROJECT_ID,
-                        history=question.history,
+                        history=compacted.history,
                         location=region
-                    ) # Try to get an answer from the Vertex AI PaLM API endpoint. If the quota for that API is exceeded in this region the for-loop continues with the next region in the list defined above.
-
-                    full_answer, num_token_prompt, num_token_response = result
-                    quota_exceeded = False
-                    break
-                except ResourceExhausted as re:
-                    logger.warning(re)
-                    quota_exceeded = True
-                    continue
+                    )
+                ) # The router tries the healthiest region first and fails over to the next one if the quota of a region is exceeded.
+
+                full_answer, num_token_prompt, num_token_response = result
+                history_manager.summarize_later(compacted, Conversation(question=question.question, answer=full_answer), _summarize_history)
+            except ResourceExhausted as re:
+                logger.warning(re)
+                quota_exceeded = True
         if quota_exceeded:
             full_answer = constants.QUOTA_EXCEEDED_ERROR
             errors.append(BackendError(
@@ -509,7 +795,7 @@ def call_llm(request: Request, question: Question):
           answer=full_answer
         ))
 
-        storage_api.log_history(
+        log_writer.log_history(
             session_id,
             oid_hashed,
             "code_chat",
@@ -517,13 +803,13 @@ def call_llm(request: Request, question: Question):
             os.environ["CHATBOT_LOGGING_BUCKET"],
         )
 
-        sql_api.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="code_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
+        log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="code_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time, num_token_saved=compacted.tokens_saved if compacted else None)
 
         logger.info(f"\nNutzerfrage: {question.question}\nAntwort: {full_answer}")
         return Answer(
             question = question.question,
             answer = full_answer,
-            history = history,
+            history=await _answer_history(question, history),
             errors = errors
         )
     except Exception as ex:
@@ -531,16 +817,15 @@ def call_llm(request: Request, question: Question):
         return Response(content=str(ex), status_code=500)
 
 @app.post("/llm/imagen", response_model=ImageAnswer)
-def call_llm(request: Request, question: ImageQuestion):
+async def call_llm(request: Request, question: ImageQuestion):
     logging.basicConfig(level=logging.INFO)
-    available_regions = ["europe-west3", "europe-west4", "europe-west1", "europe-west9"] # EU only, here: Frankfurt, Netherlands, Belgium, Paris
     try:
         history = question.history
         session_id = question.session_id
         oid_hashed = question.oid_hashed
 
         # Inspect whether the user prompt contains at personal sensitive information
-        dlp_response = dlp_api.inspect_prompt(
+        dlp_response = await dlp_api.inspect_prompt_async(
             prompt=question.question,
             project_id=PROJECT_ID,
         )
@@ -568,27 +853,25 @@ def call_llm(request: Request, question: ImageQuestion):
                 status="DLP_ERROR"
             ))
         else:
-            for region in available_regions:
-                try:
-                    result, response_time = vertexai_api.generate_image(
+            try:
+                result, response_time = await region_router.get_router("imagen").run(
+                    lambda region: vertexai_api.generate_image_async(
                         prompt=question.question,
                         project_id=PROJECT_ID,
                         history=[],
                         location=region,
                         aspect_ratio = question.aspect_ratio,
-                        session_id=session_id) # Try to get an answer from the Vertex AI PaLM API endpoint. If the quota for that API is exceeded in this region the for-loop continues with the next region in the list defined above.
-
-                    image_urls, en_prompt, errors = result
-
-                    quota_exceeded = False
-                    question_translated = en_prompt
-                    answer_urls: list = image_urls
-                    full_answer = f"Übersetzter Englischer Prompt: {en_prompt}\nCloud Storage URLs: {image_urls}"
-                    break
-                except ResourceExhausted as re:
-                    logger.warning(re)
-                    quota_exceeded = True
-                    continue
+                        session_id=session_id)
+                ) # The router tries the healthiest region first and fails over to the next one if the quota of a region is exceeded.
+
+                image_urls, en_prompt, errors = result
+
+                question_translated = en_prompt
+                answer_urls: list = image_urls
+                full_answer = f"Übersetzter Englischer Prompt: {en_prompt}\nCloud Storage URLs: {image_urls}"
+            except ResourceExhausted as re:
+                logger.warning(re)
+                quota_exceeded = True
 
         if quota_exceeded:
             full_answer = constants.QUOTA_EXCEEDED_ERROR
@@ -613,7 +896,7 @@ def call_llm(request: Request, question: ImageQuestion):
             )
         )
 
-        storage_api.log_history(
+        log_writer.log_history(
             session_id,
             oid_hashed,
             "image_chat",
@@ -621,7 +904,7 @@ def call_llm(request: Request, question: ImageQuestion):
             os.environ["CHATBOT_LOGGING_BUCKET"],
         )
 
-        sql_api.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="image_chat", num_token_prompt=None, num_token_response=None, response_time=response_time)
+        log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="image_chat", num_token_prompt=None, num_token_response=None, response_time=response_time)
 
 
         logger.info(f"\nNutzerfrage: {question.question}\nAntwort: {full_answer}")
@@ -638,18 +921,15 @@ def call_llm(request: Request, question: ImageQuestion):
 
 
 @app.post("/agent-builder/query-datastore", response_model=Answer)
-def call_datastore(request: Request, question: Question):
+async def call_datastore(request: Request, question: Question):
     logging.basicConfig(level=logging.INFO)
-    # EU only, here: Frankfurt, Netherlands, Belgium, Paris
-    available_regions = ["europe-west3",
-                         "europe-west4", "europe-west1", "europe-west9"]
     try:
-        history = question.history
+        history = await _load_history(question)
         session_id = question.session_id
         oid_hashed = question.oid_hashed
 
         # Inspect whether the user prompt contains at personal sensitive information
-        dlp_response = dlp_api.inspect_prompt(
+        dlp_response = await dlp_api.inspect_prompt_async(
             prompt=question.question,
             project_id=PROJECT_ID,
         )
@@ -674,13 +954,17 @@ def call_datastore(request: Request, question: Question):
             ))
         else:
             try:
-                result = agent_builder_api.search_engine(
-                    project=PROJECT_ID,
-                    search_query=question.question,
-                    process_string=False,
-                    location=DATASTORE_LOCATION,
-                    datastore_id=DATASTORE_ID
-                )
+                # Repeated questions are answered from the cache until the data store changes
+                result = await query_cache.get_cache().get(DATASTORE_ID, question.question)
+                if result is None:
+                    result = await agent_builder_api.search_engine_async(
+                        project=PROJECT_ID,
+                        search_query=question.question,
+                        process_string=False,
+                        location=DATASTORE_LOCATION,
+                        datastore_id=DATASTORE_ID
+                    )
+                    query_cache.get_cache().set(DATASTORE_ID, question.question, result)
 
                 # full_answer, num_token_prompt, num_token_response = result
                 quota_exceeded = False
@@ -700,7 +984,7 @@ def call_datastore(request: Request, question: Question):
             answer=full_answer
         ))
 
-        storage_api.log_history(
+        log_writer.log_history(
             session_id,
             oid_hashed,
             "code_chat",
@@ -708,13 +992,13 @@ def call_datastore(request: Request, question: Question):
             os.environ["CHATBOT_LOGGING_BUCKET"],
         )
 
-        sql_api.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="bafin_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
+        log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="bafin_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
 
         logger.info(f"\nNutzerfrage: {question.question}\nAntwort: {result}")
         return Answer(
             question=question.question,
             answer=result,
-            history=history,
+            history=await _answer_history(question, history),
             errors=errors
         )
     except Exception as ex:
@@ -722,28 +1006,28 @@ def call_datastore(request: Request, question: Question):
         return Response(content=str(ex), status_code=500)
 
 
-@app.post("/agent-builder/bafin-grounded-response", response_model=Answer)
-def call_bafin_docs(request: Request, question: Question):
+@app.post("/agent-builder/bafin-grounded-response", response_model=AnswerWithQuotes)
+async def call_bafin_docs(request: Request, question: Question):
     logging.basicConfig(level=logging.INFO)
-    # EU only, here: Frankfurt, Netherlands, Belgium, Paris
-    available_regions = ["europe-west3",
-                         "europe-west4", "europe-west1", "europe-west9"]
     try:
-        history = question.history
+        history = await _load_history(question)
         session_id = question.session_id
         oid_hashed = question.oid_hashed
 
         # Inspect whether the user prompt contains at personal sensitive information
-        dlp_response = dlp_api.inspect_prompt(
+        dlp_response = await dlp_api.inspect_prompt_async(
             prompt=question.question,
             project_id=PROJECT_ID,
         )
 
+        # Only set if the LLM is called, a rejected question saves no tokens
+        compacted = None
         quota_exceeded = False
 
         # all vars for return type (default values) / except question and history
         errors = []
         full_answer = ""
+        citations = []
 
         # Sets default values for logging as these values are not provided in case DLP finds PII. -1 in the logging SQL table means that DLP findings > 0.
         num_token_prompt = -1
@@ -758,22 +1042,24 @@ def call_bafin_docs(request: Request, question: Question):
                 status="DLP_ERROR"
             ))
         else:
-            for region in available_regions:
-                try:
-                    result = vertexai_api.ask_gemini_with_bafin_docs(
+            # Older turns beyond the token budget of the model are replaced by a summary
+            compacted = history_manager.compact(session_id, "bafin_chat", history, constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME)
+            try:
+                result = await region_router.get_router("gemini").run(
+                    lambda region: vertexai_api.ask_gemini_with_bafin_docs_async(
                         project_id=PROJECT_ID,
                         prompt=question.question,
                         datastore_id=DATASTORE_ID,
-                        history=question.history
+                        history=compacted.history,
+                        location=region
                     )
+                )
 
-                    full_answer, num_token_prompt, num_token_response = result
-                    quota_exceeded = False
-                    break
-                except ResourceExhausted as re:
-                    logger.warning(re)
-                    quota_exceeded = True
-                    continue
+                full_answer, citations, num_token_prompt, num_token_response = result
+                history_manager.summarize_later(compacted, Conversation(question=question.question, answer=full_answer), _summarize_history)
+            except ResourceExhausted as re:
+                logger.warning(re)
+                quota_exceeded = True
         if quota_exceeded:
             full_answer = constants.QUOTA_EXCEEDED_ERROR
             errors.append(BackendError(
@@ -787,7 +1073,7 @@ def call_bafin_docs(request: Request, question: Question):
             answer=full_answer
         ))
 
-        storage_api.log_history(
+        log_writer.log_history(
             session_id,
             oid_hashed,
             "bafin_chat",
@@ -795,13 +1081,14 @@ def call_bafin_docs(request: Request, question: Question):
             os.environ["CHATBOT_LOGGING_BUCKET"],
         )
 
-        sql_api.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="bafin_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
+        log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="bafin_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time, num_token_saved=compacted.tokens_saved if compacted else None)
 
         logger.info(f"\nNutzerfrage: {question.question}\nAntwort: {full_answer}")
-        return Answer(
+        return AnswerWithQuotes(
             question=question.question,
             answer=full_answer,
-            history=history,
+            citations=citations,
+            history=await _answer_history(question, history),
             errors=errors
         )
     except Exception as ex:
@@ -810,18 +1097,15 @@ def call_bafin_docs(request: Request, question: Question):
 
 
 @app.post("/agent-builder/bafin-multiturn-discovery-engine", response_model=AnswerWithQuotes)
-def call_bafin_multiturn(request: Request, question: Question):
+async def call_bafin_multiturn(request: Request, question: Question):
     logging.basicConfig(level=logging.INFO)
-    # EU only, here: Frankfurt, Netherlands, Belgium, Paris
-    available_regions = ["europe-west3",
-                         "europe-west4", "europe-west1", "europe-west9"]
     try:
-        history = question.history
+        history = await _load_history(question)
         session_id = question.session_id
         oid_hashed = question.oid_hashed
 
         # Inspect whether the user prompt contains at personal sensitive information
-        dlp_response = dlp_api.inspect_prompt(
+        dlp_response = await dlp_api.inspect_prompt_async(
             prompt=question.question,
             project_id=PROJECT_ID,
         )
@@ -831,6 +1115,7 @@ def call_bafin_multiturn(request: Request, question: Question):
         # all vars for return type (default values) / except question and history
         errors = []
         full_answer = ""
+        citations = []
 
         # Sets default values for logging as these values are not provided in case DLP finds PII. -1 in the logging SQL table means that DLP findings > 0.
         num_token_prompt = -1
@@ -846,35 +1131,18 @@ def call_bafin_multiturn(request: Request, question: Question):
             ))
         else:
             try:
-                result = agent_builder_api.multi_turn_search(
+                result = await agent_builder_api.multi_turn_search_async(
                     project_id=PROJECT_ID,
                     datastore_id=DATASTORE_ID,
                     location=DATASTORE_LOCATION,
                     search_queries=[question.question],
+                    session_id=session_id,
+                    oid_hashed=oid_hashed,
                 )
 
-                full_answer = agent_builder_api.process_multiturn_response(response=result)
-
-                citations = []
-                for reference in full_answer[-1]["references"]:
-                    ground_content = []
-                    # print(reference)
-                    for content in reference["citation_contents"]:
-                        ground_content.append(
-                            GroundContent(
-                                page=content["page_number"],
-                                content=content["ground_content"]
-                            )
-                        )
-
-                    citations.append(
-                        Citation(
-                            id=reference["citation_id"],
-                            name=reference["file_name"],
-                            link=reference["sharepoint_url"],
-                            path=reference["file_path"],
-                            content=ground_content
-                    ))
+                reply = agent_builder_api.extract_multiturn_replies(result)[-1]
+                full_answer = reply.answer
+                citations = reply.citations
 
                 quota_exceeded = False
             except ResourceExhausted as re:
@@ -890,10 +1158,10 @@ def call_bafin_multiturn(request: Request, question: Question):
 
         history.append(Conversation(
             question=question.question,
-            answer=full_answer[-1]["answer"]
+            answer=full_answer
         ))
 
-        storage_api.log_history(
+        log_writer.log_history(
             session_id,
             oid_hashed,
             "bafin_chat",
@@ -901,14 +1169,14 @@ def call_bafin_multiturn(request: Request, question: Question):
             os.environ["CHATBOT_LOGGING_BUCKET"],
         )
 
-        sql_api.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="bafin_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
+        log_writer.log_usage(oid_hashed=oid_hashed, session_id=session_id, chat_type="bafin_chat", num_token_prompt=num_token_prompt, num_token_response=num_token_response, response_time=response_time)
 
         logger.info(f"\nNutzerfrage: {question.question}\nAntwort: {full_answer}")
         return AnswerWithQuotes(
             question=question.question,
-            answer=agent_builder_api.create_markdown(full_answer[-1]),
+            answer=full_answer,
             citations=citations,
-            history=history,
+            history=await _answer_history(question, history),
             errors=errors
         )
     except Exception as ex:
@@ -916,6 +1184,211 @@ def call_bafin_multiturn(request: Request, question: Question):
         return Response(content=str(ex), status_code=500)
 
 
+@app.post("/llm/provideddocchat/stream")
+async def stream_llm_provided(request: Request, question: ProvidedDocQuestion):
+    logging.basicConfig(level=logging.INFO)
+    try:
+        history = await _load_history(question)
+        dlp_response = await dlp_api.inspect_prompt_async(
+            prompt=question.doc_question,
+            project_id=PROJECT_ID
+        )
+        doc_context, system_instruction, context_cache_key = _load_provided_doc(question.doc_key, question.doc_question, history)
+
+        errors = []
+        full_answer = ""
+        if dlp_response["num_findings"] > 0:
+            full_answer = dlp_response["findings_formatted"]
+            errors.append(BackendError(
+                code="500",
+                msg=full_answer,
+                status="DLP_ERROR"
+            ))
+
+        # Older turns beyond the token budget of the model are replaced by a summary, if the LLM is called
+        compacted = None if errors else history_manager.compact(question.session_id, "provided_doc_chat", history, constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME)
+        return _sse_response(_stream_answer(
+            question_text=question.doc_question,
+            history=history,
+            errors=errors,
+            full_answer=full_answer,
+            open_stream=lambda region: vertexai_api.stream_gemini_docchat_question(
+                doc_context=doc_context,
+                prompt=question.doc_question,
+                project_id=PROJECT_ID,
+                history=compacted.history,
+                model_name=constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME,
+                system_instruction=system_instruction,
+                temperature=1.0,
+                max_output_tokens=500,
+                location=region,
+                context_cache_key=context_cache_key,
+            ),
+            router=region_router.get_router("gemini"),
+            chat_type="provided_doc_chat",
+            session_id=question.session_id,
+            oid_hashed=question.oid_hashed,
+            use_session_store=question.use_session_store,
+            compacted=compacted,
+            log_context=doc_context,
+        ))
+    except Exception as ex:
+        logger.exception("CDC-GenAI-Weltwissen-Backend-Docchat-Stream-Error: %s", ex)
+        return Response(content=str(ex), status_code=500)
+
+
+@app.post("/llm/docchat/stream")
+async def stream_llm_doc(request: Request, question: DocQuestion):
+    logging.basicConfig(level=logging.INFO)
+    try:
+        history = await _load_history(question)
+        # Question and document are inspected concurrently, an uploaded document only once on upload
+        dlp_response, (dlp_response_doc, dlp_info, dlp_error), doc_context = await _inspect_doc_question(question)
+
+        errors = []
+        full_answer = ""
+        if dlp_response["num_findings"] > 0:
+            full_answer = dlp_response["findings_formatted"]
+            errors.append(BackendError(
+                code="500",
+                msg=full_answer,
+                status="DLP_ERROR"
+            ))
+        elif dlp_error:
+            errors.append(dlp_error)
+
+        # Older turns beyond the token budget of the model are replaced by a summary, if the LLM is called
+        compacted = None if errors else history_manager.compact(question.session_id, "doc_chat", history, constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME)
+        return _sse_response(_stream_answer(
+            question_text=question.doc_question,
+            history=history,
+            errors=errors,
+            full_answer=full_answer,
+            open_stream=lambda region: vertexai_api.stream_gemini_docchat_question(
+                doc_context=dlp_response_doc,
+                prompt=question.doc_question,
+                project_id=PROJECT_ID,
+                history=compacted.history,
+                model_name=constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME,
+                location=region,
+            ),
+            router=region_router.get_router("gemini"),
+            chat_type="doc_chat",
+            session_id=question.session_id,
+            oid_hashed=question.oid_hashed,
+            use_session_store=question.use_session_store,
+            compacted=compacted,
+            info=dlp_info,
+            log_context=doc_context,
+        ))
+    except Exception as ex:
+        logger.exception("CDC-GenAI-Weltwissen-Backend-Docchat-Stream-Error: %s", ex)
+        return Response(content=str(ex), status_code=500)
+
+
+@app.post("/llm/textchat/stream")
+async def stream_llm_text(request: Request, question: Question):
+    logging.basicConfig(level=logging.INFO)
+    try:
+        history = await _load_history(question)
+        errors = []
+        full_answer = ""
+        prompt = question.question
+        llm_history = history
+        restorer = None
+
+        if question.apply_pseudonymization:
+            # Pseudonymize the prompt and revert the pseudonyms in the streamed answer
+            prompt, replacement_mapping, dlp_error = await dlp_api.pseudonymize_text_async(prompt=question.question, project_id=PROJECT_ID, session_key=(question.oid_hashed, question.session_id))
+            if dlp_error:
+                errors.append(dlp_error)
+            llm_history = dlp_api.pseudonymize_history(history, (question.oid_hashed, question.session_id))
+            restorer = dlp_api.StreamingRestorer(replacement_mapping)
+        else:
+            dlp_response = await dlp_api.inspect_prompt_async(
+                prompt=question.question,
+                project_id=PROJECT_ID,
+            )
+            if dlp_response["num_findings"] > 0:
+                full_answer = dlp_response["findings_formatted"]
+                errors.append(BackendError(
+                    code="500",
+                    msg=full_answer,
+                    status="DLP_ERROR"
+                ))
+
+        # Older turns beyond the token budget of the model are replaced by a summary, if the LLM is called
+        compacted = None if errors else history_manager.compact(question.session_id, "text_chat", llm_history, constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME)
+        return _sse_response(_stream_answer(
+            question_text=question.question,
+            history=history,
+            errors=errors,
+            full_answer=full_answer,
+            open_stream=lambda region: vertexai_api.stream_gemini_textchat_question(
+                prompt=prompt,
+                project_id=PROJECT_ID,
+                history=compacted.history,
+                location=region,
+            ),
+            router=region_router.get_router("gemini"),
+            chat_type="text_chat",
+            session_id=question.session_id,
+            oid_hashed=question.oid_hashed,
+            use_session_store=question.use_session_store,
+            compacted=compacted,
+            llm_question=prompt,
+            restorer=restorer,
+        ))
+    except Exception as ex:
+        logger.exception("CDC-GenAI-Weltwissen-Backend-Textchat-Stream-Error: %s", ex)
+        return Response(content=str(ex), status_code=500)
+
+
+@app.post("/llm/codechat/stream")
+async def stream_llm_code(request: Request, question: Question):
+    logging.basicConfig(level=logging.INFO)
+    try:
+        history = await _load_history(question)
+        dlp_response = await dlp_api.inspect_prompt_async(
+            prompt=question.question,
+            project_id=PROJECT_ID,
+        )
+
+        errors = []
+        full_answer = ""
+        if dlp_response["num_findings"] > 0:
+            full_answer = dlp_response["findings_formatted"]
+            errors.append(BackendError(
+                code="500",
+                msg=full_answer,
+                status="DLP_ERROR"
+            ))
+
+        # Older turns beyond the token budget of the model are replaced by a summary, if the LLM is called
+        compacted = None if errors else history_manager.compact(question.session_id, "code_chat", history, constants.CODE_CHAT_DEFAULT_MODEL_NAME)
+        return _sse_response(_stream_answer(
+            question_text=question.question,
+            history=history,
+            errors=errors,
+            full_answer=full_answer,
+            open_stream=lambda region: vertexai_api.stream_codechat_question(
+                prompt=question.question,
+                project_id=PROJECT_ID,
+                history=compacted.history,
+                location=region,
+            ),
+            router=region_router.get_router("codechat"),
+            chat_type="code_chat",
+            session_id=question.session_id,
+            oid_hashed=question.oid_hashed,
+            use_session_store=question.use_session_store,
+            compacted=compacted,
+        ))
+    except Exception as ex:
+        logger.exception("CDC-GenAI-Weltwissen-Backend-Codechat-Stream-Error: %s", ex)
+        return Response(content=str(ex), status_code=500)
+
+
 @app.post("/excel_processing", response_model=ExcelProcessed)
 def process_excel(request: Request, file_bytes: FileBytes):
     logging.basicConfig(level=logging.INFO)
@@ -932,6 +1405,26 @@ def process_excel(request: Request, file_bytes: FileBytes):
 def get_health():
     return HealthCheck(status="OK")
 
+# Provided documents with their size and estimated prompt cost
+@app.get("/documents", status_code=200)
+def get_provided_documents():
+    return provided_docs.stats()
+
+# Context caches of the provided documents per model and region
+@app.get("/documents/caches", status_code=200)
+def get_context_caches():
+    return context_cache.get_manager().snapshot()
+
+# In-memory metrics of this instance (caches, registries, queues)
+@app.get("/metrics", status_code=200)
+def get_metrics():
+    return metrics.snapshot()
+
+# Health scores and circuit breaker states of the Vertex AI regions
+@app.get("/health/regions", status_code=200)
+def get_region_health():
+    return region_router.snapshot()
+
 @app.get("/unhealthy",status_code=500,response_model=UnhealthyCheck)
 def get_unhealthy():
     return UnhealthyCheck(status="Really not okay!")
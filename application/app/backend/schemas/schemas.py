@@ -21,6 +21,15 @@ class Question(BaseModel):
     session_id: str
     oid_hashed: str
     apply_pseudonymization: bool = True
+    use_session_store: bool = False # The history is kept on the server, the client sends and receives only the new turn
+
+class SpeechQuestion(BaseModel):
+    path: str
+    history: List[Conversation] = []
+    session_id: str
+    oid_hashed: str
+    apply_pseudonymization: bool = True
+    use_session_store: bool = False
 
 class ImageQuestion(BaseModel):
     question: str
@@ -29,19 +38,34 @@ class ImageQuestion(BaseModel):
     oid_hashed: str
 
 class DocQuestion(BaseModel):
-    doc_context:str
+    # Either the document itself or the doc_id returned by /llm/docchat/documents
+    doc_context:str = ""
+    doc_id:str | None = None
     doc_question:str
     session_id:str
     oid_hashed:str
     history: List[Conversation] = []
+    use_session_store: bool = False
     llm_model_name:str = "gemini-1.0-pro-001"
 
+class DocUpload(BaseModel):
+    doc_context:str
+    session_id:str
+    oid_hashed:str
+
+class DocUploadAnswer(BaseModel):
+    doc_id: str | None
+    errors: List[BackendError]
+    info: str = ""
+    expires_in: int = 0
+
 class ProvidedDocQuestion(BaseModel):
     doc_question:str
     session_id:str
     oid_hashed:str
     doc_key:str
     history: List[Conversation] = []
+    use_session_store: bool = False
     llm_model_name:str = "gemini-1.0-pro-001"
     doc_key:str
 
@@ -52,6 +76,17 @@ class Answer(BaseModel):
     errors: List[BackendError]
     info: str = ""
 
+class AnswerStreamEnd(BaseModel):
+    """Final frame of a streamed answer, sent after the last token frame."""
+    question: str
+    answer: str
+    history: List[Conversation]
+    errors: List[BackendError]
+    info: str = ""
+    num_token_prompt: int = -1
+    num_token_response: int = -1
+    time_to_first_token: int | None = None
+
 class GroundContent(BaseModel):
     page: int
     content: str
@@ -1,12 +1,17 @@
 from sqlmodel import Field, SQLModel, create_engine, Session
+from sqlalchemy import func
 from datetime import datetime
+from typing import Optional
 
 class CosiUsage(SQLModel, table=True):
     __tablename__ = 'cosi_usage'
     oid_hashed: str
     session_id: str = Field(primary_key=True)
     chat_type: str
-    time_stamp: datetime = Field(default=None, primary_key=True)
+    # Set by the database, same server default as in the migration creating the table
+    time_stamp: datetime = Field(default=None, primary_key=True, sa_column_kwargs={"server_default": func.now()})
     num_token_prompt: int
     num_token_response: int
     response_time: int
+    time_to_first_token: Optional[int] = None
+    num_token_saved: Optional[int] = None
@@ -1,42 +1,94 @@
-from typing import List, Dict
+import asyncio
+import functools
+import threading
+from typing import Any, Callable, List, Dict, NamedTuple, Optional, Tuple
 from google.cloud.discoveryengine_v1beta import (
     SearchRequest,
-    SearchServiceClient
+    SearchServiceClient,
+    SearchServiceAsyncClient
 )
 from google.cloud.discoveryengine_v1beta.services.search_service import pagers
 from google.api_core.client_options import ClientOptions
+from google.api_core.exceptions import NotFound
 from google.cloud import discoveryengine_v1 as discoveryengine
 
+from . import constants, grounding_renderer, metrics, ttl_cache
+from backend.schemas.schemas import Citation, GroundContent
 
-def _init_search_client(project: str, location: str, datastore_id: str):
+_MISSING_PAGE_NUMBER = 999
+_MISSING_GROUND_CONTENT = "Kein Inhalt erhalten"
+
+# Clients mit ihren Pfaden, je Art, Projekt, Standort und Datenspeicher. Die Clients halten ihren
+# gRPC-Kanal offen und werden von allen Requests geteilt.
+_clients: Dict[Tuple, Tuple] = {}
+_clients_lock = threading.Lock()
+
+
+def _pooled_clients(kind: str, project: str, location: str, datastore_id: str, factory: Callable[[], Tuple], loop: Any = None) -> Tuple:
     """
-    Initialisiert den Suchclient und die Serving-Konfiguration.
+    Gibt die geteilten Clients samt Pfaden zurück und erzeugt sie beim ersten Aufruf.
 
     Args:
+        kind: Art des Clients, z.B. "search".
         project: Google Cloud Projekt-ID.
         location: Standort des Datenspeichers.
         datastore_id: ID des Datenspeichers.
+        factory: Erzeugt das Tupel aus Client und Pfaden.
+        loop: Event-Loop eines asynchronen Clients, dessen gRPC-Kanal an den Loop gebunden ist.
 
     Returns:
-        Ein Tupel aus dem SearchServiceClient und dem Serving-Konfigurationspfad.
+        Das Tupel aus factory.
     """
-    client_options = (
-        ClientOptions(
-            api_endpoint=f"{location}-discoveryengine.googleapis.com")
-    )
+    key = (kind, project, location, datastore_id, loop)
+    label = f"{kind}:{location}:{datastore_id}"
+    with _clients_lock:
+        clients = _clients.get(key)
+        if clients is None:
+            metrics.increment("discovery_client_pool_misses", label)
+            clients = factory()
+            _clients[key] = clients
+        else:
+            metrics.increment("discovery_client_pool_hits", label)
+        return clients
+
 
-    search_client = SearchServiceClient(client_options=client_options)
+def _client_options(location: str) -> ClientOptions:
+    return ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com")
 
-    serving_config = search_client.serving_config_path(
+
+def _serving_config_path(client, project: str, location: str, datastore_id: str) -> str:
+    return client.serving_config_path(
         project=project,
         location=location,
         data_store=datastore_id,
         serving_config="default_config",
     )
 
-    return search_client, serving_config
 
+def _new_search_client(project: str, location: str, datastore_id: str) -> Tuple[SearchServiceClient, str]:
+    search_client = SearchServiceClient(client_options=_client_options(location))
+    return search_client, _serving_config_path(search_client, project, location, datastore_id)
+
+
+def _init_search_client(project: str, location: str, datastore_id: str):
+    """
+    Gibt den geteilten Suchclient und die Serving-Konfiguration zurück.
+
+    Args:
+        project: Google Cloud Projekt-ID.
+        location: Standort des Datenspeichers.
+        datastore_id: ID des Datenspeichers.
 
+    Returns:
+        Ein Tupel aus dem SearchServiceClient und dem Serving-Konfigurationspfad.
+    """
+    return _pooled_clients(
+        "search", project, location, datastore_id,
+        lambda: _new_search_client(project, location, datastore_id),
+    )
+
+
+@functools.lru_cache(maxsize=None)
 def _init_search_behavior(result_count: int) -> SearchRequest:
     """Initialisiert das Suchverhalten.
 
@@ -44,7 +96,8 @@ def _init_search_behavior(result_count: int) -> SearchRequest:
         result_count: Die Anzahl der zurückzugebenden Ergebnisse.
 
     Returns:
-        Eine SearchRequest-Instanz mit der konfigurierten Inhaltsuche.
+        Eine SearchRequest-Instanz mit der konfigurierten Inhaltsuche. Sie wird je result_count
+        nur einmal erzeugt und darf nicht verändert werden.
     """
     summary_spec = SearchRequest.ContentSearchSpec.SummarySpec(
         summary_result_count=result_count,
@@ -128,6 +181,63 @@ def _process_result(search_result: str) -> str:
     return answer
 
 
+def _new_search_client_async(project: str, location: str, datastore_id: str) -> Tuple[SearchServiceAsyncClient, str]:
+    search_client = SearchServiceAsyncClient(client_options=_client_options(location))
+    return search_client, _serving_config_path(search_client, project, location, datastore_id)
+
+
+def _init_search_client_async(project: str, location: str, datastore_id: str):
+    """
+    Gibt den geteilten asynchronen Suchclient und die Serving-Konfiguration zurück.
+
+    Muss im Event-Loop aufgerufen werden, in dem der Client verwendet wird.
+
+    Args:
+        project: Google Cloud Projekt-ID.
+        location: Standort des Datenspeichers.
+        datastore_id: ID des Datenspeichers.
+
+    Returns:
+        Ein Tupel aus dem SearchServiceAsyncClient und dem Serving-Konfigurationspfad.
+    """
+    return _pooled_clients(
+        "search_async", project, location, datastore_id,
+        lambda: _new_search_client_async(project, location, datastore_id),
+        loop=asyncio.get_running_loop(),
+    )
+
+
+async def _search_data_store_async(
+    search_client: SearchServiceAsyncClient,
+    serving_config: str,
+    content_spec: SearchRequest,
+    search_query: str
+) -> pagers.SearchAsyncPager:
+    """Durchsucht den Datenspeicher asynchron nach der angegebenen Suchanfrage.
+
+    Args:
+        search_client: Der SearchServiceAsyncClient.
+        serving_config: Der Pfad zur Serving-Konfiguration.
+        content_spec: Die ContentSearchSpec-Instanz.
+        search_query: Die Suchanfrage.
+
+    Returns:
+        Die Suchergebnisse als Pager.
+    """
+    search_request = SearchRequest(
+        serving_config=serving_config,
+        query=search_query,
+        page_size=5,
+        content_search_spec=content_spec
+    )
+
+    result = await search_client.search(
+        request=search_request
+    )
+
+    return result
+
+
 def search_engine(search_query: str, process_string: bool, project: str, location: str, datastore_id: str):
     search_client, serving_config = _init_search_client(project=project,
                                                     location=location,
@@ -144,8 +254,83 @@ def search_engine(search_query: str, process_string: bool, project: str, locatio
 
     return summary
 
-from typing import List
 
+async def search_engine_async(search_query: str, process_string: bool, project: str, location: str, datastore_id: str):
+    search_client, serving_config = _init_search_client_async(project=project,
+                                                              location=location,
+                                                              datastore_id=datastore_id)
+
+    content_spec = _init_search_behavior(result_count=5)
+
+    result = await _search_data_store_async(search_client=search_client,
+                                            serving_config=serving_config,
+                                            content_spec=content_spec,
+                                            search_query=search_query)
+
+    summary = (_process_result(search_result=result) if process_string else str(result.summary))
+
+    return summary
+
+def _new_conversational_client(client_class, project_id: str, location: str, datastore_id: str) -> Tuple[Any, str, str]:
+    client = client_class(client_options=_client_options(location))
+    data_store_path = client.data_store_path(project=project_id, location=location, data_store=datastore_id)
+    return client, data_store_path, _serving_config_path(client, project_id, location, datastore_id)
+
+
+def _init_conversational_client(project_id: str, location: str, datastore_id: str):
+    """
+    Gibt den geteilten Client für die Multi-Turn-Suche zurück.
+
+    Args:
+        project_id: Google Cloud Projekt-ID.
+        location: Standort des Datenspeichers.
+        datastore_id: ID des Datenspeichers.
+
+    Returns:
+        Ein Tupel aus dem ConversationalSearchServiceClient, dem Pfad des Datenspeichers und dem
+        Serving-Konfigurationspfad.
+    """
+    return _pooled_clients(
+        "conversational", project_id, location, datastore_id,
+        lambda: _new_conversational_client(discoveryengine.ConversationalSearchServiceClient, project_id, location, datastore_id),
+    )
+
+
+def _init_conversational_client_async(project_id: str, location: str, datastore_id: str):
+    """
+    Asynchrone Variante von _init_conversational_client.
+
+    Muss im Event-Loop aufgerufen werden, in dem der Client verwendet wird.
+    """
+    return _pooled_clients(
+        "conversational_async", project_id, location, datastore_id,
+        lambda: _new_conversational_client(discoveryengine.ConversationalSearchServiceAsyncClient, project_id, location, datastore_id),
+        loop=asyncio.get_running_loop(),
+    )
+
+
+# Name der Discovery-Engine-Konversation je Nutzer, Session und Datenspeicher, damit Folgefragen
+# ohne create_conversation in derselben Konversation gestellt werden. Die Session-ID allein gibt
+# keinen Zugriff auf die Konversation eines anderen Nutzers.
+_conversations = ttl_cache.TTLCache(
+    name="discovery_conversations",
+    max_entries=constants.DISCOVERY_CONVERSATIONS_MAX,
+    ttl_seconds=constants.DISCOVERY_CONVERSATION_TTL_SECONDS,
+    max_bytes=constants.DISCOVERY_CONVERSATIONS_MAX_BYTES,
+)
+
+
+def _build_converse_request(conversation_name: str, search_query: str, serving_config: str) -> discoveryengine.ConverseConversationRequest:
+    return discoveryengine.ConverseConversationRequest(
+        name=conversation_name,
+        query=discoveryengine.TextInput(input=search_query),
+        serving_config=serving_config,
+        # Options for the returned summary
+        summary_spec=discoveryengine.SearchRequest.ContentSearchSpec.SummarySpec(
+            summary_result_count=3,
+            include_citations=True,
+        ),
+    )
 
 
 def multi_turn_search(
@@ -153,118 +338,179 @@ def multi_turn_search(
     location: str,
     datastore_id: str,
     search_queries: List[str],
+    session_id: Optional[str] = None,
+    oid_hashed: Optional[str] = None,
 ) -> List[discoveryengine.ConverseConversationResponse]:
+    """
+    Stellt die Suchanfragen nacheinander in einer Konversation.
+
+    Args:
+        session_id: Mit Session-ID und oid_hashed wird die Konversation der Session des Nutzers
+            für DISCOVERY_CONVERSATION_TTL_SECONDS nach der letzten Anfrage weiterverwendet,
+            sonst wird eine neue Konversation angelegt.
+        oid_hashed: Der Nutzer, dem die Session gehört.
+    """
     #  For more information, refer to:
     # https://cloud.google.com/generative-ai-app-builder/docs/locations#specify_a_multi-region_for_your_data_store
-    client_options = (
-        ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com")
-    )
-
-    # Create a client
-    client = discoveryengine.ConversationalSearchServiceClient(
-        client_options=client_options
-    )
-
-    # Initialize Multi-Turn Session
-    conversation = client.create_conversation(
-        parent=client.data_store_path(
-            project=project_id, location=location, data_store=datastore_id
-        ),
-        conversation=discoveryengine.Conversation(),
-    )
+    client, data_store_path, serving_config = _init_conversational_client(project_id, location, datastore_id)
+    key = (oid_hashed, session_id, project_id, location, datastore_id)
+    reuse = bool(session_id and oid_hashed)
+
+    def create_conversation() -> str:
+        # Initialize Multi-Turn Session
+        metrics.increment("discovery_conversations", "created")
+        return client.create_conversation(
+            parent=data_store_path,
+            conversation=discoveryengine.Conversation(),
+        ).name
+
+    conversation_name = _conversations.get(key) if reuse else None
+    reused = conversation_name is not None
+    if not reused:
+        conversation_name = create_conversation()
 
     responses = []
     for search_query in search_queries:
         # Add new message to session
-        request = discoveryengine.ConverseConversationRequest(
-            name=conversation.name,
-            query=discoveryengine.TextInput(input=search_query),
-            serving_config=client.serving_config_path(
-                project=project_id,
-                location=location,
-                data_store=datastore_id,
-                serving_config="default_config",
-            ),
-            # Options for the returned summary
-            summary_spec=discoveryengine.SearchRequest.ContentSearchSpec.SummarySpec(
-                summary_result_count=3,
-                include_citations=True,
-            ),
+        try:
+            response = client.converse_conversation(_build_converse_request(conversation_name, search_query, serving_config))
+        except NotFound:
+            if not reused:
+                raise
+            # Die Konversation wurde vom Dienst gelöscht
+            reused = False
+            conversation_name = create_conversation()
+            response = client.converse_conversation(_build_converse_request(conversation_name, search_query, serving_config))
+        responses.append(response)
+
+    if reuse:
+        if reused:
+            metrics.increment("discovery_conversations", "reused")
+        _conversations.set(key, conversation_name)
+    return responses
+
+
+async def multi_turn_search_async(
+    project_id: str,
+    location: str,
+    datastore_id: str,
+    search_queries: List[str],
+    session_id: Optional[str] = None,
+    oid_hashed: Optional[str] = None,
+) -> List[discoveryengine.ConverseConversationResponse]:
+    """Async variant of multi_turn_search."""
+    client, data_store_path, serving_config = _init_conversational_client_async(project_id, location, datastore_id)
+    key = (oid_hashed, session_id, project_id, location, datastore_id)
+    reuse = bool(session_id and oid_hashed)
+
+    async def create_conversation() -> str:
+        metrics.increment("discovery_conversations", "created")
+        conversation = await client.create_conversation(
+            parent=data_store_path,
+            conversation=discoveryengine.Conversation(),
         )
-        response = client.converse_conversation(request)
+        return conversation.name
+
+    conversation_name = _conversations.get(key) if reuse else None
+    reused = conversation_name is not None
+    if not reused:
+        conversation_name = await create_conversation()
+
+    responses = []
+    for search_query in search_queries:
+        try:
+            response = await client.converse_conversation(_build_converse_request(conversation_name, search_query, serving_config))
+        except NotFound:
+            if not reused:
+                raise
+            # Die Konversation wurde vom Dienst gelöscht
+            reused = False
+            conversation_name = await create_conversation()
+            response = await client.converse_conversation(_build_converse_request(conversation_name, search_query, serving_config))
         responses.append(response)
 
+    if reuse:
+        if reused:
+            metrics.increment("discovery_conversations", "reused")
+        _conversations.set(key, conversation_name)
     return responses
 
 
+class MultiTurnReply(NamedTuple):
+    prompt: str
+    answer: str
+    citations: List[Citation]
+
+
+def _ground_content(document, max_chars: int) -> List[GroundContent]:
+    """
+    Gibt die extraktiven Antworten eines Dokuments zurück, zusammen höchstens max_chars Zeichen.
+
+    Args:
+        document: Das Dokument eines Suchergebnisses.
+        max_chars: Obergrenze für den Inhalt aller extraktiven Antworten des Zitats.
+    """
+    ground_content = []
+    remaining = max_chars
+    for extractive_answer in document.derived_struct_data.get("extractive_answers", []):
+        if remaining <= 0:
+            break
+        content = grounding_renderer.cap_ground_content(extractive_answer.get("content", _MISSING_GROUND_CONTENT), remaining)
+        remaining -= len(content)
+        ground_content.append(GroundContent(page=extractive_answer.get("pageNumber", _MISSING_PAGE_NUMBER), content=content))
+    return ground_content
+
+
+def _citations(reply, max_ground_content_chars: int) -> List[Citation]:
+    """Erzeugt die Zitate einer Antwort in einem Durchlauf über Zitate und Suchergebnisse."""
+    summary = reply.reply.summary.summary_with_metadata
+    reference_indices = sorted({
+        source.reference_index
+        for citation in summary.citation_metadata.citations
+        for source in citation.sources
+    })
+    if not reference_indices:
+        return []
+
+    results_by_id = {search_result.id: search_result for search_result in reply.search_results}
+    references = summary.references
+    citations = []
+    for reference_index in reference_indices:
+        search_result = results_by_id.get(references[reference_index].document.rsplit("/", 1)[-1])
+        if search_result is None:
+            continue
+        struct_data = search_result.document.struct_data
+        citations.append(Citation(
+            id=reference_index + 1,
+            name=struct_data["file_name"],
+            link=struct_data["sharepoint_url"],
+            path=struct_data["path_in_dir"],
+            content=_ground_content(search_result.document, max_ground_content_chars),
+        ))
+    return citations
+
+
+def extract_multiturn_replies(
+    response: List[discoveryengine.ConverseConversationResponse],
+    max_ground_content_chars: int = constants.CITATION_MAX_GROUND_CONTENT_CHARS,
+) -> List[MultiTurnReply]:
+    """
+    Liest Frage, Antwort und Zitate aus den Antworten der Multi-Turn-Suche.
 
+    Die Suchergebnisse werden einmal nach ID indiziert, die Zitate direkt als Citation erzeugt.
 
-def process_multiturn_response(response: List[str]) -> List[Dict]:
-    replies_list = []
-    i = 0
-    for reply in response:
-        answer = reply.reply.summary.summary_text
-        prompt = reply.conversation.messages[i].user_input.input
-        references_list = reply.reply.summary.summary_with_metadata.citation_metadata.citations
-        i = i + 2
-        citations_reference_indices = []
-        for reference in references_list:
-            sources = reference.sources
-
-            for source in sources:
-                citations_reference_indices.append(source.reference_index)
-        # print("CITATION INDICES", citations_reference_indices)
-        citations_reference_indices_uniques = list(set(citations_reference_indices))
-
-        reference_ids = []
-        for citation_index in citations_reference_indices_uniques:
-            reference = reply.reply.summary.summary_with_metadata.references[citation_index]
-            reference_id = (str(reference.document)).split("/")[-1]
-            reference_ids.append({
-                "reference_id": reference_id,
-                "citation_id": citation_index
-            })
-
-        # print("REFERENCE IDs", reference_ids)
-        reference_objects = []
-        for reference in reference_ids:
-            search_results = reply.search_results
-            for search_result in search_results:
-                if reference["reference_id"] == search_result.id:
-
-                    # extractive_answers = search_result.document.derived_struct_data["extractive_answers"]
-                    extractive_answers = search_result.document.derived_struct_data.get("extractive_answers", [])
-                    citation_contents = []
-
-                    for extractive_answer in extractive_answers:
-                        citation_content = {}
-                        if "pageNumber" in extractive_answer:
-                            citation_content["page_number"] = extractive_answer["pageNumber"]
-                        else:
-                            citation_content["page_number"] = 999
-                        if "content" in extractive_answer:
-                            citation_content["ground_content"] = extractive_answer["content"]
-                        else:
-                            citation_content["ground_content"] = "Kein Inhalt erhalten"
-                        citation_contents.append(citation_content)
-
-                    metadata_obj = {
-                        "reference_id": reference["reference_id"],
-                        "citation_id": reference["citation_id"] + 1,
-                        "file_path": search_result.document.struct_data["path_in_dir"],
-                        "file_name": search_result.document.struct_data["file_name"],
-                        "sharepoint_url": search_result.document.struct_data["sharepoint_url"],
-                        "citation_contents": citation_contents,
-                    }
-                    reference_objects.append(metadata_obj)
-
-        replies_list.append({
-            "prompt": prompt,
-            "answer": answer,
-            "references": reference_objects
-        })
-    return replies_list
-
-def create_markdown(answer_with_quotes: Dict):
-    markdown_text = answer_with_quotes["answer"] # + "\n \n"+ "#### Relevante Quellen \n"
-    return markdown_text
+    Args:
+        response: Die Antworten von multi_turn_search.
+        max_ground_content_chars: Obergrenze für den zitierten Inhalt je Zitat, damit große PDFs
+            die Antwort nicht aufblähen.
+    """
+    return [
+        MultiTurnReply(
+            # The conversation of a session also holds the messages of earlier requests, the prompt
+            # of a reply is the user input right before it
+            prompt=reply.conversation.messages[-2].user_input.input,
+            answer=reply.reply.summary.summary_text,
+            citations=_citations(reply, max_ground_content_chars),
+        )
+        for reply in response
+    ]
@@ -69,6 +69,13 @@ SYSTEM_INSTRUCTION_GEMINI_STRATEGIE = [
     """
 ]
 
+# Appended to the system instruction of a provided document when only retrieved passages are sent
+SYSTEM_INSTRUCTION_PROVIDED_DOC_RETRIEVAL = """
+    Der <KONTEXT> enthält nicht das gesamte Dokument, sondern nur die Auszüge, die am besten zur
+    Frage passen. Auszüge sind durch [...] getrennt. Falls die Auszüge die Frage nicht beantworten,
+    sage das, statt Inhalte zu erfinden.
+    """
+
 SYSTEM_INSTRUCTION_TRANSLATION_IMAGEN = [
     "You are a translator that takes input in any language and translates this input to English.",
     "You must not change the content.",
@@ -96,6 +103,166 @@ VERTEXAI_PARAMS = {
 CODE_CHAT_DEFAULT_MODEL_NAME = "codechat-bison-32k@002"
 
 
+########################
+## Provided Documents ##
+########################
+# Documents in local_files are registered under their file name without extension,
+# except for the files listed here which keep their established doc_key
+PROVIDED_DOC_FILE_KEYS = {
+    "fragenkatalogv2.txt": "fragenkatalog",
+    "strategie_final_short.txt": "strategiepapier",
+}
+PROVIDED_DOC_SYSTEM_INSTRUCTIONS = {
+    "fragenkatalog": SYSTEM_INSTRUCTION_GEMINI_KATALOG,
+    "strategiepapier": SYSTEM_INSTRUCTION_GEMINI_STRATEGIE,
+}
+PROVIDED_DOC_EXTENSIONS = (".txt", ".md")
+PROVIDED_DOC_INSTRUCTION_SUFFIX = ".instruction" # e.g. richtlinie.instruction next to richtlinie.txt
+PROVIDED_DOC_RESCAN_SECONDS = 5 # Minimum interval between two checks of local_files for changes
+CHARS_PER_TOKEN_ESTIMATE = 4 # Rough average for Gemini on German text
+# Documents above PROVIDED_DOC_RETRIEVAL_MIN_TOKENS are indexed when they are loaded, and only the
+# passages matching the question are sent instead of the whole document, see retrieval_index.
+# Documents large enough for a context cache (CONTEXT_CACHE_MIN_TOKENS) are always indexed, their
+# cache is only used for questions no passage matches, which then get the whole document.
+PROVIDED_DOC_RETRIEVAL_ENABLED = True
+PROVIDED_DOC_RETRIEVAL_MIN_TOKENS = 4000
+PROVIDED_DOC_RETRIEVAL_TOP_K = 8
+PROVIDED_DOC_RETRIEVAL_MAX_CHARS = 12000 # ~3000 tokens of passages per question
+PROVIDED_DOC_PASSAGE_CHARS = 1200
+PROVIDED_DOC_PASSAGE_OVERLAP_CHARS = 200 # Trailing lines of a passage repeated at the start of the next one
+PROVIDED_DOC_BM25_K1 = 1.2
+PROVIDED_DOC_BM25_B = 0.75
+# Documents whose best matching passages are sent along, e.g. the catalog answers to the strategy paper
+PROVIDED_DOC_RETRIEVAL_COMPANIONS = {
+    "strategiepapier": "fragenkatalog",
+}
+PROVIDED_DOC_RETRIEVAL_COMPANION_TOP_K = 2
+
+
+###################
+## Context Cache ##
+###################
+CONTEXT_CACHE_MIN_TOKENS = 32768 # Smaller contents are rejected by the caching API and are always inlined
+CONTEXT_CACHE_TTL_SECONDS = 3600
+CONTEXT_CACHE_RENEW_MARGIN_SECONDS = 600 # Caches used within this margin before expiry get a new TTL
+CONTEXT_CACHE_RETRY_SECONDS = 300 # Back-off after a failed create, the document is inlined meanwhile
+
+
+#######################
+## In-process Caches ##
+#######################
+# Sum of the *_MAX_BYTES caps of the TTL caches below. The container has 1024Mi (infrastructure/main.tf),
+# the rest is left to the interpreter, the provided documents and up to 250 concurrent requests.
+CACHE_MEMORY_BUDGET_BYTES = 256 * 1024 * 1024
+
+
+###################
+## Session Store ##
+###################
+SESSION_STORE_TTL_SECONDS = 4 * 3600 # Counted from the last turn of the session
+SESSION_STORE_MAX_SESSIONS = 10000
+SESSION_STORE_MAX_BYTES = 64 * 1024 * 1024
+SESSION_STORE_PREFIX = "sessions" # Objects in SESSION_STORE_BUCKET, see session_store.GcsSessionBackend
+SESSION_STORE_SAVE_ATTEMPTS = 3 # Conditional writes of a history before giving up on concurrent writes of other instances
+
+
+CITATION_MAX_GROUND_CONTENT_CHARS = 3000 # Extractive answers quoted per citation, longer ones are cut at a word boundary
+
+
+#################
+## Query Cache ##
+#################
+QUERY_CACHE_TTL_SECONDS = 6 * 3600
+QUERY_CACHE_MAX_ENTRIES = 5000
+QUERY_CACHE_MAX_BYTES = 24 * 1024 * 1024
+QUERY_CACHE_GENERATION_CHECK_SECONDS = 30
+# Rewritten by the ingestion function (infrastructure/files/main.py) after every import into the data store
+QUERY_CACHE_GENERATION_MARKER = "metadata/datastore_generation.json"
+
+
+#####################################
+## Discovery Engine Conversations ##
+#####################################
+DISCOVERY_CONVERSATION_TTL_SECONDS = 3600 # Counted from the last turn, later turns start a new conversation
+DISCOVERY_CONVERSATIONS_MAX = 10000
+DISCOVERY_CONVERSATIONS_MAX_BYTES = 4 * 1024 * 1024
+
+
+####################
+## Document Store ##
+####################
+DOCUMENT_STORE_TTL_SECONDS = 4 * 3600 # Counted from the upload of the document
+DOCUMENT_STORE_MAX_DOCUMENTS = 1000
+DOCUMENT_STORE_MAX_BYTES = 96 * 1024 * 1024 # Memory of original and anonymized text, the bucket keeps the rest
+DOCUMENT_STORE_PREFIX = "documents" # Objects in DOCUMENT_STORE_BUCKET, see document_store.GcsDocumentBackend
+
+
+########################
+## History Compaction ##
+########################
+# Token budget of the chat history sent per request, by model name. Older turns are folded into a summary.
+HISTORY_TOKEN_BUDGETS = {
+    "gemini-1.5-pro-002": 16000,
+    "codechat-bison-32k@002": 8000,
+}
+HISTORY_DEFAULT_TOKEN_BUDGET = 8000
+HISTORY_VERBATIM_TURNS = 4 # Latest turns that are always sent unchanged
+HISTORY_SUMMARY_MODEL_NAME = "gemini-1.5-flash-002"
+HISTORY_SUMMARY_MAX_OUTPUT_TOKENS = 1024
+HISTORY_SUMMARY_TTL_SECONDS = 4 * 3600
+HISTORY_SUMMARY_MAX_SESSIONS = 10000
+HISTORY_SUMMARY_MAX_BYTES = 16 * 1024 * 1024
+HISTORY_SUMMARY_QUESTION = "Fasse unser bisheriges Gespräch zusammen."
+SYSTEM_INSTRUCTION_HISTORY_SUMMARY = [
+    "Du fasst Gesprächsverläufe zwischen einem Nutzer und einem Assistenten zusammen.",
+    "Behalte alle Fakten, Namen, Zahlen, Entscheidungen und offenen Fragen bei, die für den weiteren Verlauf wichtig sein können.",
+    "Antworte nur mit der Zusammenfassung, ohne Einleitung.",
+]
+
+
+#########################
+## Write-behind Logging ##
+#########################
+LOG_QUEUE_MAX_SIZE = 10000 # Records beyond this are dropped instead of growing the memory without bounds
+LOG_BATCH_SIZE = 100
+LOG_HISTORY_UPLOAD_WORKERS = 8 # Concurrent uploads of the history records of one batch
+LOG_FLUSH_INTERVAL_SECONDS = 1.0 # Maximum time a record waits for its batch to fill up
+LOG_WRITE_MAX_ATTEMPTS = 5
+LOG_RETRY_INITIAL_BACKOFF_SECONDS = 0.5
+LOG_RETRY_MAX_BACKOFF_SECONDS = 8
+LOG_SHUTDOWN_TIMEOUT_SECONDS = 8 # Cloud Run kills the container 10s after SIGTERM
+
+
+#########################
+## Conversation Logging ##
+#########################
+HISTORY_TURN_DIGITS = 4 # Zero padded turn number in the object name, keeps the objects of a session in order
+HISTORY_CONTEXT_PREFIX = "contexts" # Content-addressed area of the logging bucket, one object per distinct context
+HISTORY_STORED_CONTEXTS_MAX = 10000 # Context hashes known to be stored, skips the existence check
+
+
+#################
+## SQL Logging ##
+#################
+SQL_POOL_SIZE = 5 # Usage rows are written in batches by the log writer, few connections suffice
+SQL_MAX_OVERFLOW = 5
+SQL_POOL_TIMEOUT_SECONDS = 10
+SQL_POOL_RECYCLE_SECONDS = 1800 # Reconnect before Cloud SQL or the VPC drop idle connections
+
+
+####################
+## Region Routing ##
+####################
+# EU only, here: Frankfurt, Netherlands, Belgium, Paris
+AVAILABLE_REGIONS = ["europe-west3", "europe-west4", "europe-west1", "europe-west9"]
+REGION_EWMA_ALPHA = 0.2 # Weight of the latest observation in the latency and error rate averages
+REGION_INITIAL_LATENCY_SECONDS = 2.0
+REGION_QUOTA_WINDOW_SECONDS = 60 # Vertex AI quotas are per minute
+REGION_BREAKER_QUOTA_ERRORS = 1 # Number of quota errors within the window that open the circuit breaker
+REGION_BREAKER_COOLDOWN_SECONDS = 10
+REGION_BREAKER_MAX_COOLDOWN_SECONDS = 60
+
+
 #################
 ## DLP Related ##
 #################
@@ -104,6 +271,24 @@ DEFAULT_MIN_LIKELIHOOD = "LIKELY"
 DEFAULT_MIN_LIKELIHOOD_DOCUMENT = "VERY_LIKELY"
 DEFAULT_MAX_FINDINGS = 0  # no limit
 MAX_PROMPT_SIZE_DLP = 400000 # Error message is triggered when content size exceeds 524288
+DLP_CACHE_CHUNK_MIN_SIZE = 4000 # Chunks of the DLP anonymization cache, see dlp_api._content_defined_chunks
+DLP_CACHE_CHUNK_MAX_SIZE = 16000
+DLP_CACHE_CHUNK_BOUNDARY_DIVISOR = 16 # On average every 16th line ends a chunk once it has its minimum size
+DLP_CACHE_TTL_SECONDS = 3600
+DLP_CACHE_MAX_ENTRIES = 50000
+DLP_CACHE_MAX_BYTES = 16 * 1024 * 1024
+DLP_SECTION_MAX_SIZE = 100000 # Characters per DLP request when anonymizing, well below the byte limit even for multi-byte text
+DLP_SECTION_OVERLAP = 200 # Characters of the neighbouring chunks sent along, so findings across section boundaries are complete
+DLP_MAX_PARALLEL_REQUESTS = 4
+DLP_BATCH_WINDOW_SECONDS = 0.005 # Prompts of concurrent requests arriving within this window share one DLP request
+DLP_BATCH_MAX_SIZE = 50 # Rows per batched DLP request
+DLP_BATCH_MAX_BYTES = 300000 # Request size limit of DLP is 0.5 MB
+DLP_BATCH_MAX_PROMPT_SIZE = 20000 # Longer prompts are inspected on their own
+PII_PRESCREEN_ENABLED = True # Prompts with local findings are rejected without waiting on DLP, see pii_prescreen
+PII_PRESCREEN_VERIFY_SAMPLE_RATE = 0.05 # Share of those prompts still inspected by DLP in the background to measure agreement
+PSEUDONYM_SESSIONS_MAX = 10000 # Sessions whose pseudonym mapping is kept, see dlp_api._session_mapping
+PSEUDONYM_SESSION_TTL_SECONDS = 4 * 3600 # Counted from the last pseudonymized turn of the session
+PSEUDONYM_SESSIONS_MAX_BYTES = 8 * 1024 * 1024
 DLP_INFO_ANONYMIZED = "Personenbezug wurde im Dokument automatisch anonymisiert."
 DLP_TRUNCATED_FINDINGS = "Das Dokument beinhaltet zu viele sensible Daten und kann daher nicht verarbeitet werden."
 
@@ -141,6 +326,10 @@ Die Ursache dafür kann ein Richtlinienverstoß, wie z. B. Personenbezug oder da
 Bitte versuche eine andere Formulierung.
 """
 
+DOCUMENT_NOT_FOUND_ERROR = """
+Das Dokument ist nicht mehr verfügbar, hochgeladene Dokumente werden nach einigen Stunden gelöscht. Bitte lade das Dokument erneut hoch.
+"""
+
 QUOTA_EXCEEDED_ERROR = """
 Das globale Limit für die maximale Anzahl an Anfragen an das Large Language Model wurde temporär überschritten. Bitte versuche es in einer Minute nochmal.
 """
@@ -0,0 +1,277 @@
+"""Gemini context caches for the large static provided documents.
+
+Instead of sending the whole document as <KONTEXT> turn with every question, the document turn,
+the placeholder answer and the system instruction are stored once per (doc_key, model, region)
+as cached content. Requests then only send the chat history and the question to a model bound
+to the cache.
+
+The lifecycle per key is:
+
+    - created on first use, if the document is large enough to be cached at all,
+    - renewed (TTL extended) when used within CONTEXT_CACHE_RENEW_MARGIN_SECONDS before expiry,
+    - recreated when it has expired, was deleted on the server or the document changed,
+    - after a failed create, not retried for CONTEXT_CACHE_RETRY_SECONDS.
+
+Whenever no cache is available the caller inlines the document as before. The cache service
+is behind a small backend interface, LocalCacheBackend stands in for it in offline tests.
+
+Provided documents of this size are also indexed for retrieval (PROVIDED_DOC_RETRIEVAL_MIN_TOKENS),
+so a cache is only used for the questions that get the whole document because no passage
+matched, see main._load_provided_doc.
+"""
+import asyncio
+import datetime
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Tuple
+
+from google.cloud.aiplatform_v1beta1.types.cached_content import CachedContent as GapicCachedContent
+from google.cloud.aiplatform_v1beta1.types.gen_ai_cache_service import UpdateCachedContentRequest
+from google.protobuf import field_mask_pb2
+from vertexai.caching import _caching
+from vertexai.generative_models import GenerativeModel
+from vertexai.preview import caching
+
+from . import constants, metrics, model_registry
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheHandle:
+    name: str
+    expire_time: float
+    model: Any
+
+
+class VertexCacheBackend:
+    """Creates the caches with the Vertex AI context caching API.
+
+    The cache service is called through a client per region, so the create, renew and delete
+    RPCs do not depend on the global SDK state and run outside the model registry lock. Only
+    building the request and the models, which read that state, runs in
+    model_registry.in_region.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, Any] = {}
+
+    def _client(self, project_id: str, location: str) -> Any:
+        client = self._clients.get(location)
+        if client is None:
+            client = self._clients[location] = model_registry.in_region(
+                project_id, location, lambda: caching.CachedContent._instantiate_client(location=location)
+            )
+        return client
+
+    def create(
+        self,
+        project_id: str,
+        location: str,
+        model_name: str,
+        system_instruction: list,
+        contents: list,
+        ttl_seconds: int,
+        display_name: str,
+    ) -> CacheHandle:
+        request = model_registry.in_region(
+            project_id,
+            location,
+            lambda: _caching._prepare_create_request(
+                f"projects/{project_id}/locations/{location}/publishers/google/models/{model_name}",
+                system_instruction=system_instruction,
+                contents=contents,
+                ttl=datetime.timedelta(seconds=ttl_seconds),
+                display_name=display_name,
+            ),
+        )
+        resource = self._client(project_id, location).create_cached_content(request)
+
+        def _bind() -> Any:
+            cached_content = caching.CachedContent._construct_sdk_resource_from_gapic(
+                resource, project=project_id, location=location
+            )
+            return GenerativeModel.from_cached_content(cached_content=cached_content)
+
+        model = model_registry.in_region(project_id, location, _bind)
+        return CacheHandle(resource.name, resource.expire_time.timestamp(), model)
+
+    def renew(self, project_id: str, location: str, handle: CacheHandle, ttl_seconds: int) -> float:
+        resource = self._client(project_id, location).update_cached_content(
+            UpdateCachedContentRequest(
+                cached_content=GapicCachedContent(name=handle.name, ttl=datetime.timedelta(seconds=ttl_seconds)),
+                update_mask=field_mask_pb2.FieldMask(paths=["ttl"]),
+            )
+        )
+        return resource.expire_time.timestamp()
+
+    def delete(self, project_id: str, location: str, handle: CacheHandle) -> None:
+        self._client(project_id, location).delete_cached_content(name=handle.name)
+
+
+class LocalCacheBackend:
+    """In-memory stand-in for the cache service with the same lifecycle semantics.
+
+    Args:
+        clock: Time source in seconds, shared with the ContextCacheManager under test.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self.caches: Dict[str, float] = {}
+        self.calls: List[Tuple[str, str]] = []
+        self.fail_create = False
+        self._ids = itertools.count(1)
+
+    def create(self, project_id, location, model_name, system_instruction, contents, ttl_seconds, display_name) -> CacheHandle:
+        if self.fail_create:
+            raise RuntimeError("create failed")
+        name = f"projects/{project_id}/locations/{location}/cachedContents/{next(self._ids)}"
+        self.caches[name] = self.clock() + ttl_seconds
+        self.calls.append(("create", name))
+        return CacheHandle(name, self.caches[name], model=name)
+
+    def renew(self, project_id, location, handle: CacheHandle, ttl_seconds: int) -> float:
+        if self.caches.get(handle.name, 0) <= self.clock():
+            raise KeyError(f"{handle.name} not found")
+        self.caches[handle.name] = self.clock() + ttl_seconds
+        self.calls.append(("renew", handle.name))
+        return self.caches[handle.name]
+
+    def delete(self, project_id, location, handle: CacheHandle) -> None:
+        self.caches.pop(handle.name, None)
+        self.calls.append(("delete", handle.name))
+
+    def expire(self, name: str) -> None:
+        """Simulates a cache that was deleted or expired on the server."""
+        self.caches.pop(name, None)
+
+
+@dataclass
+class _Entry:
+    version: str
+    handle: CacheHandle | None = None
+    retry_after: float = 0.0
+
+
+class ContextCacheManager:
+    """Keeps one context cache per (doc_key, model, region) alive while it is used.
+
+    Args:
+        backend: The cache service, VertexCacheBackend or LocalCacheBackend.
+        clock: Time source in seconds, comparable to the expire times of the backend.
+    """
+
+    def __init__(self, backend, clock: Callable[[], float] = time.time):
+        self.backend = backend
+        self.clock = clock
+        self._entries: Dict[Tuple[str, str, str], _Entry] = {}
+        self._locks: Dict[Tuple[str, str, str], asyncio.Lock] = {}
+
+    async def get_model(
+        self,
+        doc_key: str,
+        version: str,
+        contents: list,
+        num_tokens: int,
+        system_instruction: list,
+        project_id: str,
+        location: str,
+        model_name: str,
+    ) -> Any:
+        """Returns the model bound to the cache of the document, or None if the document has to be inlined.
+
+        Args:
+            doc_key: Key of the provided document.
+            version: Changes whenever the document content changes, the cache is recreated then.
+            contents: The turns to cache, i.e. the <KONTEXT> turn and the placeholder answer.
+            num_tokens: Estimated number of tokens of the contents.
+        """
+        if num_tokens < constants.CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        key = (doc_key, model_name, location)
+        label = ":".join(key)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            now = self.clock()
+            entry = self._entries.get(key)
+            if entry is not None and entry.version != version:
+                await self._delete(project_id, location, entry)
+                entry = None
+            if entry is None:
+                entry = self._entries[key] = _Entry(version)
+
+            handle = entry.handle
+            if handle is not None and handle.expire_time - now > constants.CONTEXT_CACHE_RENEW_MARGIN_SECONDS:
+                metrics.increment("context_cache_hits", label)
+                return handle.model
+
+            if handle is not None and handle.expire_time > now:
+                try:
+                    handle.expire_time = await asyncio.to_thread(
+                        self.backend.renew, project_id, location, handle, constants.CONTEXT_CACHE_TTL_SECONDS
+                    )
+                    metrics.increment("context_cache_renewals", label)
+                    return handle.model
+                except Exception as ex:
+                    logger.warning("Could not renew context cache %s: %s", handle.name, ex)
+                    entry.handle = None
+
+            if now < entry.retry_after:
+                metrics.increment("context_cache_misses", label)
+                return None
+            try:
+                entry.handle = await asyncio.to_thread(
+                    self.backend.create,
+                    project_id,
+                    location,
+                    model_name,
+                    system_instruction,
+                    contents,
+                    constants.CONTEXT_CACHE_TTL_SECONDS,
+                    f"provided-doc-{doc_key}",
+                )
+            except Exception as ex:
+                logger.warning("Could not create context cache for %s, inlining the document: %s", label, ex)
+                metrics.increment("context_cache_errors", label)
+                entry.retry_after = now + constants.CONTEXT_CACHE_RETRY_SECONDS
+                return None
+            logger.info("Created context cache %s for %s", entry.handle.name, label)
+            metrics.increment("context_cache_creates", label)
+            return entry.handle.model
+
+    async def invalidate(self, doc_key: str, project_id: str, location: str, model_name: str) -> None:
+        """Drops the cache of a key, e.g. after the service reported it as missing."""
+        entry = self._entries.get((doc_key, model_name, location))
+        if entry is not None and entry.handle is not None:
+            await self._delete(project_id, location, entry)
+
+    async def _delete(self, project_id: str, location: str, entry: _Entry) -> None:
+        if entry.handle is None:
+            return
+        handle, entry.handle = entry.handle, None
+        try:
+            await asyncio.to_thread(self.backend.delete, project_id, location, handle)
+        except Exception as ex:
+            # The cache expires on its own anyway
+            logger.warning("Could not delete context cache %s: %s", handle.name, ex)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        now = self.clock()
+        return {
+            ":".join(key): {
+                "version": entry.version,
+                "cache": entry.handle.name if entry.handle else None,
+                "expires_in_seconds": round(entry.handle.expire_time - now) if entry.handle else None,
+            }
+            for key, entry in self._entries.items()
+        }
+
+
+_manager = ContextCacheManager(VertexCacheBackend())
+
+
+def get_manager() -> ContextCacheManager:
+    return _manager
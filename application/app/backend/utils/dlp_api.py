@@ -1,22 +1,47 @@
+import asyncio
+import bisect
+import hashlib
 import logging
+import random
+import re
+import threading
+import zlib
 from collections.abc import Sequence
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple
 
-from google.cloud.dlp_v2 import DlpServiceClient, InspectContentRequest, Finding
+from google.cloud.dlp_v2 import DlpServiceClient, DlpServiceAsyncClient, InspectContentRequest, InspectContentResponse, InspectResult, Finding
 from google.cloud.dlp_v2.types import Finding
 from faker import Faker
+from faker.providers.person.de_DE import Provider as GermanPersonProvider
 import gender_guesser.detector as gender_detector
 
-from . import constants
-from backend.schemas.schemas import BackendError
+from . import constants, metrics, pii_prescreen, ttl_cache
+from .pseudonymizer import PatternReplacer, PseudonymMapping, StreamingRestorer
+from backend.schemas.schemas import BackendError, Conversation
 
 logger = logging.getLogger(__name__)
 client = DlpServiceClient()
 fake = Faker("de_DE")
 detector = gender_detector.Detector()
+_last_names = frozenset(GermanPersonProvider.last_names)
+_prescreen = pii_prescreen.PiiPrescreen(
+    is_first_name=lambda name: detector.get_gender(name) != "unknown",
+    is_last_name=_last_names.__contains__,
+)
+# The async client binds its gRPC channel to the running event loop, so it is created lazily on first use
+_async_client: DlpServiceAsyncClient | None = None
 
-def _call_dlp_api(prompt: str, project_id: str):
-    request = InspectContentRequest(
+
+def _get_async_client() -> DlpServiceAsyncClient:
+    global _async_client
+    if _async_client is None:
+        _async_client = DlpServiceAsyncClient()
+    return _async_client
+
+
+def _build_inspect_request(prompt: str, project_id: str, item: dict | None = None) -> InspectContentRequest:
+    return InspectContentRequest(
         inspect_config={
             "info_types": [{"name": info_type} for info_type in constants.DEFAULT_INFO_TYPES],
             "min_likelihood": constants.DEFAULT_MIN_LIKELIHOOD,
@@ -24,99 +49,487 @@ def _call_dlp_api(prompt: str, project_id: str):
             "limits": {"max_findings_per_request": constants.DEFAULT_MAX_FINDINGS},
         },
         parent=f"projects/{project_id}/locations/europe-west3",
-        item={"value": prompt},
+        item=item or {"value": prompt},
     )
 
+
+def _call_dlp_api(prompt: str, project_id: str):
+    request = _build_inspect_request(prompt, project_id)
+
     response = client.inspect_content(
         request=request,
     )
+    metrics.increment("dlp_requests", "inspect_content")
     logger.info(response)
     return response
 
 
-def _split_prompt(prompt: str, max_len: int = constants.MAX_PROMPT_SIZE_DLP):
-    """Splits a string into sections with a maximum length.
+async def _call_dlp_api_async(prompt: str, project_id: str):
+    request = _build_inspect_request(prompt, project_id)
 
-    Args:
-        prompt (str): The string to be split.
-        max_len (int): The maximum length of the sections.
+    response = await _get_async_client().inspect_content(
+        request=request,
+    )
+    metrics.increment("dlp_requests", "inspect_content")
+    logger.info(response)
+    return response
 
-    Returns:
-        A list of the sections.
+
+class _InspectBatcher:
+    """Collects the prompts of concurrent requests into one table-structured DLP request.
+
+    The first prompt opens a batching window of DLP_BATCH_WINDOW_SECONDS. All prompts arriving
+    within the window are sent as rows of one table (at most DLP_BATCH_MAX_SIZE rows and
+    DLP_BATCH_MAX_BYTES), and the findings are routed back to the callers by row index.
+    Every caller gets a response of its own with the findings of its row, the codepoint ranges
+    of table findings are relative to the cell, i.e. to the prompt. If DLP truncates the findings
+    of the table, the rows are inspected one by one instead.
     """
-    return [prompt[i:i + max_len] for i in range(0, len(prompt), max_len)]
 
+    def __init__(self):
+        self._pending: dict[str, list] = {}
+        self._pending_bytes: dict[str, int] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        # Keeps the send tasks referenced until they are done
+        self._tasks: set = set()
+
+    async def inspect(self, prompt: str, project_id: str):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(project_id, []).append((prompt, future))
+        self._pending_bytes[project_id] = self._pending_bytes.get(project_id, 0) + len(prompt.encode())
+
+        if (len(self._pending[project_id]) >= constants.DLP_BATCH_MAX_SIZE
+                or self._pending_bytes[project_id] >= constants.DLP_BATCH_MAX_BYTES):
+            self._flush(project_id)
+        elif project_id not in self._timers:
+            self._timers[project_id] = asyncio.get_running_loop().call_later(
+                constants.DLP_BATCH_WINDOW_SECONDS, self._flush, project_id
+            )
+        return await future
+
+    def _flush(self, project_id: str) -> None:
+        timer = self._timers.pop(project_id, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(project_id, [])
+        self._pending_bytes.pop(project_id, None)
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._send(batch, project_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list, project_id: str) -> None:
+        prompts = [prompt for prompt, _ in batch]
+        futures = [future for _, future in batch]
+        metrics.increment("dlp_batched_prompts", "inspect_content", len(batch))
+        try:
+            if len(batch) == 1:
+                responses = [await _call_dlp_api_async(prompts[0], project_id)]
+            else:
+                responses = await _call_dlp_api_table_async(prompts, project_id)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, response in zip(futures, responses):
+            if not future.done():
+                future.set_result(response)
+
+
+async def _call_dlp_api_table_async(prompts: List[str], project_id: str) -> List[InspectContentResponse]:
+    """Inspects the prompts as rows of one table and splits the findings into one response per prompt."""
+    item = {
+        "table": {
+            "headers": [{"name": "prompt"}],
+            "rows": [{"values": [{"string_value": prompt}]} for prompt in prompts],
+        }
+    }
+    request = _build_inspect_request("", project_id, item=item)
+    response = await _get_async_client().inspect_content(request=request)
+    metrics.increment("dlp_requests", "inspect_content")
+    logger.info(response)
 
-def _anonymize_text_section(text: str, findings: List[Finding]) -> str:
-    """Anonymizes a text section based on the results of the DLP API.
+    if response.result.findings_truncated:
+        # The findings of some rows are missing, a row without findings is not known to be clean
+        metrics.increment("dlp_batch_truncated", "inspect_content")
+        return list(await asyncio.gather(*(_call_dlp_api_async(prompt, project_id) for prompt in prompts)))
+
+    findings_per_row = [[] for _ in prompts]
+    for finding in response.result.findings:
+        row_index = finding.location.content_locations[0].record_location.table_location.row_index
+        findings_per_row[row_index].append(finding)
+    return [InspectContentResponse(result=InspectResult(findings=findings)) for findings in findings_per_row]
+
+
+_batcher = _InspectBatcher()
+
+
+async def _call_dlp_api_batched(prompt: str, project_id: str):
+    """Like _call_dlp_api_async, but batched with the prompts of concurrent requests."""
+    if len(prompt) > constants.DLP_BATCH_MAX_PROMPT_SIZE:
+        return await _call_dlp_api_async(prompt, project_id)
+    return await _batcher.inspect(prompt, project_id)
+
+
+def _prescreen_prompt(prompt: str, reject: bool) -> tuple[List[pii_prescreen.LocalFinding], bool]:
+    """Runs the local pre-screen on the prompt.
 
     Args:
-        text (str): The text to be anonymized.
-        findings (List[Finding]): A list of "Finding" objects, containing information about sensitive data locations within the text.
+        reject: Whether the caller rejects prompts with findings. Only then DLP can be skipped,
+            pseudonymization needs the complete findings of DLP.
 
     Returns:
-        str: The anonymized text with sensitive information replaced by asterisks.
+        The local findings and whether they suffice, i.e. DLP is not called.
+    """
+    if not constants.PII_PRESCREEN_ENABLED:
+        return [], False
+    local_findings = _prescreen.findings(prompt)
+    short_circuit = reject and bool(local_findings)
+    metrics.increment("pii_prescreen", "short_circuit" if short_circuit else "dlp")
+    return local_findings, short_circuit
+
+
+def _short_circuit_rate() -> float:
+    short_circuits = metrics.get_counter("pii_prescreen", "short_circuit")
+    total = short_circuits + metrics.get_counter("pii_prescreen", "dlp")
+    return short_circuits / total if total else 0.0
+
+
+metrics.register_gauge("pii_prescreen_short_circuit_rate", _short_circuit_rate)
+
+
+def _record_agreement(local_findings: Sequence[pii_prescreen.LocalFinding], response) -> None:
+    """Counts whether the pre-screen and DLP agree on the prompt containing personal data."""
+    local, remote = bool(local_findings), bool(response.result.findings)
+    if local == remote:
+        label = "both" if local else "neither"
+    else:
+        label = "local_only" if local else "dlp_only"
+    metrics.increment("pii_prescreen_agreement", label)
+
+
+# Keeps the background verifications referenced until they are done
+_verification_tasks: set = set()
+
+
+def _verify_short_circuit(prompt: str, project_id: str, local_findings: Sequence[pii_prescreen.LocalFinding]) -> None:
+    """Inspects a sample of the short-circuited prompts with DLP in the background.
+
+    Without it, the agreement metrics would only cover prompts without local findings and
+    could not show false positives of the pre-screen.
     """
-    out_text = text
-    for finding in findings:
-        start = finding.location.codepoint_range.start
-        end = finding.location.codepoint_range.end
-        out_text = out_text[:start] + "*" * (end - start) + out_text[end:]
-    return out_text
-
-def pseudonymize_text(prompt: str, project_id: str) -> tuple[str, dict, BackendError]:
+    if random.random() >= constants.PII_PRESCREEN_VERIFY_SAMPLE_RATE:
+        return
+
+    async def _verify():
+        try:
+            _record_agreement(local_findings, await _call_dlp_api_batched(prompt, project_id))
+        except Exception as e:
+            logger.warning("Verification of the PII pre-screen failed: %s", e)
+
+    task = asyncio.get_running_loop().create_task(_verify())
+    _verification_tasks.add(task)
+    task.add_done_callback(_verification_tasks.discard)
+
+
+def _pseudonym_for(original: str, info_type: str) -> str:
+    match info_type:
+        case "FIRST_NAME":
+            gender = detector.get_gender(original)
+            if gender in ["female", "mostly_female"]:
+                replacement = fake.first_name_female()
+            elif gender in ["male", "mostly_male"]:
+                replacement = fake.first_name_male()
+            else:
+                replacement = fake.first_name_nonbinary()
+        case "LAST_NAME":
+            replacement = fake.last_name()
+        case "STREET_ADDRESS":
+            replacement = fake.address().replace("\n",", ")
+        case "PHONE_NUMBER":
+            replacement = fake.phone_number()
+    return replacement
+
+
+# Pseudonym mappings per (oid_hashed, session_id), so a value keeps its pseudonym in all turns of
+# the session. The mappings hold real values, a session_id alone does not give access to them.
+_session_mappings = ttl_cache.TTLCache(
+    name="pseudonym_mappings",
+    max_entries=constants.PSEUDONYM_SESSIONS_MAX,
+    ttl_seconds=constants.PSEUDONYM_SESSION_TTL_SECONDS,
+    max_bytes=constants.PSEUDONYM_SESSIONS_MAX_BYTES,
+    sizeof=lambda mapping: mapping.size_bytes(),
+)
+# Makes the get-or-create of a session mapping atomic, concurrent first turns share one mapping
+_session_mappings_lock = threading.Lock()
+
+
+def _session_mapping(session_key: tuple[str, str] | None) -> PseudonymMapping:
+    if session_key is None:
+        return PseudonymMapping(_pseudonym_for)
+    with _session_mappings_lock:
+        mapping = _session_mappings.get(session_key)
+        if mapping is None:
+            mapping = PseudonymMapping(_pseudonym_for)
+            _session_mappings.set(session_key, mapping)
+    return mapping
+
+
+def _pseudonymize_findings(
+    prompt: str,
+    findings: Sequence[Finding],
+    session_key: tuple[str, str] | None = None,
+    local_findings: Sequence[pii_prescreen.LocalFinding] = (),
+) -> tuple[str, dict]:
+    mapping = _session_mapping(session_key)
+    mapping.add((finding.quote, finding.info_type.name) for finding in findings)
+    # Values of the pre-screen DLP rated below the minimum likelihood are pseudonymized as well
+    mapping.add((finding.quote, finding.info_type) for finding in local_findings)
+    prompt, _ = mapping.pseudonymize(prompt)
+    if session_key is not None:
+        # Set again after every turn, which also renews the TTL and the size of the entry
+        _session_mappings.set(session_key, mapping)
+    return prompt, mapping.replacement_mapping()
+
+
+def _pseudonymization_error(e: Exception) -> BackendError:
+    logger.info(f"Error occurred during pseudonymization process: {e}")
+    return BackendError(
+        status = "500",
+        msg = "Fehler bei der Pseudonymisierung der Daten.",
+        code = "DLP_ERROR"
+    )
+
+
+def pseudonymize_text(prompt: str, project_id: str, session_key: tuple[str, str] | None = None) -> tuple[str, dict, BackendError]:
     """Pseudonymizes the given text and returns the pseudomized text and the mapping of original and pseudonymized values.
 
     This method pseudonymizes the provided text using the Google Cloud DLP API and the Faker library.
+    All findings are replaced in a single pass over the text.
 
     Args:
         prompt: The text to be pseudonymized.
         project_id: The project ID of the Google Cloud project.
+        session_key: (oid_hashed, session_id) of the session, values keep their pseudonym in all
+            turns of the session. If None, the pseudonyms are drawn for this text only.
 
     Returns:
         A tuple containing:
             - The pseudonymized text.
-            - A dictionnary with pseudonymization mapping.
+            - A dictionnary mapping each pseudonym to [original value, info type], including
+              the values of earlier turns of the session.
             - A BackendError object if an error occurred, otherwise None.
     """
     try:
-        replacement_mapping = {}
+        local_findings, _ = _prescreen_prompt(prompt, reject=False)
         response = _call_dlp_api(prompt, project_id)
-        for finding in response.result.findings:
-            match finding.info_type.name:
-                case "FIRST_NAME":
-                    gender = detector.get_gender(finding.quote)
-                    if gender in ["female", "mostly_female"]:
-                        replacement = fake.first_name_female()
-                    elif gender in ["male", "mostly_male"]:
-                        replacement = fake.first_name_male()
-                    else:
-                        replacement = fake.first_name_nonbinary()
-                case "LAST_NAME":
-                    replacement = fake.last_name()
-                case "STREET_ADDRESS":
-                    replacement = fake.address().replace("\n",", ")
-                case "PHONE_NUMBER":
-                    replacement = fake.phone_number()
-            prompt = prompt.replace(finding.quote, replacement)
-            #replacement_mapping[replacement] = [finding.quote, finding.info_type.name]
-            replacement_mapping[finding.info_type.name] = finding.quote + " -> " + replacement
+        _record_agreement(local_findings, response)
+        prompt, replacement_mapping = _pseudonymize_findings(prompt, response.result.findings, session_key, local_findings)
     except Exception as e:
-        pseudonymization_error = BackendError(
-            status = "500",
-            msg = "Fehler bei der Pseudonymisierung der Daten.",
-            code = "DLP_ERROR"
-        )
-        logger.info(f"Error occurred during pseudonymization process: {e}")
-        return None, None, pseudonymization_error
+        return None, None, _pseudonymization_error(e)
     return prompt, replacement_mapping, None
 
+
+async def pseudonymize_text_async(prompt: str, project_id: str, session_key: tuple[str, str] | None = None) -> tuple[str, dict, BackendError]:
+    """Async variant of pseudonymize_text."""
+    try:
+        local_findings, _ = _prescreen_prompt(prompt, reject=False)
+        response = await _call_dlp_api_batched(prompt, project_id)
+        _record_agreement(local_findings, response)
+        prompt, replacement_mapping = _pseudonymize_findings(prompt, response.result.findings, session_key, local_findings)
+    except Exception as e:
+        return None, None, _pseudonymization_error(e)
+    return prompt, replacement_mapping, None
+
+
+def _bounded_lines(text: str) -> Iterator[str]:
+    """Yields the lines of text (with line ends), lines longer than the maximum chunk size are cut at whitespace."""
+    max_len = constants.DLP_CACHE_CHUNK_MAX_SIZE
+    for line in text.splitlines(keepends=True):
+        while len(line) > max_len:
+            cut = line.rfind(" ", 0, max_len) + 1 or max_len
+            yield line[:cut]
+            line = line[cut:]
+        yield line
+
+
+def _content_defined_chunks(text: str) -> List[str]:
+    """Splits text into chunks for the DLP cache, "".join(chunks) == text.
+
+    Chunks end after a line whose hash hits the boundary divisor (once the chunk has its minimum
+    size), so the boundaries depend on the content and not on absolute offsets. An edit only
+    changes the chunks around it, all other chunks keep their hash and stay cached.
+    """
+    chunks, current, current_len = [], [], 0
+    for line in _bounded_lines(text):
+        if current and current_len + len(line) > constants.DLP_CACHE_CHUNK_MAX_SIZE:
+            chunks.append("".join(current))
+            current, current_len = [], 0
+        current.append(line)
+        current_len += len(line)
+        if current_len >= constants.DLP_CACHE_CHUNK_MIN_SIZE and zlib.crc32(line.encode()) % constants.DLP_CACHE_CHUNK_BOUNDARY_DIVISOR == 0:
+            chunks.append("".join(current))
+            current, current_len = [], 0
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+def _chunk_cache_key(chunk: str) -> str:
+    return hashlib.sha256(chunk.encode()).hexdigest()
+
+
+# Masked codepoint ranges per chunk, relative to the chunk. Only offsets are cached, no quotes.
+_anonymization_cache = ttl_cache.TTLCache(
+    name="dlp_anonymization",
+    max_entries=constants.DLP_CACHE_MAX_ENTRIES,
+    ttl_seconds=constants.DLP_CACHE_TTL_SECONDS,
+    max_bytes=constants.DLP_CACHE_MAX_BYTES,
+)
+
+
+class _Section(NamedTuple):
+    """One DLP request: a run of adjacent uncached chunks plus some overlap with their neighbours."""
+    indices: List[int]
+    prefix: str
+    suffix: str
+
+
+def _overlap_before(chunk: str) -> str:
+    # The tail of the previous chunk, starting at a word boundary
+    tail = chunk[-constants.DLP_SECTION_OVERLAP:]
+    match = re.search(r"\s", tail)
+    return tail[match.end():] if match else tail
+
+
+def _overlap_after(chunk: str) -> str:
+    # The head of the next chunk, ending at a word boundary
+    head = chunk[:constants.DLP_SECTION_OVERLAP]
+    cut = max(head.rfind(" "), head.rfind("\n"))
+    return head[:cut] if cut > 0 else head
+
+
+def _plan_anonymization(doc_content: str) -> tuple[List[str], List[tuple | None], List[_Section]]:
+    """Looks up the chunks of a document in the cache.
+
+    Returns:
+        The chunks, the cached ranges per chunk (None on a miss) and the sections to inspect.
+        Every section is a run of adjacent missed chunks of at most DLP_SECTION_MAX_SIZE
+        characters. It overlaps with the chunks before and after it, so names or addresses
+        across a section boundary are still found as a whole.
+    """
+    chunks = _content_defined_chunks(doc_content)
+    chunk_ranges = [_anonymization_cache.get(_chunk_cache_key(chunk)) for chunk in chunks]
+
+    runs, current, current_len = [], [], 0
+    for index, chunk in enumerate(chunks):
+        if chunk_ranges[index] is not None:
+            continue
+        if current and (current[-1] != index - 1 or current_len + len(chunk) > constants.DLP_SECTION_MAX_SIZE):
+            runs.append(current)
+            current, current_len = [], 0
+        current.append(index)
+        current_len += len(chunk)
+    if current:
+        runs.append(current)
+
+    sections = [
+        _Section(
+            indices=run,
+            prefix=_overlap_before(chunks[run[0] - 1]) if run[0] > 0 else "",
+            suffix=_overlap_after(chunks[run[-1] + 1]) if run[-1] + 1 < len(chunks) else "",
+        )
+        for run in runs
+    ]
+    return chunks, chunk_ranges, sections
+
+
+def _request_text(chunks: List[str], section: _Section) -> str:
+    text = section.prefix + "".join(chunks[index] for index in section.indices) + section.suffix
+    return text.replace("|", " ")
+
+
+def _apply_anonymization_response(chunks: List[str], section: _Section, response, chunk_ranges: List[tuple | None]) -> bool:
+    """Distributes the findings of one DLP request to the chunks of its section and caches them.
+
+    Findings in the overlap belong to the neighbouring chunks and are clipped off.
+
+    Returns:
+        True if the findings were truncated, the result must not be used then.
+    """
+    if response.result.findings_truncated:
+        return True
+
+    offsets = []
+    offset = len(section.prefix)
+    for index in section.indices:
+        offsets.append(offset)
+        offset += len(chunks[index])
+    section_start, section_end = offsets[0], offset
+
+    ranges = {index: [] for index in section.indices}
+    for finding in response.result.findings:
+        start = max(finding.location.codepoint_range.start, section_start)
+        end = min(finding.location.codepoint_range.end, section_end)
+        # A finding can span a chunk boundary, e.g. an address over two lines
+        position = bisect.bisect_right(offsets, start) - 1
+        while start < end:
+            chunk_start = offsets[position]
+            chunk_end = chunk_start + len(chunks[section.indices[position]])
+            ranges[section.indices[position]].append((start - chunk_start, min(end, chunk_end) - chunk_start))
+            start = chunk_end
+            position += 1
+
+    for index in section.indices:
+        chunk_ranges[index] = tuple(ranges[index])
+        _anonymization_cache.set(_chunk_cache_key(chunks[index]), chunk_ranges[index])
+    return False
+
+
+def _mask_ranges(text: str, ranges: Sequence[tuple]) -> str:
+    if not ranges:
+        return text
+    pieces = []
+    position = 0
+    for start, end in sorted(ranges):
+        start = max(start, position)
+        if start >= end:
+            continue
+        pieces.append(text[position:start])
+        pieces.append("*" * (end - start))
+        position = end
+    pieces.append(text[position:])
+    return "".join(pieces)
+
+
+def _anonymization_result(doc_content: str, chunks: List[str], chunk_ranges: List[tuple]) -> tuple[str, str, BackendError]:
+    """Builds the anonymize_text result from the masked ranges of each chunk."""
+    if not any(chunk_ranges):
+        return doc_content, "", None
+
+    anonymized_text = "".join(_mask_ranges(chunk, ranges) for chunk, ranges in zip(chunks, chunk_ranges))
+    logger.info(anonymized_text)
+    return anonymized_text, constants.DLP_INFO_ANONYMIZED, None
+
+
+def _truncated_findings_error() -> tuple[str, str, BackendError]:
+    dlp_error = BackendError(
+        code="500",
+        msg=constants.DLP_TRUNCATED_FINDINGS,
+        status="DLP_ERROR"
+    )
+    return "", "", dlp_error
+
+
 def anonymize_text(doc_content: str, project_id: str) -> tuple[str, str, BackendError]:
     """Anonymizes the given text and returns the anonymized text.
 
-    This method anonymizes the provided text using the Google Cloud DLP API. It handles
-    texts larger than the maximum allowed size by splitting them into smaller sections
-    and processing each section individually.
+    This method anonymizes the provided text using the Google Cloud DLP API. The text is split
+    into content-defined chunks whose masked ranges are cached by their hash, so only chunks
+    that were not inspected before (e.g. in an earlier turn of the conversation) are sent to
+    DLP. They are inspected in overlapping sections, at most DLP_MAX_PARALLEL_REQUESTS at a
+    time, and the anonymized text is rebuilt in one pass over all chunks.
 
     Args:
         doc_content: The text to be anonymized.
@@ -128,74 +541,186 @@ def anonymize_text(doc_content: str, project_id: str) -> tuple[str, str, Backend
             - An information message about the anonymization process.
             - A BackendError object if an error occurred, otherwise None.
     """
-    if len(doc_content) > constants.MAX_PROMPT_SIZE_DLP:
-        sections = _split_prompt(prompt=doc_content)
-        anonymized_sections_list = []
-        for section in sections:
-            section_modified = section.replace("|", " ")
-            dlp_resp = _call_dlp_api(prompt=section_modified, project_id=project_id)
-            dlp_info = ""
-
-            if len(dlp_resp.result.findings) == 0:
-                continue
-            if dlp_resp.result.findings_truncated:
-                dlp_error = BackendError(
-                    code="500",
-                    msg=constants.DLP_TRUNCATED_FINDINGS,
-                    status="DLP_ERROR"
-                )
-                return "", dlp_info, dlp_error
-
-            anonymized_sections_list.append(_anonymize_text_section(text=section, findings=dlp_resp.result.findings))
-
-        if len(anonymized_sections_list) == 0:
-            return doc_content, dlp_info, None
-        else:
-            anonymized_text = " ".join(anonymized_sections_list)
-            dlp_info = constants.DLP_INFO_ANONYMIZED
-            logger.info(anonymized_text)
-            return anonymized_text, dlp_info, None
-    else:
-        doc_content_modified = doc_content.replace("|", " ")
-        dlp_resp = _call_dlp_api(prompt=doc_content_modified, project_id=project_id)
-        dlp_info = ""
-
-        if len(dlp_resp.result.findings) == 0:
-            return doc_content, dlp_info, None
-
-        if dlp_resp.result.findings_truncated:
-            dlp_error = BackendError(
-                code="500",
-                msg=constants.DLP_TRUNCATED_FINDINGS,
-                status="DLP_ERROR"
-            )
-            return "", dlp_info, dlp_error
+    chunks, chunk_ranges, sections = _plan_anonymization(doc_content)
+    if sections:
+        with ThreadPoolExecutor(max_workers=min(constants.DLP_MAX_PARALLEL_REQUESTS, len(sections))) as executor:
+            responses = list(executor.map(
+                lambda section: _call_dlp_api(prompt=_request_text(chunks, section), project_id=project_id),
+                sections,
+            ))
+        for section, response in zip(sections, responses):
+            if _apply_anonymization_response(chunks, section, response, chunk_ranges):
+                return _truncated_findings_error()
+    return _anonymization_result(doc_content, chunks, chunk_ranges)
+
+
+async def anonymize_text_async(doc_content: str, project_id: str) -> tuple[str, str, BackendError]:
+    """Async variant of anonymize_text."""
+    chunks, chunk_ranges, sections = _plan_anonymization(doc_content)
+    semaphore = asyncio.Semaphore(constants.DLP_MAX_PARALLEL_REQUESTS)
+
+    async def _inspect(section: _Section):
+        async with semaphore:
+            return await _call_dlp_api_async(prompt=_request_text(chunks, section), project_id=project_id)
+
+    responses = await asyncio.gather(*(_inspect(section) for section in sections))
+    for section, response in zip(sections, responses):
+        if _apply_anonymization_response(chunks, section, response, chunk_ranges):
+            return _truncated_findings_error()
+    return _anonymization_result(doc_content, chunks, chunk_ranges)
+
+
+def _inspection_result(response) -> dict:
+    num_findings = len(response.result.findings)
+    findings_formatted = ""
+    if num_findings > 0:
+        findings_formatted = format_findings(response.result.findings)
+    return {"num_findings": num_findings, "findings_formatted": findings_formatted}
 
-        anonymized_text = _anonymize_text_section(text=doc_content, findings=dlp_resp.result.findings)
 
-        dlp_info = constants.DLP_INFO_ANONYMIZED
-        logger.info(anonymized_text)
-        return anonymized_text, dlp_info, None
+def _local_inspection_result(local_findings: Sequence[pii_prescreen.LocalFinding]) -> dict:
+    return {
+        "num_findings": len(local_findings),
+        "findings_formatted": _findings_message((finding.info_type, finding.quote) for finding in local_findings),
+    }
 
 
 def inspect_prompt(
     prompt: str,
     project_id: str
-    ) -> str:
+    ) -> dict:
     logger.info("Inspecting prompt %s", prompt)
 
+    local_findings, short_circuit = _prescreen_prompt(prompt, reject=True)
+    if short_circuit:
+        return _local_inspection_result(local_findings)
     response = _call_dlp_api(prompt=prompt, project_id=project_id)
+    _record_agreement(local_findings, response)
+    return _inspection_result(response)
+
+
+async def inspect_prompt_async(
+    prompt: str,
+    project_id: str
+    ) -> dict:
+    logger.info("Inspecting prompt %s", prompt)
+
+    local_findings, short_circuit = _prescreen_prompt(prompt, reject=True)
+    if short_circuit:
+        _verify_short_circuit(prompt, project_id, local_findings)
+        return _local_inspection_result(local_findings)
+    response = await _call_dlp_api_batched(prompt=prompt, project_id=project_id)
+    _record_agreement(local_findings, response)
+    return _inspection_result(response)
+
+
+def _inspection_and_pseudonymization_result(
+    prompt: str,
+    response,
+    pseudonymize: bool,
+    session_key: tuple[str, str] | None,
+    local_findings: Sequence[pii_prescreen.LocalFinding],
+) -> dict:
+    if response is None:
+        result = _local_inspection_result(local_findings)
+    else:
+        _record_agreement(local_findings, response)
+        result = _inspection_result(response)
+    result.update({"pseudonymized_prompt": None, "replacement_mapping": None, "error": None})
+    if pseudonymize:
+        try:
+            result["pseudonymized_prompt"], result["replacement_mapping"] = _pseudonymize_findings(
+                prompt, response.result.findings, session_key, local_findings
+            )
+        except Exception as e:
+            result["error"] = _pseudonymization_error(e)
+    return result
 
-    num_findings = len(response.result.findings)
-    findings_formatted = ""
-    if num_findings > 0:
-        findings_formatted = format_findings(response.result.findings)
-    return {"num_findings": num_findings, "findings_formatted": findings_formatted}
+
+def inspect_and_pseudonymize(prompt: str, project_id: str, pseudonymize: bool, session_key: tuple[str, str] | None = None) -> dict:
+    """Inspects and optionally pseudonymizes the prompt with a single DLP request.
+
+    inspect_prompt and pseudonymize_text use the same inspect config, so the findings of one
+    request serve both. If the prompt is only inspected and the local pre-screen already finds
+    personal data, DLP is not called at all.
+
+    Args:
+        prompt: The user prompt.
+        project_id: The project ID of the Google Cloud project.
+        pseudonymize: Whether to pseudonymize the prompt as well.
+        session_key: See pseudonymize_text.
+
+    Returns:
+        The result of inspect_prompt (num_findings, findings_formatted), extended by
+        pseudonymized_prompt, replacement_mapping and error as returned by pseudonymize_text.
+        These are None if pseudonymize is False.
+    """
+    local_findings, short_circuit = _prescreen_prompt(prompt, reject=not pseudonymize)
+    response = None if short_circuit else _call_dlp_api(prompt=prompt, project_id=project_id)
+    return _inspection_and_pseudonymization_result(prompt, response, pseudonymize, session_key, local_findings)
+
+
+async def inspect_and_pseudonymize_async(prompt: str, project_id: str, pseudonymize: bool, session_key: tuple[str, str] | None = None) -> dict:
+    """Async variant of inspect_and_pseudonymize."""
+    local_findings, short_circuit = _prescreen_prompt(prompt, reject=not pseudonymize)
+    if short_circuit:
+        _verify_short_circuit(prompt, project_id, local_findings)
+        response = None
+    else:
+        response = await _call_dlp_api_batched(prompt=prompt, project_id=project_id)
+    return _inspection_and_pseudonymization_result(prompt, response, pseudonymize, session_key, local_findings)
+
+
+async def inspect_question_and_anonymize_document_async(question: str, document: str, project_id: str) -> tuple[dict, tuple[str, str, BackendError]]:
+    """Runs inspect_prompt_async on the question and anonymize_text_async on the document concurrently.
+
+    Returns:
+        The results of inspect_prompt_async and anonymize_text_async.
+    """
+    return await asyncio.gather(
+        inspect_prompt_async(prompt=question, project_id=project_id),
+        anonymize_text_async(doc_content=document, project_id=project_id),
+    )
+
+
+def pseudonymize_history(history: List[Conversation], session_key: tuple[str, str] | None) -> List[Conversation]:
+    """Replaces the values pseudonymized in earlier turns of the session in the history.
+
+    The history sent by the client carries the original values, the LLM gets the same
+    pseudonyms it has seen in those turns. Only values already known to the session are
+    replaced, the history is not inspected again.
+    """
+    mapping = _session_mappings.get(session_key) if session_key is not None else None
+    if mapping is None or not len(mapping):
+        return history
+    return [
+        Conversation(question=mapping.pseudonymize(turn.question)[0], answer=mapping.pseudonymize(turn.answer)[0])
+        for turn in history
+    ]
+
+
+def restore_original_data(replacement_mapping: dict | None, text: str) -> tuple[str, int]:
+    """Reverts the pseudonymization in an LLM answer in a single pass.
+
+    Args:
+        replacement_mapping: The mapping returned by pseudonymize_text.
+        text: The answer of the LLM.
+
+    Returns:
+        The text with the original values and the number of restored values.
+    """
+    if not replacement_mapping or not text:
+        return text, 0
+    return PatternReplacer({pseudonym: original[0] for pseudonym, original in replacement_mapping.items()}).replace(text)
 
 
 def format_findings(findings: Sequence[Finding]) -> str:
+    return _findings_message((f.info_type.name, f.quote) for f in findings)
+
+
+def _findings_message(findings: Iterable[tuple[str, str]]) -> str:
     new_findings_format = "\n".join(
-        [f"""{constants.DLP_INFO_TYPES_MAPPING[f.info_type.name]} : {f.quote}""" for f in findings],
+        [f"""{constants.DLP_INFO_TYPES_MAPPING[info_type]} : {quote}""" for info_type, quote in findings],
     )
 
     return (
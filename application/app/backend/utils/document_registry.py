@@ -0,0 +1,181 @@
+"""In-memory registry of the provided documents in local_files.
+
+All documents are read once when the registry is created and kept in memory together with
+their system instruction. Afterwards the directory is checked for changes at most every
+PROVIDED_DOC_RESCAN_SECONDS: new files are registered under a new doc_key, changed files
+(mtime or size) are reloaded and deleted files are dropped, without restarting the backend.
+
+The system instruction of a document is taken from constants.PROVIDED_DOC_SYSTEM_INSTRUCTIONS,
+from a file with the same name and the suffix PROVIDED_DOC_INSTRUCTION_SUFFIX next to the
+document, or defaults to the doc chat system instruction.
+
+Documents above PROVIDED_DOC_RETRIEVAL_MIN_TOKENS get a retrieval index when they are loaded,
+retrieve returns the passages matching a question instead of the whole document.
+"""
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from . import constants, retrieval_index
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ProvidedDocument:
+    doc_key: str
+    path: str
+    content: str
+    system_instruction: list
+    size_bytes: int
+    mtime: float
+    index: Optional[retrieval_index.RetrievalIndex] = field(default=None, repr=False, compare=False)
+
+    @property
+    def version(self) -> str:
+        """Changes whenever the file is reloaded with a different content."""
+        return f"{self.mtime}-{self.size_bytes}"
+
+    @property
+    def estimated_tokens(self) -> int:
+        return len(self.content) // constants.CHARS_PER_TOKEN_ESTIMATE
+
+    def stats(self) -> Dict:
+        return {
+            "file": os.path.basename(self.path),
+            "size_bytes": self.size_bytes,
+            "num_chars": len(self.content),
+            "estimated_tokens": self.estimated_tokens,
+            "modified_at": self.mtime,
+            "num_passages": len(self.index.passages) if self.index else 0,
+        }
+
+
+def _read_content(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        # Same layout as the documents were always sent to the model: lines joined with an extra newline
+        return "\n".join(f.readlines())
+
+
+def _build_index(content: str) -> Optional[retrieval_index.RetrievalIndex]:
+    if not constants.PROVIDED_DOC_RETRIEVAL_ENABLED:
+        return None
+    if len(content) // constants.CHARS_PER_TOKEN_ESTIMATE < constants.PROVIDED_DOC_RETRIEVAL_MIN_TOKENS:
+        return None
+    return retrieval_index.build_index(content)
+
+
+def _doc_key(file_name: str) -> str:
+    return constants.PROVIDED_DOC_FILE_KEYS.get(file_name, os.path.splitext(file_name)[0])
+
+
+class DocumentRegistry:
+    """Provided documents of one directory, keyed by doc_key.
+
+    Args:
+        directory: Directory containing the documents, usually backend/local_files.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._documents: Dict[str, ProvidedDocument] = {}
+        self._lock = threading.Lock()
+        self._last_scan = 0.0
+        self._refresh(force=True)
+
+    def _scan(self) -> Dict[str, Tuple[str, os.stat_result]]:
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(constants.PROVIDED_DOC_EXTENSIONS):
+                    files[_doc_key(entry.name)] = (entry.path, entry.stat())
+        return files
+
+    def _system_instruction(self, doc_key: str, path: str) -> list:
+        if doc_key in constants.PROVIDED_DOC_SYSTEM_INSTRUCTIONS:
+            return constants.PROVIDED_DOC_SYSTEM_INSTRUCTIONS[doc_key]
+        instruction_path = os.path.splitext(path)[0] + constants.PROVIDED_DOC_INSTRUCTION_SUFFIX
+        if os.path.isfile(instruction_path):
+            return [_read_content(instruction_path)]
+        return constants.SYSTEM_INSTRUCTION_GEMINI_DOC_CHAT
+
+    def _refresh(self, force: bool = False) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_scan < constants.PROVIDED_DOC_RESCAN_SECONDS:
+                return
+            self._last_scan = now
+
+            files = self._scan()
+            for doc_key in set(self._documents) - set(files):
+                logger.info("Removing provided document %s", doc_key)
+                del self._documents[doc_key]
+
+            for doc_key, (path, stat) in files.items():
+                known = self._documents.get(doc_key)
+                if known and known.path == path and known.mtime == stat.st_mtime and known.size_bytes == stat.st_size:
+                    continue
+                try:
+                    content = _read_content(path)
+                except (OSError, UnicodeDecodeError) as ex:
+                    # Keep serving the previous version, e.g. while the file is still being written
+                    logger.warning("Could not load provided document %s: %s", path, ex)
+                    continue
+                self._documents[doc_key] = ProvidedDocument(
+                    doc_key=doc_key,
+                    path=path,
+                    content=content,
+                    system_instruction=self._system_instruction(doc_key, path),
+                    size_bytes=stat.st_size,
+                    mtime=stat.st_mtime,
+                    index=_build_index(content),
+                )
+                logger.info("%s provided document %s (%s bytes)", "Reloaded" if known else "Loaded", doc_key, stat.st_size)
+
+    def get(self, doc_key: str) -> ProvidedDocument:
+        """Returns the document registered under doc_key.
+
+        Raises:
+            KeyError: If there is no document for doc_key.
+        """
+        self._refresh()
+        with self._lock:
+            return self._documents[doc_key]
+
+    def retrieve(self, doc_key: str, query: str) -> Optional[str]:
+        """Returns the passages of the document matching query, None if the whole document is sent.
+
+        The whole document is sent if it has no index or no passage of the document or its
+        companion matches the query, e.g. for a greeting.
+
+        The best matching passages of the companion document in PROVIDED_DOC_RETRIEVAL_COMPANIONS
+        are appended.
+
+        Raises:
+            KeyError: If there is no document for doc_key.
+        """
+        document = self.get(doc_key)
+        if document.index is None:
+            return None
+        passages = [document.index.search(query, constants.PROVIDED_DOC_RETRIEVAL_TOP_K, constants.PROVIDED_DOC_RETRIEVAL_MAX_CHARS)]
+        with self._lock:
+            companion = self._documents.get(constants.PROVIDED_DOC_RETRIEVAL_COMPANIONS.get(doc_key))
+        if companion is not None and companion.index is not None:
+            passages.append(companion.index.search(query, constants.PROVIDED_DOC_RETRIEVAL_COMPANION_TOP_K))
+        if not any(passages):
+            return None
+        return "\n\n".join(retrieval_index.render_passages(document_passages) for document_passages in passages if document_passages)
+
+    def doc_keys(self) -> List[str]:
+        self._refresh()
+        with self._lock:
+            return sorted(self._documents)
+
+    def stats(self) -> Dict[str, Dict]:
+        """Returns size and estimated token count per doc_key, i.e. the prompt cost of each document."""
+        self._refresh()
+        with self._lock:
+            return {doc_key: document.stats() for doc_key, document in sorted(self._documents.items())}
@@ -0,0 +1,162 @@
+"""Documents uploaded once for doc chat, referenced by doc_id in the following questions.
+
+A document is anonymized once on upload (dlp_api.anonymize_text_async) and stored with the
+result for DOCUMENT_STORE_TTL_SECONDS. Questions then carry the doc_id instead of the document,
+so neither the upload nor the anonymization is repeated per turn.
+
+A document belongs to the user who uploaded it, only questions with the same oid_hashed get it.
+
+Documents are held in an in-process LRU with TTL and, if DOCUMENT_STORE_BUCKET is set, in the
+bucket as well, so every instance can answer questions about a document uploaded to another.
+The object of an expired document is deleted when it is requested. Its custom time is set to
+the expiry, the lifecycle rule of the bucket deletes the objects that are never requested again.
+"""
+import asyncio
+import json
+import logging
+import os
+import secrets
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Optional, Protocol
+
+from . import constants, metrics, storage_api, ttl_cache
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StoredDocument:
+    doc_id: str
+    # The user who uploaded the document
+    oid_hashed: str
+    # The document as uploaded, logged as context of the conversation
+    content: str
+    # The document as sent to the LLM
+    anonymized_content: str
+    info: str
+    expires_at: float
+
+
+class DocumentBackend(Protocol):
+    def load(self, doc_id: str) -> Optional[StoredDocument]:
+        ...
+
+    def save(self, document: StoredDocument) -> None:
+        ...
+
+    def delete(self, doc_id: str) -> None:
+        ...
+
+
+class GcsDocumentBackend:
+    """Stores a document as {DOCUMENT_STORE_PREFIX}/{doc_id}.json in a bucket.
+
+    The custom time of the object is the expiry of the document.
+    """
+
+    def __init__(self, bucket_name: str):
+        self.bucket = storage_api.storage_client.bucket(bucket_name)
+
+    def _blob(self, doc_id: str):
+        return self.bucket.blob(f"{constants.DOCUMENT_STORE_PREFIX}/{doc_id}.json")
+
+    def load(self, doc_id: str) -> Optional[StoredDocument]:
+        blob = self._blob(doc_id)
+        if not blob.exists():
+            return None
+        return StoredDocument(**json.loads(blob.download_as_text()))
+
+    def save(self, document: StoredDocument) -> None:
+        blob = self._blob(document.doc_id)
+        blob.custom_time = datetime.fromtimestamp(document.expires_at, tz=timezone.utc)
+        blob.upload_from_string(
+            json.dumps(asdict(document), ensure_ascii=False),
+            content_type="application/json",
+        )
+
+    def delete(self, doc_id: str) -> None:
+        blob = self._blob(doc_id)
+        if blob.exists():
+            blob.delete()
+
+
+class DocumentStore:
+    """
+    Args:
+        backend: Shared backend, None to keep the documents in this process only.
+        clock: Wall clock in seconds, the expiry is shared between instances.
+    """
+
+    def __init__(self, backend: Optional[DocumentBackend] = None, clock=time.time):
+        self.backend = backend
+        self.clock = clock
+        self._documents = ttl_cache.TTLCache(
+            name="document_store",
+            max_entries=constants.DOCUMENT_STORE_MAX_DOCUMENTS,
+            ttl_seconds=constants.DOCUMENT_STORE_TTL_SECONDS,
+            max_bytes=constants.DOCUMENT_STORE_MAX_BYTES,
+        )
+
+    async def add(self, oid_hashed: str, content: str, anonymized_content: str, info: str) -> StoredDocument:
+        """Stores the document of the user and returns it with its new doc_id."""
+        document = StoredDocument(
+            doc_id=secrets.token_urlsafe(16),
+            oid_hashed=oid_hashed,
+            content=content,
+            anonymized_content=anonymized_content,
+            info=info,
+            expires_at=self.clock() + constants.DOCUMENT_STORE_TTL_SECONDS,
+        )
+        self._documents.set(document.doc_id, document)
+        if self.backend is not None:
+            # Written before the doc_id is returned, the next question may reach another instance
+            await asyncio.to_thread(self.backend.save, document)
+        metrics.increment("document_store_uploads")
+        return document
+
+    async def get(self, doc_id: str, oid_hashed: str) -> Optional[StoredDocument]:
+        """Returns the document, or None if it is unknown, expired or was uploaded by another user."""
+        document = self._documents.get(doc_id)
+        if document is None and self.backend is not None:
+            try:
+                document = await asyncio.to_thread(self.backend.load, doc_id)
+            except Exception as e:
+                logger.warning("Loading document %s from the shared store failed: %s", doc_id, e)
+                metrics.increment("document_store_errors", "load")
+            if document is not None:
+                self._documents.set(doc_id, document)
+        if document is not None and document.expires_at <= self.clock():
+            await self._expire(doc_id)
+            document = None
+        if document is None:
+            metrics.increment("document_store_misses")
+            return None
+        if document.oid_hashed != oid_hashed:
+            # Not distinguishable from an unknown doc_id for the caller
+            metrics.increment("document_store_denied")
+            return None
+        return document
+
+    async def _expire(self, doc_id: str) -> None:
+        self._documents.invalidate(doc_id)
+        if self.backend is None:
+            return
+        try:
+            await asyncio.to_thread(self.backend.delete, doc_id)
+        except Exception as e:
+            # The lifecycle rule of the bucket deletes it later
+            logger.warning("Deleting expired document %s from the shared store failed: %s", doc_id, e)
+            metrics.increment("document_store_errors", "delete")
+
+
+_store: Optional[DocumentStore] = None
+
+
+def get_store() -> DocumentStore:
+    global _store
+    if _store is None:
+        bucket_name = os.environ.get("DOCUMENT_STORE_BUCKET")
+        _store = DocumentStore(GcsDocumentBackend(bucket_name) if bucket_name else None)
+    return _store
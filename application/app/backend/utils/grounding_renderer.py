@@ -0,0 +1,91 @@
+"""Renders Gemini answers grounded on a Vertex AI Search data store.
+
+The answer is split at the end of every grounding support and the supports' chunk numbers are
+appended as footnotes, followed by the list of cited sources in order of first citation. One
+pass over the supports collects the cited chunks, the markdown is joined once at the end.
+Besides the markdown, the cited sources are returned as Citation for the frontend.
+"""
+from typing import List, NamedTuple
+
+from . import constants
+from backend.schemas.schemas import Citation, GroundContent
+
+# Citation indices are in byte units
+_ENCODING = "utf-8"
+_MISSING_PAGE_NUMBER = 999
+
+
+class GroundedAnswer(NamedTuple):
+    markdown: str
+    citations: List[Citation]
+
+
+def cap_ground_content(content: str, max_chars: int) -> str:
+    """Cuts content at the last word boundary before max_chars."""
+    if len(content) <= max_chars:
+        return content
+    cut = content.rfind(" ", 0, max_chars)
+    return content[:cut if cut > 0 else max_chars] + " …"
+
+
+def _folder_path(uri: str) -> str:
+    # gs://bucket/folder/file.pdf -> folder/file.pdf/
+    return "/".join(uri.split("/")[3:]) + "/"
+
+
+def _citation(number: int, context, folder_path: str, max_ground_content_chars: int) -> Citation:
+    text = getattr(context, "text", "") or ""
+    return Citation(
+        id=number,
+        name=context.title or folder_path,
+        link=context.uri,
+        path=folder_path,
+        content=[GroundContent(page=_MISSING_PAGE_NUMBER, content=cap_ground_content(text, max_ground_content_chars))] if text else [],
+    )
+
+
+def render(response, max_ground_content_chars: int = constants.CITATION_MAX_GROUND_CONTENT_CHARS) -> GroundedAnswer:
+    """Returns the answer of a grounded response with footnotes and its cited sources.
+
+    Args:
+        response: The GenerationResponse of a model with a Vertex AI Search retrieval tool.
+        max_ground_content_chars: Maximum length of the retrieved text quoted per citation.
+    """
+    grounding_metadata = response.candidates[0].grounding_metadata
+    text_bytes = response.text.encode(_ENCODING)
+    chunks = grounding_metadata.grounding_chunks
+    num_chunks = len(chunks)
+
+    parts = []
+    # Chunk indices in order of their first citation, a dict keeps them unique in that order
+    cited = {}
+    prev_index = 0
+    for grounding_support in grounding_metadata.grounding_supports:
+        end_index = grounding_support.segment.end_index
+        chunk_indices = grounding_support.grounding_chunk_indices
+        parts.append(text_bytes[prev_index:end_index].decode(_ENCODING))
+        parts.append(" ")
+        parts.append("".join(f"[{chunk_index + 1}]" for chunk_index in chunk_indices))
+        parts.append("\n")
+        for chunk_index in chunk_indices:
+            cited.setdefault(chunk_index, None)
+        prev_index = end_index
+
+    if prev_index < len(text_bytes):
+        parts.append(text_bytes[prev_index:].decode(_ENCODING))
+
+    parts.append("### Relevante Quellen\n")
+
+    citations = []
+    for chunk_index in cited:
+        if not 0 <= chunk_index < num_chunks:
+            continue
+        grounding_chunk = chunks[chunk_index]
+        context = grounding_chunk.web or grounding_chunk.retrieved_context
+        if not context:
+            continue
+        folder_path = _folder_path(str(context.uri))
+        parts.append(f"[{chunk_index + 1}] [{folder_path}] \n \n")
+        citations.append(_citation(chunk_index + 1, context, folder_path, max_ground_content_chars))
+
+    return GroundedAnswer("".join(parts), citations)
@@ -0,0 +1,172 @@
+"""Token-budgeted chat histories.
+
+The history sent to the model is kept within the token budget of the model: the latest
+HISTORY_VERBATIM_TURNS turns are sent unchanged, older turns are replaced by a rolling summary
+of the session. The summary is generated in the background after the answer is delivered,
+folding the turns that fell out of the verbatim window into the previous summary, and is cached
+per session and chat type. Until a summary covers them, old turns beyond the budget are left out.
+
+The history is supplied by the client with every request, so a cached summary is only used if
+the turns it covers still match.
+
+Token counts are estimated from the number of characters (CHARS_PER_TOKEN_ESTIMATE).
+"""
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional
+
+from . import constants, metrics, ttl_cache
+from backend.schemas.schemas import Conversation
+
+logger = logging.getLogger(__name__)
+
+# Summarizes (previous summary or None, turns to fold in) into a new summary
+Summarize = Callable[[Optional[str], List[Conversation]], Awaitable[str]]
+
+
+@dataclass
+class _Summary:
+    covered_turns: int
+    digest: str
+    text: str
+
+
+@dataclass
+class CompactedHistory:
+    """History to send to the model, see compact."""
+    history: List[Conversation]
+    tokens_saved: int
+    session_id: str
+    chat_type: str
+    model_name: str
+    # The uncompacted history, needed to fold turns into the summary later
+    source: List[Conversation] = field(repr=False, default_factory=list)
+
+
+_summaries = ttl_cache.TTLCache(
+    name="history_summaries",
+    max_entries=constants.HISTORY_SUMMARY_MAX_SESSIONS,
+    ttl_seconds=constants.HISTORY_SUMMARY_TTL_SECONDS,
+    max_bytes=constants.HISTORY_SUMMARY_MAX_BYTES,
+)
+# Sessions whose summary is being generated, so a burst of requests folds the turns only once
+_refreshing: set = set()
+# Keeps the summary tasks referenced until they are done
+_tasks: set = set()
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // constants.CHARS_PER_TOKEN_ESTIMATE + 1
+
+
+def _turn_tokens(turn: Conversation) -> int:
+    return _estimate_tokens(turn.question) + _estimate_tokens(turn.answer)
+
+
+def _digest(turns: List[Conversation]) -> str:
+    sha256 = hashlib.sha256()
+    for turn in turns:
+        for text in (turn.question, turn.answer):
+            sha256.update(text.encode())
+            sha256.update(b"\0")
+    return sha256.hexdigest()
+
+
+def token_budget(model_name: str) -> int:
+    return constants.HISTORY_TOKEN_BUDGETS.get(model_name, constants.HISTORY_DEFAULT_TOKEN_BUDGET)
+
+
+def _summary_turn(summary: _Summary) -> Conversation:
+    return Conversation(question=constants.HISTORY_SUMMARY_QUESTION, answer=summary.text)
+
+
+def _cached_summary(session_id: str, chat_type: str, history: List[Conversation]) -> Optional[_Summary]:
+    summary = _summaries.get((session_id, chat_type))
+    if summary is None or summary.covered_turns > len(history):
+        return None
+    if summary.digest != _digest(history[:summary.covered_turns]):
+        # The client sent a different history than the one summarized
+        return None
+    return summary
+
+
+def compact(session_id: str, chat_type: str, history: List[Conversation], model_name: str) -> CompactedHistory:
+    """Returns the history to send to the model within its token budget.
+
+    Args:
+        session_id: The session, the summary is cached per session and chat type.
+        chat_type: The chat type as logged in the usage table.
+        history: The history as it would be sent to the model.
+        model_name: The model answering, selects the token budget.
+    """
+    budget = token_budget(model_name)
+    full_tokens = sum(_turn_tokens(turn) for turn in history)
+    compacted = CompactedHistory(list(history), 0, session_id, chat_type, model_name, list(history))
+    if full_tokens <= budget:
+        return compacted
+
+    summary = _cached_summary(session_id, chat_type, history)
+    covered_turns = summary.covered_turns if summary else 0
+    prefix = [_summary_turn(summary)] if summary else []
+    verbatim_start = max(len(history) - constants.HISTORY_VERBATIM_TURNS, covered_turns)
+    older = history[covered_turns:verbatim_start]
+
+    # Newest first, the turns closest to the question are the most relevant
+    kept = []
+    tokens = sum(_turn_tokens(turn) for turn in prefix)
+    for turn in reversed(history[verbatim_start:]):
+        tokens += _turn_tokens(turn)
+        kept.append(turn)
+    for turn in reversed(older):
+        if tokens + _turn_tokens(turn) > budget:
+            break
+        tokens += _turn_tokens(turn)
+        kept.append(turn)
+
+    compacted.history = prefix + kept[::-1]
+    compacted.tokens_saved = max(full_tokens - tokens, 0)
+    metrics.increment("history_tokens_saved", chat_type, compacted.tokens_saved)
+    return compacted
+
+
+async def _fold(session_id: str, chat_type: str, history: List[Conversation], summarize: Summarize) -> None:
+    key = (session_id, chat_type)
+    try:
+        summary = _cached_summary(session_id, chat_type, history)
+        covered_turns = summary.covered_turns if summary else 0
+        target = len(history) - constants.HISTORY_VERBATIM_TURNS
+        text = await summarize(summary.text if summary else None, history[covered_turns:target])
+        _summaries.set(key, _Summary(target, _digest(history[:target]), text))
+        metrics.increment("history_summaries", chat_type)
+    except Exception as e:
+        logger.warning("Summarizing the history of session %s failed: %s", session_id, e)
+        metrics.increment("history_summary_errors", chat_type)
+    finally:
+        _refreshing.discard(key)
+
+
+def summarize_later(compacted: CompactedHistory, turn: Conversation, summarize: Summarize) -> None:
+    """Folds the turns that leave the verbatim window into the summary in the background.
+
+    Call after the answer of the turn is complete. Nothing is done while the history of the
+    next request fits into the budget or the summary is up to date.
+
+    Args:
+        compacted: The result of compact for this request.
+        turn: The turn just answered, as sent to and received from the model.
+        summarize: Generates the new summary.
+    """
+    history = compacted.source + [turn]
+    if sum(_turn_tokens(conversation) for conversation in history) <= token_budget(compacted.model_name):
+        return
+    key = (compacted.session_id, compacted.chat_type)
+    summary = _cached_summary(compacted.session_id, compacted.chat_type, history)
+    if key in _refreshing or len(history) - constants.HISTORY_VERBATIM_TURNS <= (summary.covered_turns if summary else 0):
+        return
+
+    _refreshing.add(key)
+    task = asyncio.get_running_loop().create_task(_fold(compacted.session_id, compacted.chat_type, history, summarize))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
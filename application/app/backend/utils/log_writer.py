@@ -0,0 +1,233 @@
+"""Write-behind logging of chat histories (GCS) and usage rows (Cloud SQL).
+
+The endpoints only enqueue their log records and return. One background thread per sink
+collects the records into batches, writes them with retries and exponential back-off and
+drains the queue on shutdown. The histories of a batch are uploaded concurrently by a small
+thread pool, one object per record. Records that do not fit into a full queue are dropped and
+their number is logged once per batch. Uvicorn turns the SIGTERM of Cloud Run into the FastAPI
+shutdown event, which calls shutdown() and flushes within the remaining grace period.
+
+Only the latest turn of a history is uploaded (see storage_api.log_history), so of several
+records for the same turn of a session in one batch only the last one is written.
+
+Exposed metrics:
+
+    - log_queue_depth (gauge, per sink)
+    - log_flush_seconds (gauge, duration of the last batch write per sink)
+    - log_records_written, log_records_dropped, log_write_retries (counters, per sink)
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from . import constants, metrics, sql_api, storage_api
+
+logger = logging.getLogger(__name__)
+
+
+class _WriteBehindQueue:
+    def __init__(self, name: str, write_batch: Callable[[List[Any]], List[Any]]):
+        """
+        Args:
+            name: Name of the sink, used as metrics label.
+            write_batch: Writes a batch and returns the records that failed and should be retried.
+        """
+        self.name = name
+        self.write_batch = write_batch
+        self._queue = queue.Queue(maxsize=constants.LOG_QUEUE_MAX_SIZE)
+        self._stopping = threading.Event()
+        self._deadline: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        # Records dropped because the queue was full, since the last report
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def put(self, record: Any) -> None:
+        if self._stopping.is_set():
+            # Late records during shutdown are written directly, the worker may already be gone
+            self._write_with_retries([record])
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment("log_records_dropped", self.name)
+            with self._dropped_lock:
+                self._dropped += 1
+
+    def _report_dropped(self) -> None:
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            logger.error("Log queue %s was full, dropped %s records", self.name, dropped)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"log-writer-{self.name}", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self) -> List[Any]:
+        try:
+            batch = [self._queue.get(timeout=constants.LOG_FLUSH_INTERVAL_SECONDS)]
+        except queue.Empty:
+            return []
+        batch_deadline = time.monotonic() + constants.LOG_FLUSH_INTERVAL_SECONDS
+        while len(batch) < constants.LOG_BATCH_SIZE:
+            remaining = batch_deadline - time.monotonic()
+            try:
+                if self._stopping.is_set() or remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._write_with_retries(batch)
+            self._report_dropped()
+
+    def _write_with_retries(self, batch: List[Any]) -> None:
+        backoff = constants.LOG_RETRY_INITIAL_BACKOFF_SECONDS
+        for attempt in range(1, constants.LOG_WRITE_MAX_ATTEMPTS + 1):
+            start_time = time.monotonic()
+            try:
+                failed = self.write_batch(batch)
+            except Exception as ex:
+                logger.warning("Writing %s log batch failed (attempt %s): %s", self.name, attempt, ex)
+                failed = batch
+            metrics.set_gauge("log_flush_seconds", time.monotonic() - start_time, self.name)
+            metrics.increment("log_records_written", self.name, len(batch) - len(failed))
+            if not failed:
+                return
+
+            batch = failed
+            out_of_time = self._deadline is not None and time.monotonic() + backoff > self._deadline
+            if attempt == constants.LOG_WRITE_MAX_ATTEMPTS or out_of_time:
+                break
+            metrics.increment("log_write_retries", self.name)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, constants.LOG_RETRY_MAX_BACKOFF_SECONDS)
+
+        logger.error("Dropping %s %s log records after failed retries", len(batch), self.name)
+        metrics.increment("log_records_dropped", self.name, len(batch))
+
+    def stop(self, deadline: float) -> None:
+        """Lets the worker drain the queue and exit, retries are cut short at the deadline."""
+        self._deadline = deadline
+        self._stopping.set()
+
+    def join(self, deadline: float) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout=max(deadline - time.monotonic(), 0))
+        self._report_dropped()
+        if not self._queue.empty():
+            logger.error("Log queue %s not drained before shutdown, %s records lost", self.name, self._queue.qsize())
+            metrics.increment("log_records_dropped", self.name, self._queue.qsize())
+
+
+_upload_pool = ThreadPoolExecutor(max_workers=constants.LOG_HISTORY_UPLOAD_WORKERS, thread_name_prefix="log-history-upload")
+
+
+def _upload_history(record: Dict) -> bool:
+    try:
+        storage_api.log_history(**record)
+        return True
+    except Exception as ex:
+        logger.warning("Uploading history of session %s failed: %s", record["session_id"], ex)
+        return False
+
+
+def _write_histories(records: List[Dict]) -> List[Dict]:
+    latest = {}
+    for record in records:
+        latest[(record["session_id"], len(record["history"]))] = record
+    records = list(latest.values())
+
+    try:
+        uploaded = list(_upload_pool.map(_upload_history, records))
+    except RuntimeError:
+        # The pool takes no more work once the interpreter shuts down, e.g. when atexit flushes
+        uploaded = [_upload_history(record) for record in records]
+    return [record for record, ok in zip(records, uploaded) if not ok]
+
+
+def _write_usage(rows: List[Dict]) -> List[Dict]:
+    return sql_api.log_usage_batch(rows)
+
+
+_history_queue = _WriteBehindQueue("history", _write_histories)
+_usage_queue = _WriteBehindQueue("usage", _write_usage)
+
+
+def log_history(
+    session_id: str,
+    oid_hashed: str,
+    chat_type: str,
+    history: list,
+    bucket_name: str,
+    context: Optional[str] = None,
+) -> None:
+    """Enqueues the upload of a chat history, same arguments as storage_api.log_history."""
+    _history_queue.put({
+        "session_id": session_id,
+        "oid_hashed": oid_hashed,
+        "chat_type": chat_type,
+        "history": list(history),
+        "bucket_name": bucket_name,
+        "context": context,
+    })
+
+
+def log_usage(
+    oid_hashed: str,
+    session_id: str,
+    chat_type: str,
+    num_token_prompt: int | None,
+    num_token_response: int | None,
+    response_time: int,
+    time_to_first_token: int | None = None,
+    num_token_saved: int | None = None,
+) -> None:
+    """Enqueues a usage row, same arguments as sql_api.log_usage."""
+    _usage_queue.put(sql_api.usage_data(
+        oid_hashed, session_id, chat_type, num_token_prompt, num_token_response, response_time, time_to_first_token, num_token_saved
+    ))
+
+
+_shutdown_lock = threading.Lock()
+_shut_down = False
+
+
+def shutdown(timeout: float = constants.LOG_SHUTDOWN_TIMEOUT_SECONDS) -> None:
+    """Drains both queues, waiting at most timeout seconds in total. Safe to call more than once."""
+    global _shut_down
+    with _shutdown_lock:
+        if _shut_down:
+            return
+        _shut_down = True
+    deadline = time.monotonic() + timeout
+    logger.info("Flushing log queues (history: %s, usage: %s)", _history_queue.depth(), _usage_queue.depth())
+    for log_queue in (_history_queue, _usage_queue):
+        log_queue.stop(deadline)
+    for log_queue in (_history_queue, _usage_queue):
+        log_queue.join(deadline)
+
+
+metrics.register_gauge("log_queue_depth", lambda: {"history": _history_queue.depth(), "usage": _usage_queue.depth()})
+# Fallback for runs without the FastAPI shutdown event, e.g. scripts
+atexit.register(shutdown)
@@ -0,0 +1,48 @@
+"""Process-wide in-memory metrics, exposed as JSON on GET /metrics.
+
+Counters and gauges are grouped by name and carry a single label, e.g.
+
+    metrics.increment("model_registry_hits", "gemini:europe-west3:gemini-1.5-pro-002")
+
+Gauges that are expensive to keep up to date (queue depths, cache sizes) can instead be
+registered as callbacks that are only evaluated when the metrics are read.
+"""
+import threading
+from collections import defaultdict
+from typing import Callable, Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+_gauges: Dict[str, Dict[str, float]] = defaultdict(dict)
+_gauge_callbacks: Dict[str, Callable[[], Dict[str, float] | float]] = {}
+
+
+def increment(name: str, label: str = "", value: float = 1) -> None:
+    with _lock:
+        _counters[name][label] += value
+
+
+def set_gauge(name: str, value: float, label: str = "") -> None:
+    with _lock:
+        _gauges[name][label] = value
+
+
+def register_gauge(name: str, callback: Callable[[], Dict[str, float] | float]) -> None:
+    """Registers a gauge whose value is computed by callback whenever the metrics are read."""
+    with _lock:
+        _gauge_callbacks[name] = callback
+
+
+def get_counter(name: str, label: str = "") -> float:
+    with _lock:
+        return _counters[name][label] if name in _counters else 0
+
+
+def snapshot() -> Dict:
+    with _lock:
+        counters = {name: dict(values) for name, values in _counters.items()}
+        gauges = {name: dict(values) for name, values in _gauges.items()}
+        callbacks = dict(_gauge_callbacks)
+    for name, callback in callbacks.items():
+        gauges[name] = callback()
+    return {"counters": counters, "gauges": gauges}
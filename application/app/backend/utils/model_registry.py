@@ -0,0 +1,195 @@
+"""Process-wide registry of warmed Vertex AI model objects.
+
+Building a GenerativeModel per request repeats the client setup, and CodeChatModel /
+ImageGenerationModel.from_pretrained additionally look up the model metadata every time.
+Model objects keep their location and lazily created gRPC clients, so they can be shared
+between requests and threads once they exist.
+
+vertexai.init mutates global SDK state, which races when requests for different regions
+construct models concurrently. Models are therefore only constructed here, under a lock,
+right after vertexai.init for the model's own project and region. from_pretrained reads that
+state during its metadata RPC, so the RPC runs under the lock as well.
+
+Hits are plain dict reads without any lock. A miss takes a per-key lock, so a model is built
+once, and then the init lock. Callers on the event loop use the async getters, which build
+missing models on a worker thread instead of blocking the loop on the locks and the RPC.
+
+Hits and misses are counted per key in the metrics module.
+"""
+import asyncio
+import hashlib
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+import vertexai
+from vertexai.generative_models import GenerativeModel, Tool
+from vertexai.language_models import CodeChatModel
+from vertexai.preview.vision_models import ImageGenerationModel
+
+from . import metrics
+
+# Guards vertexai.init and everything that reads the global SDK state it sets
+_init_lock = threading.Lock()
+# One lock per key, so that a model is only built once and misses for other keys do not wait
+_key_locks: Dict[Tuple, threading.Lock] = {}
+_key_locks_lock = threading.Lock()
+_models: Dict[Tuple, Any] = {}
+_labels: Dict[Tuple, str] = {}
+
+# (key, label, project_id, location, factory)
+_Spec = Tuple[Tuple, str, str, str, Callable[[], Any]]
+
+
+def _instruction_key(system_instruction: list | str | None) -> Hashable:
+    if isinstance(system_instruction, list):
+        return tuple(system_instruction)
+    return system_instruction
+
+
+def _label(kind: str, location: str, model_name: str, variant: Hashable = None) -> str:
+    label = f"{kind}:{location}:{model_name}"
+    if variant:
+        label += ":" + hashlib.sha1(repr(variant).encode()).hexdigest()[:8]
+    return label
+
+
+def _lookup(key: Tuple, label: str) -> Any:
+    model = _models.get(key)
+    if model is not None:
+        metrics.increment("model_registry_hits", label)
+    return model
+
+
+def _create(key: Tuple, label: str, project_id: str, location: str, factory: Callable[[], Any]) -> Any:
+    with _key_locks_lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        model = _models.get(key)
+        if model is not None:
+            # Built by another thread while this one waited for the key lock
+            metrics.increment("model_registry_hits", label)
+            return model
+
+        metrics.increment("model_registry_misses", label)
+        with _init_lock:
+            vertexai.init(project=project_id, location=location)
+            model = factory()
+        _labels[key] = label
+        _models[key] = model
+        return model
+
+
+def _get(spec: _Spec) -> Any:
+    model = _lookup(spec[0], spec[1])
+    return model if model is not None else _create(*spec)
+
+
+async def _get_async(spec: _Spec) -> Any:
+    model = _lookup(spec[0], spec[1])
+    return model if model is not None else await asyncio.to_thread(_create, *spec)
+
+
+def _generative_model_spec(
+    project_id: str,
+    location: str,
+    model_name: str,
+    system_instruction: list | str | None,
+    tools: List[Tool] | None,
+    tools_key: Hashable,
+) -> _Spec:
+    if tools and tools_key is None:
+        raise ValueError("tools_key is required when tools are given")
+    instruction_key = _instruction_key(system_instruction)
+    return (
+        ("gemini", project_id, location, model_name, instruction_key, tools_key),
+        _label("gemini", location, model_name, (instruction_key, tools_key)),
+        project_id,
+        location,
+        lambda: GenerativeModel(model_name, system_instruction=system_instruction, tools=tools),
+    )
+
+
+def _code_chat_model_spec(project_id: str, location: str, model_name: str) -> _Spec:
+    return (
+        ("codechat", project_id, location, model_name),
+        _label("codechat", location, model_name),
+        project_id,
+        location,
+        lambda: CodeChatModel.from_pretrained(model_name),
+    )
+
+
+def _image_generation_model_spec(project_id: str, location: str, model_name: str) -> _Spec:
+    return (
+        ("imagen", project_id, location, model_name),
+        _label("imagen", location, model_name),
+        project_id,
+        location,
+        lambda: ImageGenerationModel.from_pretrained(model_name),
+    )
+
+
+def get_generative_model(
+    project_id: str,
+    location: str,
+    model_name: str,
+    system_instruction: list | str | None = None,
+    tools: List[Tool] | None = None,
+    tools_key: Hashable = None,
+) -> GenerativeModel:
+    """Returns the shared GenerativeModel for the given region, model, system instruction and tools.
+
+    Args:
+        tools: Tools bound to the model, e.g. a Vertex AI Search retrieval tool.
+        tools_key: Hashable identity of the tools, required if tools are given.
+    """
+    return _get(_generative_model_spec(project_id, location, model_name, system_instruction, tools, tools_key))
+
+
+async def get_generative_model_async(
+    project_id: str,
+    location: str,
+    model_name: str,
+    system_instruction: list | str | None = None,
+    tools: List[Tool] | None = None,
+    tools_key: Hashable = None,
+) -> GenerativeModel:
+    """Variant of get_generative_model for the event loop, a missing model is built on a worker thread."""
+    return await _get_async(_generative_model_spec(project_id, location, model_name, system_instruction, tools, tools_key))
+
+
+def get_code_chat_model(project_id: str, location: str, model_name: str) -> CodeChatModel:
+    return _get(_code_chat_model_spec(project_id, location, model_name))
+
+
+async def get_code_chat_model_async(project_id: str, location: str, model_name: str) -> CodeChatModel:
+    return await _get_async(_code_chat_model_spec(project_id, location, model_name))
+
+
+def get_image_generation_model(project_id: str, location: str, model_name: str) -> ImageGenerationModel:
+    return _get(_image_generation_model_spec(project_id, location, model_name))
+
+
+async def get_image_generation_model_async(project_id: str, location: str, model_name: str) -> ImageGenerationModel:
+    return await _get_async(_image_generation_model_spec(project_id, location, model_name))
+
+
+def in_region(project_id: str, location: str, func: Callable[[], Any]) -> Any:
+    """Runs func right after vertexai.init for the given region, under the registry lock.
+
+    For SDK objects that are not kept in the registry but also pick up the region from the
+    global SDK state on construction, e.g. context cache requests and models bound to a cache.
+    func must only build local objects, RPCs belong outside, since the lock is shared with
+    every model construction.
+    """
+    with _init_lock:
+        vertexai.init(project=project_id, location=location)
+        return func()
+
+
+def registered_models() -> Dict[str, int]:
+    """Returns the labels of all registered models, used as gauge in the metrics."""
+    return {label: 1 for label in list(_labels.values())}
+
+
+metrics.register_gauge("model_registry_models", registered_models)
@@ -0,0 +1,86 @@
+"""Local pre-screen of prompts for personal data, run before the DLP API.
+
+The detector looks for the DEFAULT_INFO_TYPES with compiled regular expressions and known name
+lists. A local finding rejects the prompt without asking DLP, so it only reports narrowly
+confirmed matches: German phone numbers starting with +49, 0049 or an area code, street
+addresses with house number, postcode and city, and names following a salutation that are in
+the first or last name lists ("Frau Schmidt", "Herrn Dr. Jonas Becker"). "Frau Mitte 40" or
+"Zahlungsweg 2" are left to DLP. A prompt without local findings is not known to be free of
+personal data, it still has to be inspected by DLP.
+"""
+import re
+from typing import Callable, List, NamedTuple
+
+_STREET_SUFFIXES = r"(?:[Ss]traße|[Ss]trasse|[Ss]tr\.|[Ww]eg|[Aa]llee|[Pp]latz|[Gg]asse|[Rr]ing|[Dd]amm|[Uu]fer|[Cc]haussee|[Ss]teig|[Pp]fad)"
+_STREET_WORDS = r"(?:Straße|Strasse|Str\.|Weg|Allee|Platz|Gasse|Ring|Damm|Ufer|Chaussee|Steig|Pfad)"
+_CAPITALIZED = r"[A-ZÄÖÜ][a-zäöüß]+"
+
+_PHONE_PATTERN = re.compile(
+    # "+49 30 1234567", "0049 (0)30 123 45 67", "030/1234567", area codes never start with 0
+    r"(?<![\w+])"
+    r"(?:(?:\+49|0049)[\s\-/]?(?:\(0\)[\s\-/]?)?|0)"
+    r"[1-9]\d{1,4}(?:[\s\-/]?\d){4,11}"
+    r"(?![\w.,]\d)(?!\w)"
+)
+# Phone numbers inside an IBAN ("DE89 3704 0044 0532 0130 00") are not reported
+_IBAN_PATTERN = re.compile(r"\b[A-Z]{2}\d{2}(?:\s?[A-Z\d]{4}){2,7}(?:\s?[A-Z\d]{1,3})?\b")
+_STREET_PATTERN = re.compile(
+    # "Hauptstraße 5, 10115 Berlin", "Karl-Marx-Allee 12a 10178 Berlin", only with postcode and city
+    rf"(?<![\w-])(?:{_CAPITALIZED}\s{_STREET_WORDS}|[A-ZÄÖÜ][\wäöüß-]*?{_STREET_SUFFIXES})"
+    r"\s+\d{1,4}(?:\s?[a-zA-Z])?(?!\w)"
+    rf",?\s+\d{{5}}\s+{_CAPITALIZED}(?:[\s-]{_CAPITALIZED})?"
+)
+_SALUTATION_PATTERN = re.compile(
+    rf"\b(?:Herrn?|Frau|Hr\.|Fr\.)\s+(?:(?:Dr|Prof)\.\s+)*({_CAPITALIZED})(?:\s+({_CAPITALIZED}(?:-{_CAPITALIZED})?))?"
+)
+_MIN_PHONE_DIGITS = 9
+_MAX_PHONE_DIGITS = 15
+
+
+class LocalFinding(NamedTuple):
+    info_type: str
+    quote: str
+    start: int
+    end: int
+
+
+class PiiPrescreen:
+    """
+    Args:
+        is_first_name: Whether a capitalized word is a known first name.
+        is_last_name: Whether a capitalized word is a known last name.
+    """
+
+    def __init__(self, is_first_name: Callable[[str], bool], is_last_name: Callable[[str], bool]):
+        self.is_first_name = is_first_name
+        self.is_last_name = is_last_name
+
+    def _phone_findings(self, text: str) -> List[LocalFinding]:
+        ibans = [match.span() for match in _IBAN_PATTERN.finditer(text)]
+        findings = []
+        for match in _PHONE_PATTERN.finditer(text):
+            if any(start < match.end() and match.start() < end for start, end in ibans):
+                continue
+            digits = sum(char.isdigit() for char in match.group(0))
+            if _MIN_PHONE_DIGITS <= digits <= _MAX_PHONE_DIGITS:
+                findings.append(LocalFinding("PHONE_NUMBER", match.group(0), match.start(), match.end()))
+        return findings
+
+    def _name_findings(self, text: str) -> List[LocalFinding]:
+        findings = []
+        for match in _SALUTATION_PATTERN.finditer(text):
+            first, last = match.group(1), match.group(2)
+            if self.is_first_name(first):
+                findings.append(LocalFinding("FIRST_NAME", first, match.start(1), match.end(1)))
+                if last and self.is_last_name(last):
+                    findings.append(LocalFinding("LAST_NAME", last, match.start(2), match.end(2)))
+            elif self.is_last_name(first):
+                # "Frau Schmidt hat ...", the word after the name is not part of it
+                findings.append(LocalFinding("LAST_NAME", first, match.start(1), match.end(1)))
+        return findings
+
+    def findings(self, text: str) -> List[LocalFinding]:
+        findings = self._phone_findings(text) + self._name_findings(text)
+        for match in _STREET_PATTERN.finditer(text):
+            findings.append(LocalFinding("STREET_ADDRESS", match.group(0), match.start(), match.end()))
+        return sorted(findings, key=lambda finding: finding.start)
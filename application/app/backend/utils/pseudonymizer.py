@@ -0,0 +1,245 @@
+"""Pseudonymization of prompts and restoration of LLM answers.
+
+A PseudonymMapping holds the original values of one session and their pseudonyms in both
+directions. Replacing is done by a PatternReplacer, an Aho-Corasick automaton over all values
+of one direction, so a text is rewritten in a single pass regardless of the number of values.
+A StreamingRestorer applies the same matching to an answer streamed in chunks.
+"""
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import ttl_cache
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+class PatternReplacer:
+    """Replaces a fixed set of strings in one pass over the text.
+
+    Overlapping matches are resolved leftmost-longest, so "Anna Schmidt" wins over "Anna". A
+    value starting or ending with a word character only matches on a word boundary, "Anna"
+    is not replaced inside "Annabell".
+
+    Args:
+        replacements: Maps each string to its replacement.
+    """
+
+    def __init__(self, replacements: Dict[str, str]):
+        self.replacements = {value: replacement for value, replacement in replacements.items() if value}
+        # Per node: transitions, failure link, length of the value ending here (0 if none) and
+        # the next node on the failure chain where a value ends
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._length: List[int] = [0]
+        self._output: List[int] = [0]
+        for value in self.replacements:
+            self._add(value)
+        self._link()
+
+    def size_bytes(self) -> int:
+        return ttl_cache.deep_sizeof(vars(self))
+
+    def _add(self, value: str) -> None:
+        node = 0
+        for char in value:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._length.append(0)
+                self._output.append(0)
+            node = next_node
+        self._length[node] = len(value)
+
+    def _link(self) -> None:
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                fail_node = self._fail[child]
+                self._output[child] = fail_node if self._length[fail_node] else self._output[fail_node]
+                queue.append(child)
+
+    def _on_boundary(self, text: str, start: int, end: int) -> bool:
+        if _is_word_char(text[start]) and start > 0 and _is_word_char(text[start - 1]):
+            return False
+        if _is_word_char(text[end - 1]) and end < len(text) and _is_word_char(text[end]):
+            return False
+        return True
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, int]]:
+        """Yields the (start, end) of the non-overlapping matches in the text."""
+        if not self.replacements:
+            return
+        # End of the longest match per start position
+        longest: Dict[int, int] = {}
+        goto, fail, length, output = self._goto, self._fail, self._length, self._output
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            match = node if length[node] else output[node]
+            while match:
+                start = position + 1 - length[match]
+                # Matches are found by increasing end, a later one for the same start is longer
+                if self._on_boundary(text, start, position + 1):
+                    longest[start] = position + 1
+                match = output[match]
+        end = 0
+        for start in sorted(longest):
+            if start >= end:
+                end = longest[start]
+                yield start, end
+
+    def replace(self, text: str) -> Tuple[str, int]:
+        """Returns the text with all matches replaced and the number of replacements."""
+        parts = []
+        position = 0
+        count = 0
+        for start, end in self.finditer(text):
+            parts.append(text[position:start])
+            parts.append(self.replacements[text[start:end]])
+            position = end
+            count += 1
+        if not count:
+            return text, 0
+        parts.append(text[position:])
+        return "".join(parts), count
+
+
+class StreamingRestorer:
+    """Reverts a pseudonymization mapping on a streamed LLM answer.
+
+    Matches are found by a PatternReplacer with the same word boundaries as in
+    dlp_api.restore_original_data, so a streamed answer is restored exactly like the complete
+    one. Pseudonyms may be split across chunk boundaries and whether a pseudonym at the end of
+    a chunk is on a word boundary depends on the next character, so the restorer holds back the
+    longest tail of the received text that could still become or extend a pseudonym and only
+    releases it once the next chunk (or flush) decides it.
+
+    Args:
+        replacement_mapping: The mapping returned by dlp_api.pseudonymize_text, pseudonym to
+            [original value, info type].
+    """
+
+    def __init__(self, replacement_mapping: Optional[Dict[str, List[str]]]):
+        self._replacer = PatternReplacer({pseudonym: original[0] for pseudonym, original in (replacement_mapping or {}).items()})
+        pseudonyms = self._replacer.replacements
+        self._prefixes = {pseudonym[:length] for pseudonym in pseudonyms for length in range(1, len(pseudonym) + 1)}
+        self._max_len = max(map(len, pseudonyms), default=0)
+        self._buffer = ""
+        # The last released character, decides the word boundary at the start of the buffer
+        self._previous = ""
+
+    def _held_back_length(self) -> int:
+        for length in range(min(self._max_len, len(self._buffer)), 0, -1):
+            if self._buffer[-length:] in self._prefixes:
+                return length
+        return 0
+
+    def _release(self, cut: int) -> str:
+        out = []
+        pos = 0
+        offset = len(self._previous)
+        for start, end in self._replacer.finditer(self._previous + self._buffer):
+            start, end = start - offset, end - offset
+            if start < 0:
+                continue
+            if start >= cut:
+                break
+            out.append(self._buffer[pos:start])
+            out.append(self._replacer.replacements[self._buffer[start:end]])
+            pos = end
+        cut = max(cut, pos)
+        out.append(self._buffer[pos:cut])
+        if cut:
+            self._previous = self._buffer[cut - 1]
+        self._buffer = self._buffer[cut:]
+        return "".join(out)
+
+    def feed(self, chunk: str) -> str:
+        """Adds a chunk and returns the text that can be sent to the client."""
+        self._buffer += chunk
+        return self._release(len(self._buffer) - self._held_back_length())
+
+    def flush(self) -> str:
+        """Returns the remaining held back text at the end of the stream."""
+        return self._release(len(self._buffer))
+
+
+class PseudonymMapping:
+    """Bidirectional mapping of the original values of one session and their pseudonyms.
+
+    An original value keeps its pseudonym for the lifetime of the mapping, so the same real
+    name is replaced by the same fake name in every turn of a session.
+
+    Args:
+        make_pseudonym: Returns a new pseudonym for (original value, info type).
+        max_attempts: Attempts to draw a pseudonym that is neither in use nor an original value.
+    """
+
+    def __init__(self, make_pseudonym: Callable[[str, str], str], max_attempts: int = 10):
+        self.make_pseudonym = make_pseudonym
+        self.max_attempts = max_attempts
+        self._pseudonyms: Dict[str, str] = {}
+        self._originals: Dict[str, Tuple[str, str]] = {}
+        self._pseudonymizer: Optional[PatternReplacer] = None
+        self._restorer: Optional[PatternReplacer] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pseudonyms)
+
+    def _new_pseudonym(self, original: str, info_type: str) -> str:
+        for _ in range(self.max_attempts):
+            pseudonym = self.make_pseudonym(original, info_type)
+            if pseudonym and pseudonym != original and pseudonym not in self._originals and pseudonym not in self._pseudonyms:
+                return pseudonym
+        # Numbered, so that restoring stays unambiguous
+        return f"{pseudonym} {len(self._originals) + 1}"
+
+    def add(self, values: Iterable[Tuple[str, str]]) -> None:
+        """Assigns pseudonyms to the (original value, info type) pairs that do not have one yet."""
+        with self._lock:
+            for original, info_type in values:
+                if not original or original in self._pseudonyms:
+                    continue
+                pseudonym = self._new_pseudonym(original, info_type)
+                self._pseudonyms[original] = pseudonym
+                self._originals[pseudonym] = (original, info_type)
+                self._pseudonymizer = None
+                self._restorer = None
+
+    def pseudonymize(self, text: str) -> Tuple[str, int]:
+        """Replaces all known original values in the text by their pseudonyms."""
+        with self._lock:
+            if self._pseudonymizer is None:
+                self._pseudonymizer = PatternReplacer(self._pseudonyms)
+            pseudonymizer = self._pseudonymizer
+        return pseudonymizer.replace(text)
+
+    def restore(self, text: str) -> Tuple[str, int]:
+        """Replaces all known pseudonyms in the text by their original values."""
+        with self._lock:
+            if self._restorer is None:
+                self._restorer = PatternReplacer({pseudonym: original for pseudonym, (original, _) in self._originals.items()})
+            restorer = self._restorer
+        return restorer.replace(text)
+
+    def replacement_mapping(self) -> Dict[str, List[str]]:
+        """Returns the mapping in the format of dlp_api.pseudonymize_text, pseudonym to [original value, info type]."""
+        with self._lock:
+            return {pseudonym: [original, info_type] for pseudonym, (original, info_type) in self._originals.items()}
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            replacers = [replacer for replacer in (self._pseudonymizer, self._restorer) if replacer is not None]
+            return ttl_cache.deep_sizeof((self._pseudonyms, self._originals)) + sum(replacer.size_bytes() for replacer in replacers)
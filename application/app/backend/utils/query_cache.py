@@ -0,0 +1,108 @@
+"""Result cache for the search queries of /agent-builder/query-datastore.
+
+Many employees ask the same questions in near-identical wording, so results are cached under
+the normalized query: case-folded, umlauts folded (ä -> ae, ß -> ss), whitespace collapsed and
+punctuation at either end dropped. Entries expire after QUERY_CACHE_TTL_SECONDS and are evicted
+least recently used first.
+
+The ingestion function rewrites the marker blob QUERY_CACHE_GENERATION_MARKER after every
+import into the data store. Its GCS generation is checked at most every
+QUERY_CACHE_GENERATION_CHECK_SECONDS, and the cache is cleared when it changed, so new documents
+show up in the answers without waiting for the TTL.
+"""
+import asyncio
+import logging
+import os
+import time
+import unicodedata
+from typing import Callable, Optional
+
+from . import constants, metrics, storage_api, ttl_cache
+
+logger = logging.getLogger(__name__)
+
+_UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+_EDGE_PUNCTUATION = " \t\n?!.,;:\"'„“”»«"
+
+
+def normalize_query(query: str) -> str:
+    text = unicodedata.normalize("NFC", query).casefold().translate(_UMLAUTS)
+    return " ".join(text.split()).strip(_EDGE_PUNCTUATION)
+
+
+def _hit_rate() -> float:
+    hits = metrics.get_counter("cache_hits", "datastore_queries")
+    total = hits + metrics.get_counter("cache_misses", "datastore_queries")
+    return hits / total if total else 0.0
+
+
+metrics.register_gauge("datastore_query_cache_hit_rate", _hit_rate)
+
+
+class QueryCache:
+    """
+    Args:
+        generation: Returns the current generation of the data store, None if unknown. The
+            cache is cleared whenever the returned value changes.
+        clock: Time source in seconds, replaceable in tests.
+    """
+
+    def __init__(self, generation: Optional[Callable[[], Optional[str]]] = None, clock: Callable[[], float] = time.monotonic):
+        self.generation = generation
+        self.clock = clock
+        self._results = ttl_cache.TTLCache(
+            name="datastore_queries",
+            max_entries=constants.QUERY_CACHE_MAX_ENTRIES,
+            ttl_seconds=constants.QUERY_CACHE_TTL_SECONDS,
+            max_bytes=constants.QUERY_CACHE_MAX_BYTES,
+            clock=clock,
+        )
+        self._generation: Optional[str] = None
+        self._next_check = 0.0
+
+    async def _check_generation(self) -> None:
+        if self.generation is None or self.clock() < self._next_check:
+            return
+        # Set before the check, concurrent requests do not check again
+        self._next_check = self.clock() + constants.QUERY_CACHE_GENERATION_CHECK_SECONDS
+        try:
+            generation = await asyncio.to_thread(self.generation)
+        except Exception as e:
+            logger.warning("Reading the data store generation failed: %s", e)
+            metrics.increment("datastore_query_cache_errors", "generation")
+            return
+        if generation != self._generation:
+            if self._generation is not None:
+                logger.info("Data store generation changed to %s, clearing the query cache", generation)
+                metrics.increment("datastore_query_cache_invalidations")
+            self._results.clear()
+            self._generation = generation
+
+    async def get(self, datastore_id: str, query: str) -> Optional[str]:
+        """Returns the cached result of the query, None if there is none."""
+        await self._check_generation()
+        return self._results.get((datastore_id, normalize_query(query)))
+
+    def set(self, datastore_id: str, query: str, result: str) -> None:
+        self._results.set((datastore_id, normalize_query(query)), result)
+
+
+def _gcs_generation(bucket_name: str) -> Callable[[], Optional[str]]:
+    bucket = storage_api.storage_client.bucket(bucket_name)
+
+    def generation() -> Optional[str]:
+        blob = bucket.get_blob(constants.QUERY_CACHE_GENERATION_MARKER)
+        return str(blob.generation) if blob is not None else None
+
+    return generation
+
+
+_cache: Optional[QueryCache] = None
+
+
+def get_cache() -> QueryCache:
+    global _cache
+    if _cache is None:
+        bucket_name = os.environ.get("DATASTORE_GENERATION_BUCKET")
+        _cache = QueryCache(_gcs_generation(bucket_name) if bucket_name else None)
+    return _cache
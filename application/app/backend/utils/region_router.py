@@ -0,0 +1,225 @@
+"""Health-scored routing of Vertex AI calls across the EU regions.
+
+Every model family (Gemini, Codechat, Imagen) has its own quotas per region, so there is
+one RegionRouter per family. A router tracks per region
+
+    - the EWMA latency of successful calls,
+    - the EWMA error rate,
+    - the quota errors (429 / ResourceExhausted) within the last quota window,
+    - the number of calls in flight,
+
+and opens a circuit breaker for a region as soon as its quota is exhausted. While the breaker
+is open the region is skipped, after the cooldown a single probe call is let through
+(half-open). A failed probe doubles the cooldown, a successful one closes the breaker.
+
+The first region of a request is drawn at random, weighted by the remaining headroom of the
+healthy regions, so load is spread instead of always hitting Frankfurt first.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, TypeVar
+
+from google.api_core.exceptions import ResourceExhausted
+
+from . import constants
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class _RegionState:
+    def __init__(self, name: str):
+        self.name = name
+        self.ewma_latency = constants.REGION_INITIAL_LATENCY_SECONDS
+        self.error_rate = 0.0
+        self.quota_errors = deque()
+        self.in_flight = 0
+        self.breaker_open_until = 0.0
+        self.cooldown = constants.REGION_BREAKER_COOLDOWN_SECONDS
+        self.probing = False
+        self.calls = 0
+        self.failures = 0
+
+
+class RegionRouter:
+    """Orders the regions of one model family by health and records the outcome of each call.
+
+    Args:
+        name: Name of the model family, used for logging.
+        regions: The regions to route to, by default constants.AVAILABLE_REGIONS.
+    """
+
+    def __init__(self, name: str, regions: List[str] | None = None):
+        self.name = name
+        self._states = {region: _RegionState(region) for region in (regions or constants.AVAILABLE_REGIONS)}
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._failed_attempts = 0
+
+    def _expire_quota_errors(self, state: _RegionState, now: float) -> None:
+        while state.quota_errors and state.quota_errors[0] < now - constants.REGION_QUOTA_WINDOW_SECONDS:
+            state.quota_errors.popleft()
+
+    def _is_available(self, state: _RegionState, now: float) -> bool:
+        if state.breaker_open_until == 0:
+            return True
+        if now < state.breaker_open_until:
+            return False
+        # Half-open: only a single probe at a time
+        return not state.probing
+
+    def _headroom(self, state: _RegionState, now: float) -> float:
+        self._expire_quota_errors(state, now)
+        quota_headroom = 1 / (1 + len(state.quota_errors))
+        return quota_headroom * (1 - state.error_rate) / (state.ewma_latency * (1 + state.in_flight))
+
+    def ordered_regions(self) -> List[str]:
+        """Returns the regions to try for one request, best first. Regions with an open breaker are left out."""
+        with self._lock:
+            now = time.monotonic()
+            available = [state for state in self._states.values() if self._is_available(state, now)]
+            if not available:
+                # All breakers are open, only try the region that recovers first
+                return [min(self._states.values(), key=lambda state: state.breaker_open_until).name]
+
+            headroom = {state.name: max(self._headroom(state, now), 1e-6) for state in available}
+            first = random.choices(available, weights=[headroom[state.name] for state in available])[0]
+            rest = sorted((state for state in available if state is not first), key=lambda state: headroom[state.name], reverse=True)
+            return [first.name] + [state.name for state in rest]
+
+    def acquire(self, region: str) -> bool:
+        """Marks a call to the region as started. Returns False if the region must not be called right now."""
+        with self._lock:
+            state = self._states[region]
+            now = time.monotonic()
+            if state.breaker_open_until != 0:
+                if now < state.breaker_open_until or state.probing:
+                    return False
+                state.probing = True
+            state.in_flight += 1
+            state.calls += 1
+            return True
+
+    def record_success(self, region: str, latency: float) -> None:
+        with self._lock:
+            state = self._states[region]
+            alpha = constants.REGION_EWMA_ALPHA
+            state.in_flight -= 1
+            state.ewma_latency = alpha * latency + (1 - alpha) * state.ewma_latency
+            state.error_rate = (1 - alpha) * state.error_rate
+            if state.breaker_open_until != 0:
+                logger.info("Closing circuit breaker of %s in %s", self.name, region)
+            state.breaker_open_until = 0.0
+            state.cooldown = constants.REGION_BREAKER_COOLDOWN_SECONDS
+            state.probing = False
+
+    def release(self, region: str) -> None:
+        """Ends a call that was abandoned without an outcome, e.g. because the client disconnected.
+
+        The health of the region is left as it is, a half-open region can be probed again.
+        """
+        with self._lock:
+            state = self._states[region]
+            state.in_flight -= 1
+            state.probing = False
+
+    def record_failure(self, region: str, quota_exceeded: bool) -> None:
+        with self._lock:
+            state = self._states[region]
+            alpha = constants.REGION_EWMA_ALPHA
+            now = time.monotonic()
+            state.in_flight -= 1
+            state.failures += 1
+            state.error_rate = alpha + (1 - alpha) * state.error_rate
+            self._failed_attempts += 1
+            if not quota_exceeded:
+                state.probing = False
+                return
+
+            state.quota_errors.append(now)
+            self._expire_quota_errors(state, now)
+            if state.probing:
+                state.cooldown = min(state.cooldown * 2, constants.REGION_BREAKER_MAX_COOLDOWN_SECONDS)
+            already_open = now < state.breaker_open_until
+            if not already_open and (state.probing or len(state.quota_errors) >= constants.REGION_BREAKER_QUOTA_ERRORS):
+                state.breaker_open_until = now + state.cooldown
+                logger.warning("Opening circuit breaker of %s in %s for %ss", self.name, region, state.cooldown)
+            state.probing = False
+
+    def count_request(self) -> None:
+        with self._lock:
+            self._requests += 1
+
+    async def run(self, call: Callable[[str], Awaitable[T]]) -> T:
+        """Runs call(region) in the best region and fails over to the next one on quota errors.
+
+        Raises:
+            ResourceExhausted: If the quota of every tried region is exceeded or all breakers are open.
+        """
+        self.count_request()
+        last_error = None
+        for region in self.ordered_regions():
+            if not self.acquire(region):
+                continue
+            start_time = time.monotonic()
+            try:
+                result = await call(region)
+            except ResourceExhausted as re:
+                logger.warning("Quota of %s exceeded in %s: %s", self.name, region, re)
+                self.record_failure(region, quota_exceeded=True)
+                last_error = re
+                continue
+            except Exception:
+                self.record_failure(region, quota_exceeded=False)
+                raise
+            except BaseException:
+                # Cancelled, e.g. because the client disconnected, says nothing about the region
+                self.release(region)
+                raise
+            self.record_success(region, time.monotonic() - start_time)
+            return result
+        raise last_error or ResourceExhausted(f"No region available for {self.name}")
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            now = time.monotonic()
+            regions = {}
+            for state in self._states.values():
+                self._expire_quota_errors(state, now)
+                regions[state.name] = {
+                    "ewma_latency_seconds": round(state.ewma_latency, 3),
+                    "error_rate": round(state.error_rate, 3),
+                    "quota_errors_in_window": len(state.quota_errors),
+                    "in_flight": state.in_flight,
+                    "breaker_open": now < state.breaker_open_until,
+                    "calls": state.calls,
+                    "failures": state.failures,
+                }
+            return {
+                "requests": self._requests,
+                "failed_attempts": self._failed_attempts,
+                "failed_attempts_per_request": self._failed_attempts / self._requests if self._requests else 0.0,
+                "regions": regions,
+            }
+
+
+_routers: Dict[str, RegionRouter] = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(name: str) -> RegionRouter:
+    """Returns the process-wide router of a model family, e.g. "gemini", "codechat" or "imagen"."""
+    with _routers_lock:
+        if name not in _routers:
+            _routers[name] = RegionRouter(name)
+        return _routers[name]
+
+
+def snapshot() -> Dict:
+    with _routers_lock:
+        routers = list(_routers.values())
+    return {router.name: router.snapshot() for router in routers}
@@ -0,0 +1,214 @@
+"""BM25 retrieval over the passages of a provided document.
+
+A document is split into passages once when it is loaded: numbered entries such as
+<FRAGE3>...</FRAGE3><ANTWORT3>...</ANTWORT3> become one passage each, all other text is packed
+line by line into passages of about PROVIDED_DOC_PASSAGE_CHARS with a small overlap. Passages
+keep the top-level section they belong to (e.g. <ZUSAMMENFASSUNG>), so the rendered excerpts
+still carry the tags the system instructions refer to.
+
+The BM25 weights of all terms and passages are precomputed into one NumPy matrix, scoring a
+question is a sum over the rows of its terms. Terms are lowercased words without German stop
+words, reduced by a light suffix stemmer.
+"""
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from . import constants
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+# Top-level sections such as <ZUSAMMENFASSUNG>...</ZUSAMMENFASSUNG>
+_SECTION_PATTERN = re.compile(r"<([A-ZÄÖÜ_]+)>(.*?)</\1>", re.S)
+# Numbered entries such as <FRAGE3>...</FRAGE3>, entries with the same number form one passage
+_ENTRY_PATTERN = re.compile(r"<([A-ZÄÖÜ_]+?)(\d+)>.*?</\1\2>", re.S)
+_SEPARATOR = "[...]"
+
+_STOPWORDS = frozenset("""
+    aber alle allem allen aller alles als also am an ans auch auf aus bei beim bin bis bist da
+    damit dann das dass dem den denn der des dessen die dies diese diesem diesen dieser dieses du
+    durch ein eine einem einen einer eines er es etwa euch euer für gegen hat hatte hätte haben
+    hier ich ihr ihre ihrem ihren ihrer im in ins ist ja jede jedem jeden jeder jedes kann kein
+    keine mit man mehr mich mir muss nach nicht noch nun nur ob oder ohne sehr sein seine sich
+    sie sind so soll sollen über um und uns unser unsere unter vom von vor war waren was welche
+    welchem welchen welcher welches wenn werden wie wir wird wo wurde zu zum zur zwischen
+""".split())
+# Longest first, at most one suffix is removed
+_SUFFIXES = ("ungen", "ung", "ern", "en", "er", "es", "em", "e")
+_MIN_STEM = 4
+
+
+@dataclass(frozen=True)
+class Passage:
+    position: int
+    section: Optional[str]
+    text: str
+
+
+def _stem(word: str) -> str:
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= _MIN_STEM:
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Returns the index terms of text."""
+    return [_stem(word) for word in _TOKEN_PATTERN.findall(text.lower()) if len(word) > 1 and word not in _STOPWORDS]
+
+
+def _lines(text: str) -> List[str]:
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def _pack_lines(lines: Sequence[str]) -> Iterator[str]:
+    """Packs lines into passages of about PROVIDED_DOC_PASSAGE_CHARS, repeating the last lines of a passage."""
+    passage: List[str] = []
+    size = 0
+    for line in lines:
+        if passage and size + len(line) > constants.PROVIDED_DOC_PASSAGE_CHARS:
+            yield "\n".join(passage)
+            overlap: List[str] = []
+            overlap_size = 0
+            for previous in reversed(passage):
+                if overlap_size + len(previous) > constants.PROVIDED_DOC_PASSAGE_OVERLAP_CHARS:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += len(previous) + 1
+            passage, size = overlap, overlap_size
+        passage.append(line)
+        size += len(line) + 1
+    if passage:
+        yield "\n".join(passage)
+
+
+def _section_passages(text: str) -> List[str]:
+    """Returns one passage per numbered entry, the text around the entries is packed line by line."""
+    passages: List[str] = []
+    entries: Dict[str, int] = {}
+    pending: List[str] = []
+    end = 0
+    for match in _ENTRY_PATTERN.finditer(text):
+        pending.extend(_lines(text[end:match.start()]))
+        end = match.end()
+        entry = "\n".join(_lines(match.group(0)))
+        number = match.group(2)
+        if number in entries:
+            # <ANTWORT3> joins the passage of <FRAGE3>
+            passages[entries[number]] += "\n" + entry
+            continue
+        passages.extend(_pack_lines(pending))
+        pending = []
+        entries[number] = len(passages)
+        passages.append(entry)
+    pending.extend(_lines(text[end:]))
+    passages.extend(_pack_lines(pending))
+    return passages
+
+
+def chunk_document(content: str) -> List[Passage]:
+    """Splits a document into passages in document order."""
+    parts = []
+    end = 0
+    for match in _SECTION_PATTERN.finditer(content):
+        parts.append((None, content[end:match.start()]))
+        parts.append((match.group(1), match.group(2)))
+        end = match.end()
+    parts.append((None, content[end:]))
+
+    passages = []
+    for section, text in parts:
+        for passage in _section_passages(text):
+            passages.append(Passage(len(passages), section, passage))
+    return passages
+
+
+class RetrievalIndex:
+    """BM25 index over the passages of one document.
+
+    Args:
+        passages: The passages of the document, see chunk_document.
+    """
+
+    def __init__(self, passages: Sequence[Passage]):
+        self.passages = list(passages)
+        self.vocabulary: Dict[str, int] = {}
+        rows, columns, counts = [], [], []
+        lengths = np.zeros(len(self.passages), dtype=np.float32)
+        for column, passage in enumerate(self.passages):
+            terms = tokenize(passage.text)
+            lengths[column] = len(terms)
+            for term, count in Counter(terms).items():
+                rows.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                columns.append(column)
+                counts.append(count)
+
+        # One row per term, so scoring a question only touches the rows of its terms
+        tf = np.zeros((len(self.vocabulary), len(self.passages)), dtype=np.float32)
+        tf[rows, columns] = counts
+        df = np.count_nonzero(tf, axis=1)
+        idf = np.log1p((len(self.passages) - df + 0.5) / (df + 0.5)).astype(np.float32)
+        k1, b = constants.PROVIDED_DOC_BM25_K1, constants.PROVIDED_DOC_BM25_B
+        length_norm = k1 * (1 - b + b * lengths / max(float(lengths.mean()) if len(lengths) else 0.0, 1.0))
+        self._weights = idf[:, None] * tf * (k1 + 1) / (tf + length_norm[None, :])
+
+    @property
+    def size_bytes(self) -> int:
+        return self._weights.nbytes
+
+    def scores(self, query: str) -> np.ndarray:
+        """Returns the BM25 score of every passage for query."""
+        rows = [self.vocabulary[term] for term in set(tokenize(query)) if term in self.vocabulary]
+        if not rows:
+            return np.zeros(len(self.passages), dtype=np.float32)
+        return self._weights[rows].sum(axis=0)
+
+    def search(self, query: str, top_k: int, max_chars: Optional[int] = None) -> List[Passage]:
+        """Returns up to top_k passages matching query, best first.
+
+        Args:
+            query: The question.
+            top_k: Maximum number of passages.
+            max_chars: Stops before the passages exceed this number of characters.
+        """
+        scores = self.scores(query)
+        top_k = min(top_k, int(np.count_nonzero(scores > 0)))
+        if top_k == 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+
+        passages = []
+        size = 0
+        for position in best:
+            passage = self.passages[position]
+            if max_chars is not None and passages and size + len(passage.text) > max_chars:
+                break
+            passages.append(passage)
+            size += len(passage.text)
+        return passages
+
+
+def render_passages(passages: Sequence[Passage]) -> str:
+    """Renders passages in document order, wrapped in the tags of their sections."""
+    parts = []
+    section = None
+    for passage in sorted(passages, key=lambda passage: passage.position):
+        if passage.section != section:
+            if section is not None:
+                parts.append(f"</{section}>")
+            if passage.section is not None:
+                parts.append(f"<{passage.section}>")
+            section = passage.section
+        elif parts:
+            parts.append(_SEPARATOR)
+        parts.append(passage.text)
+    if section is not None:
+        parts.append(f"</{section}>")
+    return "\n".join(parts)
+
+
+def build_index(content: str) -> RetrievalIndex:
+    return RetrievalIndex(chunk_document(content))
@@ -0,0 +1,190 @@
+"""Server-side chat histories, keyed by oid_hashed and session_id.
+
+Clients that set use_session_store on their question only send the new question and receive
+only the new turn, the history is kept here. Clients that send the full history every time
+keep working unchanged and do not touch the store. Histories are keyed by user and session, a
+session_id alone does not give access to the history of another user.
+
+Histories are held in an in-process LRU with TTL. With a shared backend configured, every
+history carries the generation of its shared copy. The local copy is only used while the
+shared copy still has the same generation, otherwise another instance served a newer turn and
+the history is read again. Writes are conditional on the generation that was read; if another
+instance wrote in between, the new turns are appended to its history and written again. The
+shared backend is pluggable, GcsSessionBackend stores one JSON object per session and is used
+if SESSION_STORE_BUCKET is set.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Iterable, List, NamedTuple, Optional, Protocol, Tuple
+from urllib.parse import quote
+
+from google.api_core.exceptions import PreconditionFailed
+
+from . import constants, metrics, storage_api, ttl_cache
+from backend.schemas.schemas import Conversation
+
+logger = logging.getLogger(__name__)
+
+# (oid_hashed, session_id)
+SessionKey = Tuple[str, str]
+
+
+class StoredHistory(NamedTuple):
+    turns: List[Conversation]
+    # Generation of the shared copy, 0 if there is none
+    generation: int
+
+
+class SessionHistory(list):
+    """The turns of a session as returned by SessionStore.load.
+
+    Besides the turns it remembers what they were loaded from, SessionStore.save writes
+    conditionally on that generation and treats the turns after loaded_turns as new.
+    """
+
+    def __init__(self, turns: Iterable[Conversation] = (), generation: int = 0):
+        super().__init__(turns)
+        self.generation = generation
+        self.loaded_turns = len(self)
+
+
+class SessionBackend(Protocol):
+    def generation(self, key: SessionKey) -> int:
+        ...
+
+    def load(self, key: SessionKey) -> StoredHistory:
+        ...
+
+    def save(self, key: SessionKey, turns: List[Conversation], if_generation_match: int) -> int:
+        """Writes the turns if the shared copy still has the given generation, returns the new generation.
+
+        Raises:
+            PreconditionFailed: If the shared copy has another generation.
+        """
+        ...
+
+
+class GcsSessionBackend:
+    """Stores the history of a session as {SESSION_STORE_PREFIX}/{oid_hashed}/{session_id}.json in a bucket.
+
+    The object generation is the generation of the history, a generation of 0 means the object
+    must not exist yet.
+    """
+
+    def __init__(self, bucket_name: str):
+        self.bucket = storage_api.storage_client.bucket(bucket_name)
+
+    def _blob_name(self, key: SessionKey) -> str:
+        oid_hashed, session_id = key
+        return f"{constants.SESSION_STORE_PREFIX}/{quote(oid_hashed, safe='')}/{quote(session_id, safe='')}.json"
+
+    def generation(self, key: SessionKey) -> int:
+        blob = self.bucket.get_blob(self._blob_name(key))
+        return blob.generation if blob is not None else 0
+
+    def load(self, key: SessionKey) -> StoredHistory:
+        blob = self.bucket.get_blob(self._blob_name(key))
+        if blob is None:
+            return StoredHistory([], 0)
+        # The blob carries its generation, so exactly that generation is downloaded
+        turns = [Conversation(**turn) for turn in json.loads(blob.download_as_text())]
+        return StoredHistory(turns, blob.generation)
+
+    def save(self, key: SessionKey, turns: List[Conversation], if_generation_match: int) -> int:
+        blob = self.bucket.blob(self._blob_name(key))
+        blob.upload_from_string(
+            json.dumps([turn.dict() for turn in turns], ensure_ascii=False),
+            content_type="application/json",
+            if_generation_match=if_generation_match,
+        )
+        return blob.generation
+
+
+class SessionStore:
+    """
+    Args:
+        backend: Shared backend, None to keep the histories in this process only.
+    """
+
+    def __init__(self, backend: Optional[SessionBackend] = None):
+        self.backend = backend
+        self._histories = ttl_cache.TTLCache(
+            name="session_store",
+            max_entries=constants.SESSION_STORE_MAX_SESSIONS,
+            ttl_seconds=constants.SESSION_STORE_TTL_SECONDS,
+            max_bytes=constants.SESSION_STORE_MAX_BYTES,
+        )
+
+    async def _load_shared(self, key: SessionKey, stored: Optional[StoredHistory]) -> Optional[StoredHistory]:
+        """Returns the local copy if it is current, otherwise the shared copy."""
+        if stored is not None:
+            generation = await asyncio.to_thread(self.backend.generation, key)
+            if generation == stored.generation:
+                return stored
+            # Another instance served a newer turn of the session
+            metrics.increment("session_store_stale")
+        stored = await asyncio.to_thread(self.backend.load, key)
+        self._histories.set(key, stored)
+        return stored
+
+    async def load(self, oid_hashed: str, session_id: str) -> SessionHistory:
+        """Returns a copy of the history of the session, empty for a new session."""
+        key = (oid_hashed, session_id)
+        stored = self._histories.get(key)
+        if self.backend is not None:
+            try:
+                stored = await self._load_shared(key, stored)
+            except Exception as e:
+                # The local copy, if any, is still the best guess, save detects if it is stale
+                logger.warning("Loading session %s from the shared store failed: %s", session_id, e)
+                metrics.increment("session_store_errors", "load")
+        if stored is None:
+            return SessionHistory()
+        return SessionHistory(stored.turns, stored.generation)
+
+    async def save(self, oid_hashed: str, session_id: str, history: SessionHistory) -> None:
+        """Stores the history of the session, returns once the shared backend has it.
+
+        If another instance wrote the session since history was loaded, the new turns of history
+        are appended to the turns written by the other instance.
+        """
+        key = (oid_hashed, session_id)
+        turns = list(history)
+        if self.backend is None:
+            self._histories.set(key, StoredHistory(turns, 0))
+            return
+
+        new_turns = turns[history.loaded_turns:]
+        generation = history.generation
+        for _ in range(constants.SESSION_STORE_SAVE_ATTEMPTS):
+            try:
+                generation = await asyncio.to_thread(self.backend.save, key, turns, generation)
+                self._histories.set(key, StoredHistory(turns, generation))
+                return
+            except PreconditionFailed:
+                metrics.increment("session_store_conflicts")
+                try:
+                    latest = await asyncio.to_thread(self.backend.load, key)
+                except Exception as e:
+                    logger.warning("Reloading session %s from the shared store failed: %s", session_id, e)
+                    break
+                turns, generation = latest.turns + new_turns, latest.generation
+            except Exception as e:
+                logger.warning("Saving session %s to the shared store failed: %s", session_id, e)
+                break
+        metrics.increment("session_store_errors", "save")
+        # The next load reads the shared copy again
+        self._histories.invalidate(key)
+
+
+_store: Optional[SessionStore] = None
+
+
+def get_store() -> SessionStore:
+    global _store
+    if _store is None:
+        bucket_name = os.environ.get("SESSION_STORE_BUCKET")
+        _store = SessionStore(GcsSessionBackend(bucket_name) if bucket_name else None)
+    return _store
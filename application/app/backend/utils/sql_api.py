@@ -1,14 +1,41 @@
 from sqlmodel import SQLModel, create_engine, Session
-from sqlalchemy import DateTime
+from sqlalchemy import DateTime, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DataError, IntegrityError
+import logging
 import os
+import threading
 from contextlib import contextmanager
 from backend.schemas.sql_schemas.cosi_usage import CosiUsage
-from typing import Dict
+from typing import Dict, List
+from . import constants
+
+logger = logging.getLogger(__name__)
+
+_engine: Engine | None = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> Engine:
+    """Returns the process-wide engine, its connection pool is shared by all SQLHandlers."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(
+                os.environ["CONNECTION_STRING"],
+                echo=False,
+                pool_size=constants.SQL_POOL_SIZE,
+                max_overflow=constants.SQL_MAX_OVERFLOW,
+                pool_timeout=constants.SQL_POOL_TIMEOUT_SECONDS,
+                pool_recycle=constants.SQL_POOL_RECYCLE_SECONDS,
+                pool_pre_ping=True,
+            )
+        return _engine
 
 
 class SQLHandler():
     def __init__(self):
-        self.engine = create_engine(os.environ["CONNECTION_STRING"], echo=True)
+        self.engine = get_engine()
 
     @contextmanager
     def session(self):
@@ -28,14 +55,80 @@ class SQLHandler():
             session.add(row)
             return row
 
-def log_usage(oid_hashed: str, session_id: str, chat_type: str, num_token_prompt: int | None, num_token_response: int | None, response_time: int):
-    usage_data = {
+    def _insert(self, sql_model: SQLModel, rows: List[Dict]) -> None:
+        with self.session() as session:
+            session.execute(insert(sql_model).values(rows))
+
+    def insert_rows(self, sql_model: SQLModel, rows: List[Dict]) -> List[Dict]:
+        """Inserts all rows with a single multi-row INSERT statement in one transaction.
+
+        If a row violates a constraint, the statement is rolled back and the rows are inserted
+        one by one, each in its own transaction, so that only the offending rows are dropped.
+
+        Returns:
+            The rows that were not inserted because of other errors, e.g. a lost connection,
+            and can be retried.
+        """
+        if not rows:
+            return []
+        try:
+            self._insert(sql_model, rows)
+            return []
+        except (IntegrityError, DataError) as ex:
+            logger.warning("Inserting %s rows into %s failed, inserting them one by one: %s", len(rows), sql_model.__tablename__, ex)
+        except Exception as ex:
+            logger.warning("Inserting %s rows into %s failed: %s", len(rows), sql_model.__tablename__, ex)
+            return rows
+
+        for index, row in enumerate(rows):
+            try:
+                self._insert(sql_model, [row])
+            except (IntegrityError, DataError) as ex:
+                logger.error("Dropping row of session %s rejected by %s: %s", row.get("session_id"), sql_model.__tablename__, ex)
+            except Exception as ex:
+                logger.warning("Inserting rows into %s failed: %s", sql_model.__tablename__, ex)
+                return rows[index:]
+        return []
+
+def usage_data(oid_hashed: str, session_id: str, chat_type: str, num_token_prompt: int | None, num_token_response: int | None, response_time: int, time_to_first_token: int | None = None, num_token_saved: int | None = None) -> Dict:
+    return {
         "oid_hashed": oid_hashed,
         "session_id": session_id,
         "chat_type": chat_type,
+        # time_stamp is left to the server default now() of the column
         "num_token_prompt": num_token_prompt,
         "num_token_response": num_token_response,
-        "response_time": response_time
+        "response_time": response_time,
+        "time_to_first_token": time_to_first_token,
+        "num_token_saved": num_token_saved,
     }
+
+def log_usage(oid_hashed: str, session_id: str, chat_type: str, num_token_prompt: int | None, num_token_response: int | None, response_time: int, time_to_first_token: int | None = None, num_token_saved: int | None = None):
+    usage = usage_data(oid_hashed, session_id, chat_type, num_token_prompt, num_token_response, response_time, time_to_first_token, num_token_saved)
+    sql_handler = SQLHandler()
+    return sql_handler.insert_row(CosiUsage, data=usage)
+
+def log_usage_batch(usage_rows: List[Dict]) -> List[Dict]:
+    """Inserts several usage rows (see usage_data) with multi-row INSERTs.
+
+    The time_stamp of all rows of one transaction is the same server default now(), and
+    (session_id, time_stamp) is the primary key. Rows of a session that occurs more than once
+    in the batch are therefore inserted in separate transactions, one per occurrence.
+
+    Returns:
+        The rows to retry, see SQLHandler.insert_rows.
+    """
+    transactions: List[List[Dict]] = []
+    occurrences: Dict[str, int] = {}
+    for row in usage_rows:
+        occurrence = occurrences.get(row["session_id"], 0)
+        occurrences[row["session_id"]] = occurrence + 1
+        if occurrence == len(transactions):
+            transactions.append([])
+        transactions[occurrence].append(row)
+
     sql_handler = SQLHandler()
-    return sql_handler.insert_row(CosiUsage, data=usage_data)
+    retry = []
+    for rows in transactions:
+        retry.extend(sql_handler.insert_rows(CosiUsage, rows))
+    return retry
@@ -1,7 +1,10 @@
 from google.cloud import storage
 from . import constants
 import os
-from typing import List, Optional
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+import hashlib
 import json
 from datetime import datetime
 
@@ -12,12 +15,50 @@ def write_bucket_object(
     object_content: str,
     bucket_name: str = os.environ["CHATBOT_LOGGING_BUCKET"],
 ) -> None:
-    storage_client = storage.Client(project=os.environ["PROJECT_ID"])
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_name)
+    # Single request upload, the turn records are small
+    blob.upload_from_string(object_content, content_type="application/json")
 
-    with blob.open("w") as f:
-        f.write(object_content)
+
+# Hashes of the contexts known to exist in the bucket (LRU), saves the existence check per turn
+_stored_contexts: "OrderedDict[str, None]" = OrderedDict()
+_stored_contexts_lock = threading.Lock()
+
+
+def _context_blob_name(context_sha1: str) -> str:
+    return f"{constants.HISTORY_CONTEXT_PREFIX}/{context_sha1}.txt"
+
+
+def _remember_context(context_sha1: str) -> None:
+    with _stored_contexts_lock:
+        _stored_contexts[context_sha1] = None
+        _stored_contexts.move_to_end(context_sha1)
+        while len(_stored_contexts) > constants.HISTORY_STORED_CONTEXTS_MAX:
+            _stored_contexts.popitem(last=False)
+
+
+def store_context(context: str, bucket_name: str) -> str:
+    """Stores a context once under its content hash and returns the hash.
+
+    Identical contexts, e.g. the provided documents or a document asked about in many turns,
+    are uploaded once per bucket instead of once per turn and session.
+    """
+    context_sha1 = hashlib.sha1(context.encode()).hexdigest()
+    with _stored_contexts_lock:
+        if context_sha1 in _stored_contexts:
+            _stored_contexts.move_to_end(context_sha1)
+            return context_sha1
+
+    blob = storage_client.bucket(bucket_name).blob(_context_blob_name(context_sha1))
+    if not blob.exists():
+        blob.upload_from_string(context, content_type="text/plain; charset=utf-8")
+    _remember_context(context_sha1)
+    return context_sha1
+
+
+def load_context(context_sha1: str, bucket_name: str) -> str:
+    return storage_client.bucket(bucket_name).blob(_context_blob_name(context_sha1)).download_as_text()
 
 
 def log_history(
@@ -28,27 +69,78 @@ def log_history(
     bucket_name:str,
     context:Optional[str]=None,
 ):
-   # convert Conversation-Objects to JSON-Strings
-    history_json = [ json.loads(c.json()) for c in history ]
+    """Appends the latest turn of history to the session log.
+
+    Every turn is written as its own object {date}/{session_id}/{turn}.json, so the bytes per
+    turn do not grow with the length of the conversation. The context is stored once in the
+    content-addressed area of the bucket (see store_context), the turn only references its
+    hash. Use read_session to reconstruct the whole session.
+    """
+    if not history:
+        return
 
     if context == None:
         context = constants.DEFAULT_CONTEXT
+    context_sha1 = store_context(context, bucket_name)
 
+    turn = len(history) - 1
     # oid_hashed not saved yet due to internal data protection policy
-    text_messages_json: str = json.dumps(
-        {
-            "session_id": session_id,
-            "chat_type":chat_type,
-            "chat_history": history_json,
-            "context":context
-        },
-        ensure_ascii=False
-    )
+    record = {
+        "session_id": session_id,
+        "chat_type": chat_type,
+        "turn": turn,
+        "time_stamp": datetime.now().isoformat(),
+        "conversation": json.loads(history[-1].json()),
+        "context_sha1": context_sha1,
+    }
 
     CURRENT_DATE = datetime.today().strftime("%Y-%m-%d")
 
     write_bucket_object(
-        f"{CURRENT_DATE}/{session_id}.txt",
-            text_messages_json,
-            bucket_name
+        f"{CURRENT_DATE}/{session_id}/{turn:0{constants.HISTORY_TURN_DIGITS}d}.json",
+        json.dumps(record, ensure_ascii=False),
+        bucket_name
     )
+
+
+def read_session(session_id: str, bucket_name: str, date: Optional[str] = None) -> Dict:
+    """Reconstructs a session from its turn records.
+
+    Args:
+        session_id: The session to read.
+        bucket_name: The logging bucket.
+        date: Day (YYYY-MM-DD) of the session. If None, all days are searched.
+
+    Returns:
+        Same shape as the session files written before: session_id, chat_type, chat_history
+        and the context of the latest turn.
+    """
+    bucket = storage_client.bucket(bucket_name)
+    if date:
+        blobs = storage_client.list_blobs(bucket, prefix=f"{date}/{session_id}/")
+    else:
+        blobs = storage_client.list_blobs(bucket, match_glob=f"*/{session_id}/*.json")
+    records = [json.loads(blob.download_as_text()) for blob in blobs]
+    return reconstruct_session(session_id, records, lambda context_sha1: load_context(context_sha1, bucket_name))
+
+
+def reconstruct_session(session_id: str, records: List[Dict], load_context: Callable[[str], str]) -> Dict:
+    """Builds the session from its turn records, see read_session.
+
+    Args:
+        load_context: Returns the context for a hash, only called for the context of the latest turn.
+    """
+    # A turn can have been written more than once, e.g. by a retried request. The latest one wins.
+    turns = {}
+    for record in sorted(records, key=lambda record: record["time_stamp"]):
+        turns[record["turn"]] = record
+
+    ordered = [turns[turn] for turn in sorted(turns)]
+    if not ordered:
+        return {"session_id": session_id, "chat_type": None, "chat_history": [], "context": None}
+    return {
+        "session_id": session_id,
+        "chat_type": ordered[-1]["chat_type"],
+        "chat_history": [record["conversation"] for record in ordered],
+        "context": load_context(ordered[-1]["context_sha1"]),
+    }
@@ -0,0 +1,139 @@
+"""Thread-safe in-memory cache with LRU eviction, a TTL per entry and a memory cap.
+
+Entries are evicted least recently used first as soon as either the number of entries or
+their estimated size exceeds the limits. Hits, misses and evictions are counted in the
+metrics module under the name of the cache.
+
+The size of an entry is its memory as measured by sys.getsizeof, see deep_sizeof, so text
+with umlauts counts two bytes per character and object headers are included. The caps of all
+caches together must stay within CACHE_MEMORY_BUDGET_BYTES, a warning is logged otherwise.
+"""
+import dataclasses
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from pydantic import BaseModel
+
+from . import constants, metrics
+
+logger = logging.getLogger(__name__)
+
+# The OrderedDict slot and the (value, expiry, size) tuple of an entry
+_ENTRY_OVERHEAD_BYTES = 200
+_LEAF_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+def deep_sizeof(value: Any) -> int:
+    """Returns the memory of value in bytes.
+
+    Follows containers, dataclasses and pydantic models, other objects are counted without
+    what they reference. Objects referenced more than once are counted once.
+    """
+    seen = set()
+    total = 0
+    pending = [value]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, _LEAF_TYPES):
+            continue
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif isinstance(obj, BaseModel) or (dataclasses.is_dataclass(obj) and not isinstance(obj, type)):
+            pending.append(vars(obj))
+    return total
+
+
+class TTLCache:
+    """
+    Args:
+        name: Name of the cache, used as metrics label.
+        max_entries: Maximum number of entries.
+        ttl_seconds: Time after which an entry expires, counted from when it was set.
+        max_bytes: Maximum memory of all entries.
+        sizeof: Returns the memory of a value in bytes, the key is counted separately.
+        clock: Time source in seconds, replaceable in tests.
+    """
+
+    # Sum of max_bytes of all caches of the process
+    _reserved_bytes = 0
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int,
+        ttl_seconds: float,
+        max_bytes: int,
+        sizeof: Callable[[Any], int] = deep_sizeof,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.clock = clock
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        metrics.register_gauge(f"cache_{name}", self.stats)
+        TTLCache._reserved_bytes += max_bytes
+        if TTLCache._reserved_bytes > constants.CACHE_MEMORY_BUDGET_BYTES:
+            logger.warning(
+                "The caps of the in-process caches add up to %d MiB, above the budget of %d MiB",
+                TTLCache._reserved_bytes // 2**20, constants.CACHE_MEMORY_BUDGET_BYTES // 2**20,
+            )
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= self.clock():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                metrics.increment("cache_misses", self.name)
+                return None
+            self._entries.move_to_end(key)
+            metrics.increment("cache_hits", self.name)
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value) + deep_sizeof(key) + _ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, self.clock() + self.ttl_seconds, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                metrics.increment("cache_evictions", self.name)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes}
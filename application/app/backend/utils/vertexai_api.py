@@ -1,4 +1,5 @@
 from __future__ import annotations
+import asyncio
 import random
 import string
 import base64
@@ -6,28 +7,28 @@ import io
 from datetime import datetime
 import os
 import json
-from typing import List, Any, Tuple
+import logging
+from typing import List, Any, Tuple, AsyncIterator
 import requests
 from functools import wraps
 
 from google.cloud import storage
 import google.oauth2.id_token
 from google.auth import default
-import vertexai
-from vertexai.language_models import ChatModel, ChatSession, InputOutputTextPair, CodeChatModel, ChatMessage, TextGenerationResponse
-from vertexai.generative_models import (GenerativeModel,
-                                        GenerationResponse,
+from google.api_core.exceptions import NotFound
+from vertexai.language_models import ChatModel, ChatSession, InputOutputTextPair, ChatMessage, TextGenerationResponse
+from vertexai.generative_models import (GenerationResponse,
                                         Tool,
                                         Part,
                                         Content,
                                         HarmBlockThreshold,
                                         HarmCategory)
-from vertexai.preview.vision_models import ImageGenerationModel
 from vertexai.preview.generative_models import grounding as preview_grounding
 
-from . import constants, storage_api
-from backend.schemas.schemas import Conversation, BackendError
+from . import constants, storage_api, model_registry, context_cache, grounding_renderer
+from backend.schemas.schemas import Conversation, BackendError, Citation
 
+logger = logging.getLogger(__name__)
 
 
 SAFETY_SETTINGS = {
@@ -55,6 +56,18 @@ def measure_time(func):
         return result, int(duration.total_seconds())
     return wrapper
 
+
+# Wrapper for time measurement of coroutines, same return shape as measure_time
+def measure_time_async(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs) -> Tuple[Any, float]:
+        start_time = datetime.now()
+        result = await func(*args, **kwargs)
+        end_time = datetime.now()
+        duration = end_time - start_time
+        return result, int(duration.total_seconds())
+    return wrapper
+
 # Helper function to get the number of tokens of prompt and llm response for usage logging
 
 
@@ -78,39 +91,59 @@ def _get_content_history_from_conversation_list(conv_list: List[Conversation]):
     return contents
 
 
-@measure_time
-def ask_gemini_docchat_question(
-        doc_context: str,
-        prompt: str,
-        project_id: str,
-        history: List[Conversation],
-        model_name: str,
-        temperature: float = constants.GEMINI_TEXT_CHAT_DEFAULT_TEMPERATURE,
-        max_output_tokens: int = constants.GEMINI_MAX_OUTPUT_TOKENS,
-        system_instruction: list = constants.SYSTEM_INSTRUCTION_GEMINI_DOC_CHAT,
-        location: str = "europe-west3") -> (str, int, int):
-    config = {
+def _build_generation_config(temperature: float, max_output_tokens: int) -> dict:
+    return {
         "max_output_tokens": max_output_tokens,
         "temperature": temperature,
         "top_p": 1
     }
 
-    contents_history = [
+
+def _build_docchat_context_turns(doc_context: str) -> List[Content]:
+    return [
         Content(role="user", parts=[Part.from_text("<KONTEXT> " + doc_context + " </KONTEXT>")]),
         Content(role="model", parts=[Part.from_text(constants.DOC_CHAT_PLACEHOLDER_MESSAGE)])
     ]
 
-    contents_history.extend(_get_content_history_from_conversation_list(history))
 
+def _build_docchat_contents(doc_context: str, prompt: str, history: List[Conversation]) -> List[Content]:
+    contents_history = _build_docchat_context_turns(doc_context)
+    contents_history.extend(_get_content_history_from_conversation_list(history))
     contents_history.append(
         Content(role="user", parts=[Part.from_text(prompt)])
     )
+    return contents_history
 
-    vertexai.init(project=project_id, location=location)
-    model = GenerativeModel(
-        model_name,
-        system_instruction=system_instruction
+
+def _build_textchat_contents(prompt: str, history: List[Conversation]) -> List[Content]:
+    contents_history = _get_content_history_from_conversation_list(history)
+    contents_history.append(
+        Content(role="user", parts=[Part.from_text(prompt)])
     )
+    return contents_history
+
+
+def _parse_gemini_response(response: GenerationResponse) -> (str, int, int):
+    num_prompt_token, num_response_token = _get_num_token_gemini(response)
+    answer_str = response.candidates[0].content.parts[0].text
+    return answer_str, num_prompt_token, num_response_token
+
+
+@measure_time
+def ask_gemini_docchat_question(
+        doc_context: str,
+        prompt: str,
+        project_id: str,
+        history: List[Conversation],
+        model_name: str,
+        temperature: float = constants.GEMINI_TEXT_CHAT_DEFAULT_TEMPERATURE,
+        max_output_tokens: int = constants.GEMINI_MAX_OUTPUT_TOKENS,
+        system_instruction: list = constants.SYSTEM_INSTRUCTION_GEMINI_DOC_CHAT,
+        location: str = "europe-west3") -> (str, int, int):
+    config = _build_generation_config(temperature, max_output_tokens)
+    contents_history = _build_docchat_contents(doc_context, prompt, history)
+
+    model = model_registry.get_generative_model(project_id, location, model_name, system_instruction)
 
     response = model.generate_content(
         contents=contents_history,
@@ -118,10 +151,83 @@ def ask_gemini_docchat_question(
         safety_settings=SAFETY_SETTINGS
     )
 
-    num_prompt_token, num_response_token = _get_num_token_gemini(response)
+    return _parse_gemini_response(response)
 
-    answer_str = response.candidates[0].content.parts[0].text
-    return answer_str, num_prompt_token, num_response_token
+
+async def _get_docchat_model(
+        doc_context: str,
+        prompt: str,
+        history: List[Conversation],
+        project_id: str,
+        model_name: str,
+        system_instruction: list,
+        location: str,
+        context_cache_key: Tuple[str, str] | None) -> (Any, List[Content], bool):
+    """Returns the model, the contents to send and whether the model is bound to a context cache.
+
+    With a context cache only the history and the prompt are sent, otherwise the document is inlined.
+    """
+    if context_cache_key is not None:
+        doc_key, version = context_cache_key
+        model = await context_cache.get_manager().get_model(
+            doc_key,
+            version,
+            _build_docchat_context_turns(doc_context),
+            len(doc_context) // constants.CHARS_PER_TOKEN_ESTIMATE,
+            system_instruction,
+            project_id,
+            location,
+            model_name,
+        )
+        if model is not None:
+            return model, _build_textchat_contents(prompt, history), True
+
+    model = await model_registry.get_generative_model_async(project_id, location, model_name, system_instruction)
+    return model, _build_docchat_contents(doc_context, prompt, history), False
+
+
+@measure_time_async
+async def ask_gemini_docchat_question_async(
+        doc_context: str,
+        prompt: str,
+        project_id: str,
+        history: List[Conversation],
+        model_name: str,
+        temperature: float = constants.GEMINI_TEXT_CHAT_DEFAULT_TEMPERATURE,
+        max_output_tokens: int = constants.GEMINI_MAX_OUTPUT_TOKENS,
+        system_instruction: list = constants.SYSTEM_INSTRUCTION_GEMINI_DOC_CHAT,
+        location: str = "europe-west3",
+        context_cache_key: Tuple[str, str] | None = None) -> (str, int, int):
+    """Async variant of ask_gemini_docchat_question, awaits the Gemini call instead of blocking a worker thread.
+
+    Args:
+        context_cache_key: (doc_key, version) of a provided document. If given, the document is
+            served from a Gemini context cache instead of being inlined, see context_cache.
+    """
+    config = _build_generation_config(temperature, max_output_tokens)
+    model, contents_history, cached = await _get_docchat_model(
+        doc_context, prompt, history, project_id, model_name, system_instruction, location, context_cache_key
+    )
+
+    try:
+        response = await model.generate_content_async(
+            contents=contents_history,
+            generation_config=config,
+            safety_settings=SAFETY_SETTINGS
+        )
+    except NotFound:
+        if not cached:
+            raise
+        # The cache expired or was deleted on the server, answer with the inlined document
+        await context_cache.get_manager().invalidate(context_cache_key[0], project_id, location, model_name)
+        model = await model_registry.get_generative_model_async(project_id, location, model_name, system_instruction)
+        response = await model.generate_content_async(
+            contents=_build_docchat_contents(doc_context, prompt, history),
+            generation_config=config,
+            safety_settings=SAFETY_SETTINGS
+        )
+
+    return _parse_gemini_response(response)
 
 
 @measure_time
@@ -135,20 +241,9 @@ def ask_gemini_textchat_question(
     location: str = "europe-west3",
     system_instruction: list = constants.SYSTEM_INSTRUCTION_GEMINI_TEXT_CHAT,
 ) -> (str, int, int):
-    config = {
-        "max_output_tokens": max_output_tokens,
-        "temperature": temperature,
-        "top_p": 1
-    }
-    contents_history = _get_content_history_from_conversation_list(history)
-    contents_history.append(
-        Content(role="user", parts=[Part.from_text(prompt)])
-    )
-    vertexai.init(project=project_id, location=location)
-    model = GenerativeModel(
-        model_name,
-        system_instruction=system_instruction
-    )
+    config = _build_generation_config(temperature, max_output_tokens)
+    contents_history = _build_textchat_contents(prompt, history)
+    model = model_registry.get_generative_model(project_id, location, model_name, system_instruction)
 
     response = model.generate_content(
         contents=contents_history,
@@ -156,10 +251,151 @@ def ask_gemini_textchat_question(
         safety_settings=SAFETY_SETTINGS,
     )
 
-    num_prompt_token, num_response_token = _get_num_token_gemini(response)
+    return _parse_gemini_response(response)
 
-    answer_str = response.candidates[0].content.parts[0].text
-    return answer_str, num_prompt_token, num_response_token
+
+@measure_time_async
+async def ask_gemini_textchat_question_async(
+    prompt: str,
+    project_id: str,
+    history: List[Conversation],
+    model_name: str = constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME,
+    temperature: float = constants.GEMINI_TEXT_CHAT_DEFAULT_TEMPERATURE,
+    max_output_tokens: int = constants.GEMINI_MAX_OUTPUT_TOKENS,
+    location: str = "europe-west3",
+    system_instruction: list = constants.SYSTEM_INSTRUCTION_GEMINI_TEXT_CHAT,
+) -> (str, int, int):
+    """Async variant of ask_gemini_textchat_question."""
+    config = _build_generation_config(temperature, max_output_tokens)
+    contents_history = _build_textchat_contents(prompt, history)
+    model = await model_registry.get_generative_model_async(project_id, location, model_name, system_instruction)
+
+    response = await model.generate_content_async(
+        contents=contents_history,
+        generation_config=config,
+        safety_settings=SAFETY_SETTINGS,
+    )
+
+    return _parse_gemini_response(response)
+
+
+async def summarize_conversation_async(
+    summary: str | None,
+    turns: List[Conversation],
+    project_id: str,
+    location: str = "europe-west3",
+    model_name: str = constants.HISTORY_SUMMARY_MODEL_NAME,
+) -> str:
+    """Folds the turns into the previous summary of a conversation, see history_manager."""
+    formatted_turns = "".join([f"Frage: {conversation.question}\nAntwort: {conversation.answer}\n" for conversation in turns])
+    prompt = (
+        (f"Bisherige Zusammenfassung:\n{summary}\n\n" if summary else "")
+        + f"Weiterer Gesprächsverlauf:\n{formatted_turns}\n"
+        + "Fasse den gesamten Gesprächsverlauf zusammen."
+    )
+    model = await model_registry.get_generative_model_async(project_id, location, model_name, constants.SYSTEM_INSTRUCTION_HISTORY_SUMMARY)
+
+    response = await model.generate_content_async(
+        contents=[Content(role="user", parts=[Part.from_text(prompt)])],
+        generation_config=_build_generation_config(0.2, constants.HISTORY_SUMMARY_MAX_OUTPUT_TOKENS),
+        safety_settings=SAFETY_SETTINGS,
+    )
+    answer, _, _ = _parse_gemini_response(response)
+    return answer
+
+
+def _chunk_text(chunk: GenerationResponse) -> str:
+    # The last chunk of a stream may only carry usage metadata and no parts
+    if not chunk.candidates or not chunk.candidates[0].content.parts:
+        return ""
+    return chunk.candidates[0].content.parts[0].text
+
+
+async def _stream_gemini_contents(
+    contents: List[Content],
+    model: Any,
+    temperature: float,
+    max_output_tokens: int,
+) -> AsyncIterator[Tuple[str, int, int]]:
+    """Streams a Gemini answer.
+
+    Yields:
+        Tuples of (text delta, prompt token count, response token count). The token counts are
+        cumulative, so the values of the last tuple are the ones to log.
+    """
+    config = _build_generation_config(temperature, max_output_tokens)
+
+    responses = await model.generate_content_async(
+        contents=contents,
+        generation_config=config,
+        safety_settings=SAFETY_SETTINGS,
+        stream=True,
+    )
+
+    num_prompt_token, num_response_token = -1, -1
+    async for chunk in responses:
+        if chunk.usage_metadata:
+            num_prompt_token = int(chunk.usage_metadata.prompt_token_count)
+            num_response_token = int(chunk.usage_metadata.candidates_token_count)
+        yield _chunk_text(chunk), num_prompt_token, num_response_token
+
+
+async def stream_gemini_textchat_question(
+    prompt: str,
+    project_id: str,
+    history: List[Conversation],
+    model_name: str = constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME,
+    temperature: float = constants.GEMINI_TEXT_CHAT_DEFAULT_TEMPERATURE,
+    max_output_tokens: int = constants.GEMINI_MAX_OUTPUT_TOKENS,
+    location: str = "europe-west3",
+    system_instruction: list = constants.SYSTEM_INSTRUCTION_GEMINI_TEXT_CHAT,
+) -> AsyncIterator[Tuple[str, int, int]]:
+    """Streaming variant of ask_gemini_textchat_question, see _stream_gemini_contents."""
+    stream = _stream_gemini_contents(
+        _build_textchat_contents(prompt, history),
+        await model_registry.get_generative_model_async(project_id, location, model_name, system_instruction),
+        temperature,
+        max_output_tokens,
+    )
+    async for item in stream:
+        yield item
+
+
+async def stream_gemini_docchat_question(
+        doc_context: str,
+        prompt: str,
+        project_id: str,
+        history: List[Conversation],
+        model_name: str,
+        temperature: float = constants.GEMINI_TEXT_CHAT_DEFAULT_TEMPERATURE,
+        max_output_tokens: int = constants.GEMINI_MAX_OUTPUT_TOKENS,
+        system_instruction: list = constants.SYSTEM_INSTRUCTION_GEMINI_DOC_CHAT,
+        location: str = "europe-west3",
+        context_cache_key: Tuple[str, str] | None = None) -> AsyncIterator[Tuple[str, int, int]]:
+    """Streaming variant of ask_gemini_docchat_question_async, see _stream_gemini_contents."""
+    model, contents, cached = await _get_docchat_model(
+        doc_context, prompt, history, project_id, model_name, system_instruction, location, context_cache_key
+    )
+    stream = _stream_gemini_contents(contents, model, temperature, max_output_tokens)
+    try:
+        first = await anext(stream, None)
+    except NotFound:
+        if not cached:
+            raise
+        # The cache expired or was deleted on the server, answer with the inlined document
+        await context_cache.get_manager().invalidate(context_cache_key[0], project_id, location, model_name)
+        stream = _stream_gemini_contents(
+            _build_docchat_contents(doc_context, prompt, history),
+            await model_registry.get_generative_model_async(project_id, location, model_name, system_instruction),
+            temperature,
+            max_output_tokens,
+        )
+        first = await anext(stream, None)
+    if first is None:
+        return
+    yield first
+    async for item in stream:
+        yield item
 
 
 def build_codechat_message_history(history: list):
@@ -185,11 +421,9 @@ def ask_codechat_question(
         context: str = constants.DEFAULT_CONTEXT,
         location: str = "europe-west3") -> (str, int, int):
 
-    vertexai.init(project=project_id, location=location)
-
     message_history = build_codechat_message_history(history)
 
-    code_chat_model = CodeChatModel.from_pretrained(model_name)
+    code_chat_model = model_registry.get_code_chat_model(project_id, location, model_name)
     formatted_history = "".join([f"Frage: {conversation.question}\nAntwort: {conversation.answer}\n" for conversation in history])
     full_context = f"{context}\n{formatted_history}"
 
@@ -206,6 +440,53 @@ def ask_codechat_question(
     return answer, num_prompt_token, num_response_token
 
 
+@measure_time_async
+async def ask_codechat_question_async(
+        prompt: str,
+        project_id: str,
+        history: List[Conversation],
+        model_name: str = constants.CODE_CHAT_DEFAULT_MODEL_NAME,
+        temperature: float = constants.TEXT_CHAT_DEFAULT_TEMPERATURE,
+        max_output_tokens: int = constants.CODE_CHAT_MAX_OUTPUT_TOKENS,
+        location: str = "europe-west3") -> (str, int, int):
+    """Async variant of ask_codechat_question."""
+    message_history = build_codechat_message_history(history)
+
+    code_chat_model = await model_registry.get_code_chat_model_async(project_id, location, model_name)
+    code_chat_session = code_chat_model.start_chat(
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+        message_history=message_history,
+    )
+    response = await code_chat_session.send_message_async(prompt)
+    num_prompt_token, num_response_token = _get_num_token_palm(response)
+    answer = str(response.text)
+
+    return answer, num_prompt_token, num_response_token
+
+
+async def stream_codechat_question(
+        prompt: str,
+        project_id: str,
+        history: List[Conversation],
+        model_name: str = constants.CODE_CHAT_DEFAULT_MODEL_NAME,
+        temperature: float = constants.TEXT_CHAT_DEFAULT_TEMPERATURE,
+        max_output_tokens: int = constants.CODE_CHAT_MAX_OUTPUT_TOKENS,
+        location: str = "europe-west3") -> AsyncIterator[Tuple[str, int, int]]:
+    """Streaming variant of ask_codechat_question.
+
+    The streamed PaLM responses carry no token metadata, so the token counts are always -1.
+    """
+    code_chat_model = await model_registry.get_code_chat_model_async(project_id, location, model_name)
+    code_chat_session = code_chat_model.start_chat(
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+        message_history=build_codechat_message_history(history),
+    )
+    async for response in code_chat_session.send_message_streaming_async(prompt):
+        yield str(response.text), -1, -1
+
+
 @measure_time
 def generate_image(
     prompt: str,
@@ -218,8 +499,6 @@ def generate_image(
     location: str = "EU"
 ) -> (List[str], str, List[BackendError]):
 
-    vertexai.init(project=project_id, location=location)
-
     translation_result, _ = ask_gemini_textchat_question(
         prompt,
         project_id,
@@ -232,7 +511,7 @@ def generate_image(
     CURRENT_DATE = datetime.today().strftime("%Y-%m-%d")
     storage_uri = f"gs://{os.environ['CHATBOT_LOGGING_BUCKET']}/imagen/{CURRENT_DATE}"
 
-    model = ImageGenerationModel.from_pretrained(model_name)
+    model = model_registry.get_image_generation_model(project_id, location, model_name)
 
     urls = []
     errors = []
@@ -260,6 +539,62 @@ def generate_image(
     return urls, en_prompt, errors
 
 
+@measure_time_async
+async def generate_image_async(
+    prompt: str,
+    project_id: str,
+    history: List[Conversation],
+    session_id: str,
+    model_name: str = constants.IMAGEN_DEFAULT_MODEL_NAME,
+    image_num=constants.IMAGEN_NUM_IMAGES,
+    context: str = constants.DEFAULT_CONTEXT,
+    location: str = "EU"
+) -> (List[str], str, List[BackendError]):
+    """Async variant of generate_image.
+
+    The translation runs on the async Gemini client. The Imagen SDK has no async API,
+    so the image generation itself is moved to a worker thread.
+    """
+    translation_result, _ = await ask_gemini_textchat_question_async(
+        prompt,
+        project_id,
+        [],
+        system_instruction=constants.SYSTEM_INSTRUCTION_TRANSLATION_IMAGEN
+    )
+
+    en_prompt, _, _ = translation_result
+
+    CURRENT_DATE = datetime.today().strftime("%Y-%m-%d")
+    storage_uri = f"gs://{os.environ['CHATBOT_LOGGING_BUCKET']}/imagen/{CURRENT_DATE}"
+
+    urls = []
+    errors = []
+
+    def _generate() -> list:
+        model = model_registry.get_image_generation_model(project_id, location, model_name)
+        return model.generate_images(
+            prompt=en_prompt,
+            number_of_images=image_num,
+            output_gcs_uri=storage_uri,
+            safety_filter_level="block_few",
+            person_generation="dont_allow"
+        )
+
+    try:
+        response = await asyncio.to_thread(_generate)
+        urls = [im._gcs_uri for im in response.images]
+
+    except Exception as e:
+        errors.append(BackendError(
+            code="500",
+            msg=f"{type(e)}:{str(e)}",
+            status="EMPTY_RESPONSE"
+        ))
+        logger.exception("Image generation failed: %s", e)
+
+    return urls, en_prompt, errors
+
+
 # @measure_time
 def ask_gemini_with_bafin_docs(
     prompt: str,
@@ -271,43 +606,80 @@ def ask_gemini_with_bafin_docs(
     max_output_tokens: int = constants.GEMINI_MAX_OUTPUT_TOKENS,
     location: str = "europe-west3",
     system_instruction: list = constants.SYSTEM_INSTRUCTION_GEMINI_TEXT_CHAT,
-) -> (str, int, int):
-    config = {
-        "max_output_tokens": max_output_tokens,
-        "temperature": temperature,
-        "top_p": 1
-    }
-    contents_history = _get_content_history_from_conversation_list(history)
-    contents_history.append(
-        Content(role="user", parts=[Part.from_text(prompt)])
-    )
-    vertexai.init(project=project_id, location=location)
-    model = GenerativeModel(
+) -> (str, List[Citation], int, int):
+    """Answers grounded on the BaFin data store.
+
+    Returns:
+        The answer with footnotes and source list, the cited sources, and the prompt and response token counts.
+    """
+    config = _build_generation_config(temperature, max_output_tokens)
+    contents_history = _build_textchat_contents(prompt, history)
+    model = model_registry.get_generative_model(
+        project_id,
+        location,
         model_name,
-        system_instruction=system_instruction
+        system_instruction,
+        tools=[_build_bafin_datastore_tool(datastore_id, project_id)],
+        tools_key=("bafin_datastore", datastore_id),
     )
 
-    bafin_datastore_tool = Tool.from_retrieval(
-        retrieval=preview_grounding.Retrieval(
-            preview_grounding.VertexAISearch(
-                datastore=datastore_id,
-                project=project_id,
-                location="eu"
-            )
-        )
+    response = model.generate_content(
+        contents=contents_history,
+        generation_config=config,
+        safety_settings=SAFETY_SETTINGS,
     )
 
-    response = model.generate_content(
+    num_prompt_token, num_response_token = _get_num_token_gemini(response)
+
+    answer_str, citations = grounding_renderer.render(response)
+    return answer_str, citations, num_prompt_token, num_response_token
+
+
+async def ask_gemini_with_bafin_docs_async(
+    prompt: str,
+    project_id: str,
+    history: List[Conversation],
+    datastore_id: str,
+    model_name: str = constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME,
+    temperature: float = constants.GEMINI_TEXT_CHAT_DEFAULT_TEMPERATURE,
+    max_output_tokens: int = constants.GEMINI_MAX_OUTPUT_TOKENS,
+    location: str = "europe-west3",
+    system_instruction: list = constants.SYSTEM_INSTRUCTION_GEMINI_TEXT_CHAT,
+) -> (str, List[Citation], int, int):
+    """Async variant of ask_gemini_with_bafin_docs."""
+    config = _build_generation_config(temperature, max_output_tokens)
+    contents_history = _build_textchat_contents(prompt, history)
+    model = await model_registry.get_generative_model_async(
+        project_id,
+        location,
+        model_name,
+        system_instruction,
+        tools=[_build_bafin_datastore_tool(datastore_id, project_id)],
+        tools_key=("bafin_datastore", datastore_id),
+    )
+
+    response = await model.generate_content_async(
         contents=contents_history,
-        tools=[bafin_datastore_tool],
         generation_config=config,
         safety_settings=SAFETY_SETTINGS,
     )
 
     num_prompt_token, num_response_token = _get_num_token_gemini(response)
 
-    answer_str = grounding_response_with_citations(response=response)
-    return answer_str, num_prompt_token, num_response_token
+    answer_str, citations = grounding_renderer.render(response)
+    return answer_str, citations, num_prompt_token, num_response_token
+
+
+def _build_bafin_datastore_tool(datastore_id: str, project_id: str) -> Tool:
+    return Tool.from_retrieval(
+        retrieval=preview_grounding.Retrieval(
+            preview_grounding.VertexAISearch(
+                datastore=datastore_id,
+                project=project_id,
+                location="eu"
+            )
+        )
+    )
 
 
 
@@ -364,48 +736,5 @@ def grounding_response_with_citations_original(response: GenerationResponse):
     return markdown_text
 
 def grounding_response_with_citations(response: GenerationResponse) -> str:
-    """Prints Gemini response with grounding citations."""
-    grounding_metadata = response.candidates[0].grounding_metadata
-
-    # Citation indices are in byte units
-    ENCODING = "utf-8"
-    text_bytes = response.text.encode(ENCODING)
-
-    prev_index = 0
-    markdown_text = ""
-
-    for grounding_support in grounding_metadata.grounding_supports:
-        text_segment = text_bytes[
-            prev_index : grounding_support.segment.end_index
-        ].decode(ENCODING)
-
-        footnotes_text = ""
-        for grounding_chunk_index in grounding_support.grounding_chunk_indices:
-            footnotes_text += f"[{grounding_chunk_index + 1}]"
-
-        markdown_text += f"{text_segment} {footnotes_text}\n"
-        prev_index = grounding_support.segment.end_index
-
-    if prev_index < len(text_bytes):
-        markdown_text += str(text_bytes[prev_index:], encoding=ENCODING)
-
-    markdown_text += "### Relevante Quellen\n"
-
-    already_used_citations = []
-
-    for grounding_support in response.candidates[0].grounding_metadata.grounding_supports:
-        for grounding_chunk_index in grounding_support.grounding_chunk_indices:
-            for index, grounding_chunk in enumerate(
-                response.candidates[0].grounding_metadata.grounding_chunks
-            ):
-                context = grounding_chunk.web or grounding_chunk.retrieved_context
-                if not context:
-                    continue
-
-                if grounding_chunk_index == index:
-                    if index not in already_used_citations:
-                        folder_path = "/".join(str(context.uri).split("/")[3:]) + "/"
-                        markdown_text += f"[{(index + 1)}] [{folder_path}] \n \n"
-                        already_used_citations.append(index)
-
-    return markdown_text
+    """Returns the Gemini response with grounding citations as markdown, see grounding_renderer."""
+    return grounding_renderer.render(response).markdown
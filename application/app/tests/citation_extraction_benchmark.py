@@ -0,0 +1,165 @@
+"""Microbenchmark of the citation extraction of the multi-turn BaFin search.
+
+    python citation_extraction_benchmark.py --results 50 --answers 20 --answer-chars 4000
+    python citation_extraction_benchmark.py --recorded response.json
+
+A recorded response is the JSON of a ConverseConversationResponse as written by
+ConverseConversationResponse.to_json, e.g. from a debugging session against the data store.
+Without a recording a large response is generated: every search result is cited and carries
+many long extractive answers, as for big PDFs.
+
+The script compares
+
+    - baseline: the previous implementation, process_multiturn_response with nested loops over
+      references and search results, followed by the loop in main building the citations,
+    - indexed: agent_builder_api.extract_multiturn_replies,
+
+and reports the time per response and the size of the citations in the JSON response.
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from backend.schemas.schemas import Citation, GroundContent
+from backend.utils import agent_builder_api
+
+
+def build_response(results: int, answers: int, answer_chars: int) -> SimpleNamespace:
+    random.seed(42)
+    words = ["Risiko", "Anforderung", "Institut", "Geschäftsleitung", "Auslagerung", "Kontrolle", "gemäß", "und", "der"]
+
+    def text(chars: int) -> str:
+        return " ".join(random.choice(words) for _ in range(chars // 8))
+
+    search_results = [
+        SimpleNamespace(
+            id=f"doc{index}",
+            document=SimpleNamespace(
+                derived_struct_data={"extractive_answers": [
+                    {"pageNumber": str(page + 1), "content": text(answer_chars)} for page in range(answers)
+                ]},
+                struct_data={
+                    "file_name": f"rundschreiben_{index}.pdf",
+                    "sharepoint_url": f"https://sharepoint.example/rundschreiben_{index}.pdf",
+                    "path_in_dir": f"bafin/rundschreiben_{index}.pdf",
+                },
+            ),
+        )
+        for index in range(results)
+    ]
+    references = [SimpleNamespace(document=f"projects/p/locations/eu/dataStores/d/documents/doc{index}") for index in range(results)]
+    citations = [
+        SimpleNamespace(sources=[SimpleNamespace(reference_index=index), SimpleNamespace(reference_index=(index + 1) % results)])
+        for index in range(results)
+    ]
+    return SimpleNamespace(
+        reply=SimpleNamespace(summary=SimpleNamespace(
+            summary_text=text(2000),
+            summary_with_metadata=SimpleNamespace(citation_metadata=SimpleNamespace(citations=citations), references=references),
+        )),
+        conversation=SimpleNamespace(messages=[SimpleNamespace(user_input=SimpleNamespace(input="Frage")), SimpleNamespace()]),
+        search_results=search_results,
+    )
+
+
+def load_response(path: str):
+    from google.cloud import discoveryengine_v1 as discoveryengine
+    return discoveryengine.ConverseConversationResponse.from_json(Path(path).read_text(), ignore_unknown_fields=True)
+
+
+def baseline(response: list) -> list:
+    """process_multiturn_response and the citation loop of call_bafin_multiturn before the change."""
+    replies_list = []
+    i = 0
+    for reply in response:
+        answer = reply.reply.summary.summary_text
+        prompt = reply.conversation.messages[i].user_input.input
+        references_list = reply.reply.summary.summary_with_metadata.citation_metadata.citations
+        i = i + 2
+        citations_reference_indices = []
+        for reference in references_list:
+            for source in reference.sources:
+                citations_reference_indices.append(source.reference_index)
+        citations_reference_indices_uniques = list(set(citations_reference_indices))
+
+        reference_ids = []
+        for citation_index in citations_reference_indices_uniques:
+            reference = reply.reply.summary.summary_with_metadata.references[citation_index]
+            reference_ids.append({"reference_id": (str(reference.document)).split("/")[-1], "citation_id": citation_index})
+
+        reference_objects = []
+        for reference in reference_ids:
+            for search_result in reply.search_results:
+                if reference["reference_id"] == search_result.id:
+                    extractive_answers = search_result.document.derived_struct_data.get("extractive_answers", [])
+                    citation_contents = []
+                    for extractive_answer in extractive_answers:
+                        citation_content = {}
+                        if "pageNumber" in extractive_answer:
+                            citation_content["page_number"] = extractive_answer["pageNumber"]
+                        else:
+                            citation_content["page_number"] = 999
+                        if "content" in extractive_answer:
+                            citation_content["ground_content"] = extractive_answer["content"]
+                        else:
+                            citation_content["ground_content"] = "Kein Inhalt erhalten"
+                        citation_contents.append(citation_content)
+                    reference_objects.append({
+                        "reference_id": reference["reference_id"],
+                        "citation_id": reference["citation_id"] + 1,
+                        "file_path": search_result.document.struct_data["path_in_dir"],
+                        "file_name": search_result.document.struct_data["file_name"],
+                        "sharepoint_url": search_result.document.struct_data["sharepoint_url"],
+                        "citation_contents": citation_contents,
+                    })
+        replies_list.append({"prompt": prompt, "answer": answer, "references": reference_objects})
+
+    citations = []
+    for reference in replies_list[-1]["references"]:
+        ground_content = [GroundContent(page=content["page_number"], content=content["ground_content"]) for content in reference["citation_contents"]]
+        citations.append(Citation(
+            id=reference["citation_id"],
+            name=reference["file_name"],
+            link=reference["sharepoint_url"],
+            path=reference["file_path"],
+            content=ground_content,
+        ))
+    return citations
+
+
+def indexed(response: list) -> list:
+    return agent_builder_api.extract_multiturn_replies(response)[-1].citations
+
+
+def measure(name: str, extract, response: list, repeat: int) -> None:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        citations = extract(response)
+        durations.append(time.perf_counter() - start)
+    size = len(json.dumps([citation.dict() for citation in citations]))
+    print(f"{name:>9}: {statistics.median(durations) * 1000:8.2f} ms per response, {len(citations)} citations, {size / 1024:8.1f} KiB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recorded", help="JSON of a recorded ConverseConversationResponse")
+    parser.add_argument("--results", type=int, default=50, help="Search results of the generated response")
+    parser.add_argument("--answers", type=int, default=20, help="Extractive answers per search result")
+    parser.add_argument("--answer-chars", type=int, default=4000, help="Characters per extractive answer")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    response = [load_response(args.recorded) if args.recorded else build_response(args.results, args.answers, args.answer_chars)]
+    measure("baseline", baseline, response, args.repeat)
+    measure("indexed", indexed, response, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
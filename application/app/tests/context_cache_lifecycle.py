@@ -0,0 +1,70 @@
+"""Offline check of the context cache lifecycle against the local stand-in of the cache service.
+
+    python context_cache_lifecycle.py
+
+Walks one provided document through create, hit, renewal, server-side expiry, document change
+and a failed create with back-off, using a fake clock. No Vertex AI calls are made.
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from backend.utils import constants
+from backend.utils.context_cache import ContextCacheManager, LocalCacheBackend
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+async def main() -> None:
+    clock = FakeClock()
+    backend = LocalCacheBackend(clock)
+    manager = ContextCacheManager(backend, clock)
+    tokens = constants.CONTEXT_CACHE_MIN_TOKENS
+
+    async def get(version: str = "v1", num_tokens: int = tokens):
+        return await manager.get_model(
+            "strategiepapier", version, ["<KONTEXT>"], num_tokens, ["system"], "project", "europe-west3", "gemini-1.5-pro-002"
+        )
+
+    assert await get(num_tokens=tokens - 1) is None, "small documents are inlined"
+    assert backend.calls == []
+
+    first = await get()
+    assert backend.calls == [("create", first)]
+    assert await get() == first, "cache is reused"
+    assert len(backend.calls) == 1
+
+    clock.now += constants.CONTEXT_CACHE_TTL_SECONDS - constants.CONTEXT_CACHE_RENEW_MARGIN_SECONDS + 1
+    assert await get() == first
+    assert backend.calls[-1] == ("renew", first), "cache is renewed before expiry"
+
+    backend.expire(first)
+    clock.now += constants.CONTEXT_CACHE_TTL_SECONDS - constants.CONTEXT_CACHE_RENEW_MARGIN_SECONDS + 1
+    second = await get()
+    assert second != first and backend.calls[-1] == ("create", second), "missing cache is recreated"
+
+    third = await get(version="v2")
+    assert backend.calls[-2:] == [("delete", second), ("create", third)], "changed document replaces the cache"
+
+    await manager.invalidate("strategiepapier", "project", "europe-west3", "gemini-1.5-pro-002")
+    backend.fail_create = True
+    assert await get(version="v2") is None, "failed create falls back to inlining"
+    backend.fail_create = False
+    assert await get(version="v2") is None, "no retry during the back-off"
+    clock.now += constants.CONTEXT_CACHE_RETRY_SECONDS
+    fourth = await get(version="v2")
+    assert fourth is not None and backend.calls[-1] == ("create", fourth)
+
+    print("context cache lifecycle ok:", backend.calls)
+    print(manager.snapshot())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
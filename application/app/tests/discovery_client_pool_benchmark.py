@@ -0,0 +1,97 @@
+"""Benchmark of the per-request setup of the Discovery Engine clients, new clients vs. the pool.
+
+    python discovery_client_pool_benchmark.py --requests 200
+    python discovery_client_pool_benchmark.py --live --project-id my-project --location eu --datastore-id my-datastore
+
+Without --live no request is sent: the clients are created with anonymous credentials and the
+script compares the setup of every /agent-builder request before the pool (new client, new gRPC
+channel, serving config path and search spec) with the lookup in the pool.
+
+With --live the same searches are sent through agent_builder_api.search_engine_async, once with
+the pool emptied before every request, as before, and once with the pooled client. The channel
+of a new client connects on its first request, so this includes the TLS and gRPC handshakes.
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from backend.utils import agent_builder_api
+
+
+def report(name: str, durations: list) -> None:
+    durations = sorted(durations)
+    print(
+        f"{name:>10}: mean {statistics.mean(durations) * 1000:8.3f} ms, "
+        f"p50 {durations[len(durations) // 2] * 1000:8.3f} ms, "
+        f"p95 {durations[int(len(durations) * 0.95)] * 1000:8.3f} ms"
+    )
+
+
+def setup(requests: int, project: str, location: str, datastore_id: str) -> None:
+    async def new_client() -> None:
+        agent_builder_api._new_search_client_async(project, location, datastore_id)
+        agent_builder_api._init_search_behavior.__wrapped__(result_count=5)
+
+    async def pooled_client() -> None:
+        agent_builder_api._init_search_client_async(project, location, datastore_id)
+        agent_builder_api._init_search_behavior(result_count=5)
+
+    async def measure(create) -> list:
+        durations = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            await create()
+            durations.append(time.perf_counter() - start)
+        return durations
+
+    async def run() -> None:
+        report("new", await measure(new_client))
+        report("pooled", await measure(pooled_client))
+
+    asyncio.run(run())
+
+
+def live(requests: int, project: str, location: str, datastore_id: str, query: str) -> None:
+    async def search(cold: bool) -> list:
+        durations = []
+        for _ in range(requests):
+            if cold:
+                agent_builder_api._clients.clear()
+            start = time.perf_counter()
+            await agent_builder_api.search_engine_async(query, False, project, location, datastore_id)
+            durations.append(time.perf_counter() - start)
+        return durations
+
+    async def run() -> None:
+        report("new", await search(cold=True))
+        report("pooled", await search(cold=False))
+
+    asyncio.run(run())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--live", action="store_true", help="Send searches to the data store")
+    parser.add_argument("--project-id", default="benchmark-project")
+    parser.add_argument("--location", default="eu")
+    parser.add_argument("--datastore-id", default="benchmark-datastore")
+    parser.add_argument("--query", default="Welche Anforderungen stellt die BaFin an das Risikomanagement?")
+    args = parser.parse_args()
+
+    if args.live:
+        live(args.requests, args.project_id, args.location, args.datastore_id, args.query)
+    else:
+        google.auth.default = lambda *_, **__: (AnonymousCredentials(), args.project_id)
+        setup(args.requests, args.project_id, args.location, args.datastore_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Benchmark of the DLP anonymization of large documents, without calling DLP.
+
+    python dlp_sectioning_benchmark.py --size-mb 4 --latency 0.15 --seconds-per-mb 1.0
+
+DLP is replaced by a regex finder for "Vorname Nachname" pairs with a simulated latency of
+latency + seconds_per_mb * request size. The script compares
+
+    - baseline: the previous implementation, fixed cuts of MAX_PROMPT_SIZE_DLP characters,
+      sequential requests, one string rebuild per finding, sections without findings dropped,
+    - cold: dlp_api.anonymize_text_async with an empty cache,
+    - warm: the same document again, as in a follow-up doc chat turn,
+
+and reports wall time, number of requests, names left unmasked and whether the length of
+the document was preserved.
+"""
+import argparse
+import asyncio
+import random
+import re
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from backend.utils import constants, dlp_api
+
+FIRST_NAMES = ["Anna", "Lukas", "Marie", "Jonas", "Sophie", "Felix"]
+LAST_NAMES = ["Schmidt", "Meyer", "Becker", "Hoffmann", "Schulz", "Koch"]
+NAME_PATTERN = re.compile(rf"(?:{'|'.join(FIRST_NAMES)})\s+(?:{'|'.join(LAST_NAMES)})")
+WORDS = ["Vertrag", "Leistung", "Versicherung", "Beitrag", "Kunde", "Tarif", "Antrag", "Schaden", "der", "und", "mit"]
+
+
+def build_document(size: int) -> str:
+    random.seed(42)
+    lines = []
+    length = 0
+    while length < size:
+        words = [random.choice(WORDS) for _ in range(random.randint(4, 16))]
+        if random.random() < 0.2:
+            words.insert(random.randint(0, len(words)), f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}")
+        line = " ".join(words)
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def fake_response(prompt: str):
+    findings = [
+        SimpleNamespace(location=SimpleNamespace(codepoint_range=SimpleNamespace(start=match.start(), end=match.end())))
+        for match in NAME_PATTERN.finditer(prompt)
+    ]
+    return SimpleNamespace(result=SimpleNamespace(findings=findings, findings_truncated=False))
+
+
+def baseline(doc: str, latency) -> tuple[str, int]:
+    max_len = constants.MAX_PROMPT_SIZE_DLP
+    sections = [doc[i:i + max_len] for i in range(0, len(doc), max_len)] if len(doc) > max_len else [doc]
+    anonymized = []
+    for section in sections:
+        time.sleep(latency(section))
+        findings = fake_response(section).result.findings
+        if not findings:
+            continue
+        text = section
+        for finding in findings:
+            start, end = finding.location.codepoint_range.start, finding.location.codepoint_range.end
+            text = text[:start] + "*" * (end - start) + text[end:]
+        anonymized.append(text)
+    return " ".join(anonymized) if anonymized else doc, len(sections)
+
+
+def _report(label: str, doc: str, anonymized: str, duration: float, requests: int) -> None:
+    print(
+        f"{label:<9} {duration:>7.2f}s requests={requests:<4} "
+        f"unmasked_names={len(NAME_PATTERN.findall(anonymized)):<4} length_preserved={len(anonymized) == len(doc)}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--latency", type=float, default=0.15, help="Fixed latency per DLP request in seconds")
+    parser.add_argument("--seconds-per-mb", type=float, default=1.0, help="Additional latency per MB of request")
+    args = parser.parse_args()
+
+    def latency(text: str) -> float:
+        return args.latency + args.seconds_per_mb * len(text.encode()) / 1e6
+
+    doc = build_document(int(args.size_mb * 1e6))
+    print(f"document: {len(doc) / 1e6:.1f} M characters, {len(NAME_PATTERN.findall(doc))} names")
+
+    start_time = time.perf_counter()
+    anonymized, requests = baseline(doc, latency)
+    _report("baseline", doc, anonymized, time.perf_counter() - start_time, requests)
+
+    request_count = 0
+
+    async def fake_dlp(prompt: str, project_id: str):
+        nonlocal request_count
+        request_count += 1
+        await asyncio.sleep(latency(prompt))
+        return fake_response(prompt)
+
+    dlp_api._call_dlp_api_async = fake_dlp
+    for label in ["cold", "warm"]:
+        request_count = 0
+        start_time = time.perf_counter()
+        anonymized, _, _ = asyncio.run(dlp_api.anonymize_text_async(doc, "benchmark"))
+        _report(label, doc, anonymized, time.perf_counter() - start_time, request_count)
+
+
+if __name__ == "__main__":
+    main()
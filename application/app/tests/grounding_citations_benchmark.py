@@ -0,0 +1,123 @@
+"""Benchmark of the rendering of grounded BaFin answers with their citations.
+
+    python grounding_citations_benchmark.py --supports 100 300 1000 --chunks 200
+
+Generates grounded responses with the given number of grounding supports, each citing up to
+four of the grounding chunks, and compares
+
+    - baseline: the previous grounding_response_with_citations, with string concatenation and
+      a loop over supports x chunk indices x all chunks for the source list,
+    - renderer: grounding_renderer.render, which also builds the structured citations,
+
+reporting the time per response and whether both produce the same markdown.
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from backend.utils import grounding_renderer
+
+
+def build_response(supports: int, chunks: int) -> SimpleNamespace:
+    random.seed(42)
+    words = ["Die", "BaFin", "verlangt", "ein", "angemessenes", "Risikomanagement", "gemäß", "MaRisk", "für", "Institute"]
+    segments = [" ".join(random.choice(words) for _ in range(random.randint(8, 30))) + "." for _ in range(supports)]
+    text = " ".join(segments) + " Weitere Hinweise ohne Beleg."
+
+    grounding_supports = []
+    end_index = 0
+    for segment in segments:
+        end_index += len((segment + " ").encode("utf-8"))
+        grounding_supports.append(SimpleNamespace(
+            segment=SimpleNamespace(end_index=end_index - 1),
+            grounding_chunk_indices=random.sample(range(chunks), random.randint(1, 4)),
+        ))
+    grounding_chunks = [
+        SimpleNamespace(web=None, retrieved_context=SimpleNamespace(
+            uri=f"gs://bafin-docs/rundschreiben/{index}/dokument_{index}.pdf",
+            title=f"Rundschreiben {index}",
+            text=" ".join(random.choice(words) for _ in range(200)),
+        ))
+        for index in range(chunks)
+    ]
+    return SimpleNamespace(
+        text=text,
+        candidates=[SimpleNamespace(grounding_metadata=SimpleNamespace(
+            grounding_supports=grounding_supports,
+            grounding_chunks=grounding_chunks,
+        ))],
+    )
+
+
+def baseline(response) -> str:
+    """grounding_response_with_citations before the change."""
+    grounding_metadata = response.candidates[0].grounding_metadata
+    ENCODING = "utf-8"
+    text_bytes = response.text.encode(ENCODING)
+
+    prev_index = 0
+    markdown_text = ""
+    for grounding_support in grounding_metadata.grounding_supports:
+        text_segment = text_bytes[prev_index : grounding_support.segment.end_index].decode(ENCODING)
+        footnotes_text = ""
+        for grounding_chunk_index in grounding_support.grounding_chunk_indices:
+            footnotes_text += f"[{grounding_chunk_index + 1}]"
+        markdown_text += f"{text_segment} {footnotes_text}\n"
+        prev_index = grounding_support.segment.end_index
+
+    if prev_index < len(text_bytes):
+        markdown_text += str(text_bytes[prev_index:], encoding=ENCODING)
+
+    markdown_text += "### Relevante Quellen\n"
+
+    already_used_citations = []
+    for grounding_support in response.candidates[0].grounding_metadata.grounding_supports:
+        for grounding_chunk_index in grounding_support.grounding_chunk_indices:
+            for index, grounding_chunk in enumerate(response.candidates[0].grounding_metadata.grounding_chunks):
+                context = grounding_chunk.web or grounding_chunk.retrieved_context
+                if not context:
+                    continue
+                if grounding_chunk_index == index:
+                    if index not in already_used_citations:
+                        folder_path = "/".join(str(context.uri).split("/")[3:]) + "/"
+                        markdown_text += f"[{(index + 1)}] [{folder_path}] \n \n"
+                        already_used_citations.append(index)
+
+    return markdown_text
+
+
+def measure(render, response, repeat: int) -> float:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(response)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--supports", type=int, nargs="+", default=[100, 300, 1000])
+    parser.add_argument("--chunks", type=int, default=200, help="Grounding chunks per response")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for supports in args.supports:
+        response = build_response(supports, args.chunks)
+        rendered = grounding_renderer.render(response)
+        same = rendered.markdown == baseline(response)
+        old = measure(baseline, response, args.repeat)
+        new = measure(grounding_renderer.render, response, args.repeat)
+        print(
+            f"{supports:5d} supports: baseline {old * 1000:9.2f} ms, renderer {new * 1000:7.2f} ms "
+            f"({old / new:6.1f}x), {len(rendered.citations)} citations, same markdown: {same}"
+        )
+
+
+if __name__ == "__main__":
+    main()
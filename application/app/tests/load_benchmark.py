@@ -0,0 +1,133 @@
+"""Load benchmark for the concurrency per backend instance.
+
+Two modes:
+
+    # Against a running backend (e.g. the old and the new revision one after another)
+    python load_benchmark.py --url http://localhost:8003/llm/textchat --concurrency 10 40 100 200
+
+    # Offline simulation of the old sync handlers (FastAPI threadpool, 40 worker tokens)
+    # against the new async handlers, with a simulated LLM round trip
+    python load_benchmark.py --simulate --llm-latency 5 --concurrency 10 40 100 200
+
+For every concurrency level the script reports throughput, latency percentiles and the
+maximum number of requests that were in flight at the same time.
+"""
+import argparse
+import asyncio
+import random
+import string
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Default size of the anyio threadpool that runs sync FastAPI handlers
+FASTAPI_THREADPOOL_SIZE = 40
+
+
+def randomword(length: int) -> str:
+    letters = string.ascii_lowercase
+    return "".join(random.choice(letters) for i in range(length))
+
+
+def _report(label: str, concurrency: int, latencies: list, wall_time: float, max_in_flight: int) -> None:
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{label:<8} concurrency={concurrency:<4} requests={len(latencies):<4} "
+        f"throughput={len(latencies) / wall_time:7.2f} req/s "
+        f"p50={p50:6.2f}s p95={p95:6.2f}s max_in_flight={max_in_flight}"
+    )
+
+
+def run_http(url: str, concurrency: int, requests_per_worker: int) -> None:
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    latencies = []
+
+    def _worker() -> None:
+        nonlocal in_flight, max_in_flight
+        for _ in range(requests_per_worker):
+            data = {
+                "question": "Was ist ein Large Language Model?",
+                "history": [],
+                "session_id": randomword(10),
+                "oid_hashed": "oid",
+            }
+            with lock:
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+            start = time.perf_counter()
+            response = requests.post(url, json=data, timeout=600)
+            latencies.append(time.perf_counter() - start)
+            with lock:
+                in_flight -= 1
+            if response.status_code != 200:
+                print(response.status_code, response.content[:200])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(_worker)
+    _report("http", concurrency, latencies, time.perf_counter() - start, max_in_flight)
+
+
+async def _simulate(concurrency: int, llm_latency: float, use_async: bool) -> None:
+    executor = ThreadPoolExecutor(max_workers=FASTAPI_THREADPOOL_SIZE)
+    loop = asyncio.get_running_loop()
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    latencies = []
+
+    def _sync_handler() -> None:
+        time.sleep(llm_latency)
+
+    async def _async_handler() -> None:
+        await asyncio.sleep(llm_latency)
+
+    async def _request() -> None:
+        nonlocal in_flight, max_in_flight
+        start = time.perf_counter()
+        if use_async:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await _async_handler()
+            in_flight -= 1
+        else:
+            def _tracked() -> None:
+                nonlocal in_flight, max_in_flight
+                with lock:
+                    in_flight += 1
+                    max_in_flight = max(max_in_flight, in_flight)
+                _sync_handler()
+                with lock:
+                    in_flight -= 1
+            await loop.run_in_executor(executor, _tracked)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_request() for _ in range(concurrency)])
+    executor.shutdown()
+    _report("async" if use_async else "sync", concurrency, latencies, time.perf_counter() - start, max_in_flight)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8003/llm/textchat")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 40, 100, 200])
+    parser.add_argument("--requests-per-worker", type=int, default=1)
+    parser.add_argument("--simulate", action="store_true")
+    parser.add_argument("--llm-latency", type=float, default=5.0, help="Simulated LLM round trip in seconds")
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        if args.simulate:
+            asyncio.run(_simulate(concurrency, args.llm_latency, use_async=False))
+            asyncio.run(_simulate(concurrency, args.llm_latency, use_async=True))
+        else:
+            run_http(args.url, concurrency, args.requests_per_worker)
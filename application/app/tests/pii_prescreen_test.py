@@ -0,0 +1,49 @@
+"""Checks of the local PII pre-screen, run with pytest from application/app.
+
+A local finding rejects the prompt without DLP, so ordinary questions must not produce any.
+The name lists are small stand-ins for gender_guesser and the Faker last names used by dlp_api.
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from backend.utils.pii_prescreen import PiiPrescreen
+
+FIRST_NAMES = {"Anna", "Jonas", "Thomas"}
+LAST_NAMES = {"Schmidt", "Becker", "Müller"}
+prescreen = PiiPrescreen(is_first_name=FIRST_NAMES.__contains__, is_last_name=LAST_NAMES.__contains__)
+
+
+@pytest.mark.parametrize("prompt", [
+    "Hat jede Frau Anspruch auf Mutterschutz?",
+    "Wie beantrage ich als Frau Elternzeit?",
+    "Was gilt für eine Frau Mitte 40?",
+    "Welche Anforderungen gelten für Transaction Monitoring 2024?",
+    "Was bedeutet Arbeitsplatz 4.0 für uns?",
+    "Ist Zahlungsweg 2 zulässig?",
+    "Wie läuft Clearing 2 ab?",
+    "Bitte überweise an DE89 3704 0044 0532 0130 00.",
+    "Siehe Tz. 0 12345678 des Rundschreibens.",
+    "Der Leitfaden 0815 2024 ist veraltet.",
+])
+def test_ordinary_questions_have_no_findings(prompt):
+    assert prescreen.findings(prompt) == []
+
+
+@pytest.mark.parametrize("prompt, info_type, quote", [
+    ("Bitte ruf Frau Schmidt an.", "LAST_NAME", "Schmidt"),
+    ("Termin mit Herrn Dr. Jonas Becker", "FIRST_NAME", "Jonas"),
+    ("Termin mit Herrn Dr. Jonas Becker", "LAST_NAME", "Becker"),
+    ("Meine Nummer ist +49 30 1234567.", "PHONE_NUMBER", "+49 30 1234567"),
+    ("Ruf mich unter 030/12345678 an", "PHONE_NUMBER", "030/12345678"),
+    ("Ich wohne in der Hauptstraße 5, 10115 Berlin.", "STREET_ADDRESS", "Hauptstraße 5, 10115 Berlin"),
+])
+def test_confirmed_personal_data_is_found(prompt, info_type, quote):
+    assert (info_type, quote) in [(finding.info_type, finding.quote) for finding in prescreen.findings(prompt)]
+
+
+def test_unknown_word_after_first_name_is_not_a_last_name():
+    findings = prescreen.findings("Frau Anna Elternzeit")
+    assert [(finding.info_type, finding.quote) for finding in findings] == [("FIRST_NAME", "Anna")]
@@ -0,0 +1,145 @@
+"""Offline evaluation of the retrieval mode of the provided documents against the full-context mode.
+
+    python provided_doc_retrieval_eval.py
+    python provided_doc_retrieval_eval.py --live --project-id my-project --limit 10
+
+The questions of the catalog (<FRAGEn> in fragenkatalogv2.txt) are used as evaluation set, their
+catalog answers as reference. Without --live no model is called, the script reports per document
+
+    - prompt size: estimated tokens of the context sent, full document vs. excerpts,
+    - catalog recall: share of questions whose own catalog entry is among the excerpts,
+    - answer support: share of the reference answer's terms found in the excerpts of the strategy
+      paper, relative to the share found in the whole paper (1.0 = as good as full context).
+
+With --live both modes are asked through Gemini, and the script reports the prompt tokens counted
+by the API and a judgement by Gemini whether the excerpt answer is as good as the full-context
+answer for the same question.
+"""
+import argparse
+import asyncio
+import re
+import statistics
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from backend.utils import constants, document_registry, retrieval_index
+
+LOCAL_FILES = Path(__file__).parent.parent / "backend" / "local_files"
+ENTRY_PATTERN = re.compile(r"<FRAGE(\d+)>(.*?)</FRAGE\1>\s*<ANTWORT\1>(.*?)</ANTWORT\1>", re.S)
+JUDGE_PROMPT = """
+Vergleiche zwei Antworten auf dieselbe Frage. Antwort A wurde mit dem gesamten Dokument erzeugt,
+Antwort B nur mit Auszügen daraus. Ist Antwort B inhaltlich mindestens so korrekt und vollständig
+wie Antwort A? Antworte nur mit JA oder NEIN.
+
+Frage: {question}
+
+Antwort A: {full}
+
+Antwort B: {excerpts}
+"""
+
+
+def catalog_entries(registry: document_registry.DocumentRegistry) -> list:
+    content = registry.get("fragenkatalog").content
+    return [(number, " ".join(question.split()), " ".join(answer.split())) for number, question, answer in ENTRY_PATTERN.findall(content)]
+
+
+def tokens(text: str) -> int:
+    return len(text) // constants.CHARS_PER_TOKEN_ESTIMATE
+
+
+def offline(registry: document_registry.DocumentRegistry, entries: list) -> None:
+    for doc_key in registry.doc_keys():
+        document = registry.get(doc_key)
+        sizes = []
+        for _, question, _ in entries:
+            excerpts = registry.retrieve(doc_key, question)
+            sizes.append(tokens(excerpts if excerpts is not None else document.content))
+        print(
+            f"{doc_key}: full {tokens(document.content)} tokens, excerpts mean {statistics.mean(sizes):.0f} / "
+            f"max {max(sizes)} tokens ({tokens(document.content) / statistics.mean(sizes):.1f}x fewer)"
+        )
+
+    catalog = registry.get("fragenkatalog").index
+    hits = 0
+    for number, question, _ in entries:
+        passages = catalog.search(question, constants.PROVIDED_DOC_RETRIEVAL_TOP_K, constants.PROVIDED_DOC_RETRIEVAL_MAX_CHARS)
+        hits += any(f"<FRAGE{number}>" in passage.text for passage in passages)
+    print(f"fragenkatalog: catalog recall {hits / len(entries):.2f} ({hits}/{len(entries)})")
+
+    paper = registry.get("strategiepapier")
+    paper_terms = set(retrieval_index.tokenize(paper.content))
+    support = []
+    for _, question, answer in entries:
+        reference = set(retrieval_index.tokenize(answer))
+        in_paper = reference & paper_terms
+        if not in_paper:
+            continue
+        passages = paper.index.search(question, constants.PROVIDED_DOC_RETRIEVAL_TOP_K, constants.PROVIDED_DOC_RETRIEVAL_MAX_CHARS)
+        excerpt_terms = set(retrieval_index.tokenize(retrieval_index.render_passages(passages)))
+        support.append(len(reference & excerpt_terms) / len(in_paper))
+    print(f"strategiepapier: answer support {statistics.mean(support):.2f} (min {min(support):.2f}) relative to full context")
+
+
+async def live(registry: document_registry.DocumentRegistry, entries: list, project_id: str, location: str) -> None:
+    from backend.utils import vertexai_api
+
+    model_name = constants.GEMINI_TEXT_CHAT_DEFAULT_MODEL_NAME
+    for doc_key in registry.doc_keys():
+        document = registry.get(doc_key)
+        prompt_tokens = {"full": [], "excerpts": []}
+        agreed = 0
+        for _, question, _ in entries:
+            answers = {}
+            for mode in ("full", "excerpts"):
+                excerpts = registry.retrieve(doc_key, question) if mode == "excerpts" else None
+                (answer, num_token_prompt, _), _ = await vertexai_api.ask_gemini_docchat_question_async(
+                    doc_context=excerpts if excerpts is not None else document.content,
+                    prompt=question,
+                    project_id=project_id,
+                    history=[],
+                    model_name=model_name,
+                    system_instruction=(
+                        list(document.system_instruction) + [constants.SYSTEM_INSTRUCTION_PROVIDED_DOC_RETRIEVAL]
+                        if excerpts is not None else document.system_instruction
+                    ),
+                    temperature=0.0,
+                    max_output_tokens=500,
+                    location=location,
+                )
+                answers[mode] = answer
+                prompt_tokens[mode].append(num_token_prompt)
+            (verdict, _, _), _ = await vertexai_api.ask_gemini_textchat_question_async(
+                prompt=JUDGE_PROMPT.format(question=question, full=answers["full"], excerpts=answers["excerpts"]),
+                project_id=project_id,
+                history=[],
+                model_name=model_name,
+                temperature=0.0,
+                location=location,
+            )
+            agreed += verdict.strip().upper().startswith("JA")
+        print(
+            f"{doc_key}: prompt tokens full {statistics.mean(prompt_tokens['full']):.0f}, "
+            f"excerpts {statistics.mean(prompt_tokens['excerpts']):.0f}, "
+            f"excerpt answers as good as full context {agreed}/{len(entries)}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--live", action="store_true", help="Ask Gemini in both modes")
+    parser.add_argument("--project-id")
+    parser.add_argument("--location", default="europe-west3")
+    parser.add_argument("--limit", type=int, default=None, help="Number of catalog questions")
+    args = parser.parse_args()
+
+    registry = document_registry.DocumentRegistry(str(LOCAL_FILES))
+    entries = catalog_entries(registry)[:args.limit]
+    offline(registry, entries)
+    if args.live:
+        asyncio.run(live(registry, entries, args.project_id, args.location))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Rows/second of the cosi_usage logging paths.
+
+    # Local SQLite file as stand-in (default)
+    python sql_insert_benchmark.py --rows 2000
+
+    # Local Postgres, e.g. docker run -e POSTGRES_PASSWORD=pw -p 5432:5432 postgres
+    python sql_insert_benchmark.py --url postgresql+psycopg2://postgres:pw@localhost:5432/postgres
+
+Compares
+
+    - per-request: a new engine and transaction per row, as sql_api.log_usage did before,
+    - pooled: the shared engine of sql_api, one transaction per row,
+    - bulk: the shared engine, one multi-row INSERT per batch (sql_api.log_usage_batch).
+
+The cosi_usage table is created if it does not exist and emptied before every run.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import delete
+from sqlmodel import SQLModel, create_engine
+
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from backend.schemas.sql_schemas.cosi_usage import CosiUsage
+from backend.utils import sql_api
+
+
+def _rows(count: int) -> list:
+    return [
+        sql_api.usage_data(f"oid{i % 50}", f"session{i}", "text_chat", 1200, 300, 2, 400)
+        for i in range(count)
+    ]
+
+
+def _run(label: str, rows: list, write) -> None:
+    with sql_api.get_engine().begin() as connection:
+        connection.execute(delete(CosiUsage))
+    start_time = time.perf_counter()
+    write(rows)
+    duration = time.perf_counter() - start_time
+    print(f"{label:<12} rows={len(rows):<6} {len(rows) / duration:>10.0f} rows/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None, help="SQLAlchemy URL, defaults to a temporary SQLite file")
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    url = args.url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'cosi_usage.db')}"
+    # Read by sql_api.get_engine on first use
+    os.environ["CONNECTION_STRING"] = url
+
+    SQLModel.metadata.create_all(sql_api.get_engine(), tables=[CosiUsage.__table__])
+    rows = _rows(args.rows)
+
+    def per_request(rows):
+        for row in rows:
+            engine = create_engine(url)
+            handler = sql_api.SQLHandler()
+            handler.engine = engine
+            handler.insert_row(CosiUsage, row)
+            engine.dispose()
+
+    def pooled(rows):
+        for row in rows:
+            sql_api.SQLHandler().insert_row(CosiUsage, row)
+
+    def bulk(rows):
+        for i in range(0, len(rows), args.batch_size):
+            sql_api.log_usage_batch(rows[i:i + args.batch_size])
+
+    _run("per-request", rows, per_request)
+    _run("pooled", rows, pooled)
+    _run("bulk", rows, bulk)
+
+
+if __name__ == "__main__":
+    main()
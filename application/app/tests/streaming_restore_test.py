@@ -0,0 +1,61 @@
+"""Checks that streamed answers are restored like complete ones, run with pytest from application/app.
+
+dlp_api.restore_original_data restores a complete answer with a PatternReplacer, the streaming
+endpoints use a StreamingRestorer. Both must give the same text for every split into chunks.
+"""
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+from backend.utils.pseudonymizer import PatternReplacer, StreamingRestorer
+
+MAPPING = {
+    "Anna": ["Maria", "FIRST_NAME"],
+    "Anna Schmidt": ["Maria Weber", "FIRST_NAME"],
+    "Schmidt": ["Weber", "LAST_NAME"],
+    "Hauptstraße 5, 10115 Berlin": ["Lindenweg 3, 50667 Köln", "STREET_ADDRESS"],
+    "030 1234567": ["0221 7654321", "PHONE_NUMBER"],
+}
+ANSWERS = [
+    "Anna Schmidt wohnt in der Hauptstraße 5, 10115 Berlin.",
+    "Annabell und Anna sind nicht dieselbe Person, Schmidtke auch nicht.",
+    "Ruf Anna unter 030 1234567 an, nicht unter 030 12345678.",
+    "AnnaAnna Schmidt_ Anna_Schmidt Anna-Schmidt",
+    "Anna",
+    "Schmidt",
+    "",
+]
+
+
+def restore(answer: str) -> str:
+    return PatternReplacer({pseudonym: original[0] for pseudonym, original in MAPPING.items()}).replace(answer)[0]
+
+
+def stream(answer: str, chunk_sizes) -> str:
+    restorer = StreamingRestorer(MAPPING)
+    parts = []
+    position = 0
+    for size in chunk_sizes:
+        parts.append(restorer.feed(answer[position:position + size]))
+        position += size
+    parts.append(restorer.feed(answer[position:]))
+    parts.append(restorer.flush())
+    return "".join(parts)
+
+
+@pytest.mark.parametrize("answer", ANSWERS)
+def test_streaming_matches_complete_restore(answer):
+    expected = restore(answer)
+    for size in range(1, len(answer) + 2):
+        assert stream(answer, [size] * len(answer)) == expected
+    rng = random.Random(42)
+    for _ in range(200):
+        assert stream(answer, [rng.randint(0, 6) for _ in range(len(answer))]) == expected
+
+
+def test_pseudonym_is_not_restored_inside_a_word():
+    assert stream("Annabell", [4, 4]) == "Annabell"
+    assert stream("Anna bell", [4, 5]) == "Maria bell"
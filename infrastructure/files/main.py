@@ -2,6 +2,7 @@ import os
 import json
 import logging
 import hashlib
+from datetime import datetime, timezone
 import google.cloud.logging
 from google.cloud import storage
 from google.api_core.client_options import ClientOptions
@@ -17,6 +18,8 @@ LOCATION = os.getenv("LOCATION")
 DATA_STORE_ID = os.getenv("DATA_STORE_ID")
 GCS_BUCKET = os.getenv("GCS_BUCKET")
 METADATA_BASE_DIR = "metadata"
+# Rewritten after every import, the backend clears its search result cache when its generation changes
+GENERATION_MARKER = f"{METADATA_BASE_DIR}/datastore_generation.json"
 
 def import_documents(project_id, location, data_store_id, event_bucket, metadata_filename):
     # Create a client
@@ -88,6 +91,15 @@ def write_metadata_file(bucket: str, file_path: str):
     logging.info(f"File metadata written to json_file: {metadata_filename}")
     return metadata_filename
 
+def write_generation_marker(operation_name: str):
+    client = storage.Client()
+    blob = client.bucket(GCS_BUCKET).blob(GENERATION_MARKER)
+    blob.upload_from_string(
+        data=json.dumps({"operation": operation_name, "imported_at": datetime.now(timezone.utc).isoformat()}),
+        content_type="application/json",
+    )
+    logging.info(f"Generation marker written: {GENERATION_MARKER}")
+
 def event_handler(event, context):
     try:
         if event["name"].split("/")[0] == METADATA_BASE_DIR:
@@ -97,8 +109,9 @@ def event_handler(event, context):
         logging.info(f"Reading metadata for object")
         metadata_filename = write_metadata_file(event["bucket"], event["name"])
         logging.info('Starting loading data %s into data store', event["name"])
-        import_documents(PROJECT_ID, LOCATION, DATA_STORE_ID, event["bucket"], metadata_filename)
+        operation_name = import_documents(PROJECT_ID, LOCATION, DATA_STORE_ID, event["bucket"], metadata_filename)
         logging.info('Completed loading data %s into data store', event["name"])
+        write_generation_marker(operation_name)
 
     except Exception as e:
         logging.error('Error: %s', e)
@@ -19,6 +19,18 @@ locals {
     },
     DATASTORE_ID = {
       value = module.agent_builder.data_store_id
+    },
+    # Shared backend of the server-side chat histories, every instance can continue a session
+    SESSION_STORE_BUCKET = {
+      value = module.storage_bucket.bucket_name
+    },
+    # Shared backend of the uploaded doc chat documents, every instance can answer questions about them
+    DOCUMENT_STORE_BUCKET = {
+      value = module.storage_bucket.bucket_name
+    },
+    # Holds the marker the ingestion function rewrites after every import, see query_cache
+    DATASTORE_GENERATION_BUCKET = {
+      value = module.agent_builder.bucket_name
     }
   }
 
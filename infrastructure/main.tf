@@ -14,6 +14,16 @@ module "storage_bucket" {
         age = 90
       }
     }
+    # Uploaded doc chat documents carry their expiry as custom time, see document_store
+    "expired_documents" = {
+      action = {
+        type = "Delete"
+      }
+      condition = {
+        days_since_custom_time = 1
+        matches_prefix         = ["documents/"]
+      }
+    }
   }
 }
 
@@ -82,6 +92,8 @@ module "cloud_run" {
           cpu    = "1"
           memory = "1024Mi"
         }
+        # Keep CPU allocated between requests, the log records are written in the background
+        cpu_idle = false
       }
     }
   }
@@ -116,7 +128,7 @@ module "cloud_run" {
       }
     }
   }
-  container_concurrency = "80"
+  container_concurrency = "250"
   depends_on            = [module.docker_image, google_cloud_run_v2_job.default]
 }
 